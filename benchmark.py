@@ -0,0 +1,205 @@
+"""
+Бенчмарки виртуальной файловой системы на синтетических tar-архивах.
+
+Для каждого размера архива генерируется образ с заданной глубиной, ветвлением, числом файлов
+и длиной имён, затем замеряются время и пиковая память операций VirtualFileSystem.
+Результаты пишутся в JSON; при сравнении с сохранённым базовым прогоном скрипт завершается
+с кодом 1, если какая-либо метрика выросла больше допустимого порога.
+
+    python benchmark.py --sizes small medium --output bench.json
+    python benchmark.py --baseline bench.json --threshold 0.25
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+from emulator import VirtualFileSystem
+
+# Параметры синтетических архивов: глубина дерева каталогов, ветвление, файлов в каталоге, длина имён
+SIZES = {
+    "small": dict(depth=2, fanout=5, files_per_dir=20, name_length=8),
+    "medium": dict(depth=3, fanout=8, files_per_dir=40, name_length=12),
+    "large": dict(depth=4, fanout=10, files_per_dir=50, name_length=16),
+}
+
+# Разница во времени меньше этой (в секундах) считается шумом и регрессией не является
+NOISE_FLOOR = 0.001
+
+
+def _name(prefix, index, length):
+    # Имя вида d000017 заданной длины
+    return f"{prefix}{index:0{max(length - len(prefix), 1)}d}"
+
+
+def make_synthetic_tar(path, depth, fanout, files_per_dir, name_length=8, file_size=0):
+    """
+    Создаёт tar-архив: корневой каталог image, дерево каталогов глубины depth с fanout
+    подкаталогами у каждого и files_per_dir файлами размера file_size в каждом каталоге.
+    Возвращает число записей в архиве.
+    """
+    data = b"x" * file_size
+    count = 0
+    with tarfile.open(path, "w") as tar:
+        level = ["image"]
+        for current_depth in range(depth + 1):
+            next_level = []
+            for directory in level:
+                info = tarfile.TarInfo(directory)
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+                count += 1
+                for i in range(files_per_dir):
+                    info = tarfile.TarInfo(f"{directory}/{_name('f', i, name_length)}.txt")
+                    info.size = file_size
+                    tar.addfile(info, io.BytesIO(data))
+                    count += 1
+                if current_depth < depth:
+                    next_level.extend(f"{directory}/{_name('d', i, name_length)}" for i in range(fanout))
+            level = next_level
+    return count
+
+
+def _deepest_dir(depth, name_length):
+    return "/image" + "".join(f"/{_name('d', 0, name_length)}" for _ in range(depth))
+
+
+def _operations(tar_path, params):
+    """
+    Операции бенчмарка: имя -> (подготовка, замеряемое действие).
+    Подготовка возвращает состояние, которое получает действие, и в замер не входит.
+    """
+    deepest = _deepest_dir(params["depth"], params["name_length"])
+    second = "/image/" + _name("d", 1, params["name_length"])
+
+    def loaded():
+        vfs = VirtualFileSystem(tar_path, use_index=False)
+        vfs.ls("/")  # дочитываем архив до конца
+        return vfs
+
+    def index():
+        # Полное чтение архива записывает индекс рядом с ним
+        VirtualFileSystem(tar_path).ls("/")
+
+    def touch(vfs):
+        vfs.cd(deepest)
+        for i in range(1000):
+            vfs.touch(f"new{i}")
+
+    def cd(vfs):
+        for _ in range(1000):
+            vfs.cd(deepest)
+            vfs.cd("/")
+
+    return {
+        "load_tar": (lambda: None, lambda _: loaded()),
+        "load_index": (index, lambda _: VirtualFileSystem(tar_path).ls("/")),
+        "ls": (loaded, lambda vfs: vfs.ls(deepest)),
+        "cd": (loaded, cd),
+        "cp": (loaded, lambda vfs: vfs.cp(second, deepest)),
+        "mv": (loaded, lambda vfs: vfs.mv(second, deepest)),
+        "mv_glob": (loaded, lambda vfs: vfs.mv(deepest + "/*.txt", second + "/moved")),
+        "touch": (loaded, touch),
+        "tree": (loaded, lambda vfs: vfs.tree("/")),
+    }
+
+
+def _measure(setup, action, repeat):
+    # Время — лучшее из repeat запусков без трассировки памяти; пик памяти — отдельным запуском под tracemalloc
+    seconds = float("inf")
+    for _ in range(repeat):
+        state = setup()
+        started = time.perf_counter()
+        action(state)
+        seconds = min(seconds, time.perf_counter() - started)
+
+    state = setup()
+    tracemalloc.start()
+    try:
+        action(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def run_benchmarks(sizes, workdir, repeat=3, operations=None):
+    """Генерирует архивы нужных размеров и замеряет операции. Возвращает список результатов."""
+    results = []
+    for size in sizes:
+        params = SIZES[size]
+        tar_path = os.path.join(workdir, f"{size}.tar")
+        entries = make_synthetic_tar(tar_path, **params)
+        for name, (setup, action) in _operations(tar_path, params).items():
+            if operations and name not in operations:
+                continue
+            seconds, peak = _measure(setup, action, repeat)
+            results.append({"size": size, "entries": entries, "operation": name,
+                            "seconds": seconds, "peak_bytes": peak})
+            print(f"{size:>8} {name:>10}: {seconds * 1000:10.2f} мс, пик {peak / 1024:10.1f} КБ", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Сравнивает результаты с базовым прогоном. Возвращает список описаний регрессий:
+    метрик, выросших больше чем в (1 + threshold) раз.
+    """
+    previous = {(item["size"], item["operation"]): item for item in baseline["results"]}
+    regressions = []
+    for item in results:
+        base = previous.get((item["size"], item["operation"]))
+        if base is None:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            if metric == "seconds" and item[metric] - base[metric] < NOISE_FLOOR:
+                continue
+            if base[metric] and item[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{item['size']}/{item['operation']} {metric}: "
+                                   f"{base[metric]:.6g} -> {item[metric]:.6g} "
+                                   f"(+{(item[metric] / base[metric] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки эмулятора виртуальной файловой системы.")
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=["small", "medium"],
+                        help="Размеры синтетических архивов.")
+    parser.add_argument('--operations', nargs='+', help="Замерять только указанные операции.")
+    parser.add_argument('--repeat', type=int, default=3, help="Сколько раз повторять замер времени.")
+    parser.add_argument('--output', default="benchmark.json", help="Куда записать результаты в формате JSON.")
+    parser.add_argument('--baseline', help="JSON с результатами прошлого прогона для сравнения.")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Допустимый относительный рост метрики по сравнению с базовым прогоном.")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(args.sizes, workdir, args.repeat, args.operations)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"Регрессия: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,269 +1,3398 @@
 import tkinter as tk
 from tkinter import scrolledtext
 import argparse
+import asyncio
+import base64
+import bisect
+import bz2
+import codecs
+import cProfile
+import ctypes
+import ctypes.util
+import fnmatch
+import gzip
+import io
+import json
+import lzma
+import mmap
+import os
+import pstats
+import queue
+import re
+import stat
+import struct
+import sys
 import tarfile
-from pathlib import Path
+import threading
+import time
+import tracemalloc
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, islice, repeat
 
+try:
+    import zstandard  # нужен только для образов .tar.zst
+except ImportError:
+    zstandard = None
+try:
+    import resource  # нет на Windows
+except ImportError:
+    resource = None
+
+# Индекс архива хранится рядом с ним: <архив>.vfsidx
+INDEX_SUFFIX = ".vfsidx"
+_INDEX_MAGIC = b"VFSIDX\0\0"
+_INDEX_VERSION = 3
+# Заголовок индекса: сигнатура, версия, размер архива, mtime архива (нс), контрольная сумма, число записей
+_INDEX_HEADER = struct.Struct("<8sIQqII")
+# Запись индекса: тип, длина имени, смещение имени в пуле имён, два поля, зависящих от типа
+# (для файла — смещение данных и размер, для каталога — первая дочерняя запись и их число),
+# время изменения, права доступа, для каталога — суммарный размер и число записей его поддерева,
+# и смещение заголовка записи в архиве (-1 — записи в архиве нет)
+_INDEX_ENTRY = struct.Struct("<BxHIQQqIQQq")
+_KIND_FILE = 0
+_KIND_DIR = 1
+# Смещение данных файла, у которого их нет в архиве
+_NO_DATA = (1 << 64) - 1
+# Журнал изменений дерева хранится рядом с архивом: <архив>.vfsjournal
+JOURNAL_SUFFIX = ".vfsjournal"
+# Точки перезапуска распаковки сжатого архива хранятся рядом с ним: <архив>.vfsz
+CHECKPOINTS_SUFFIX = ".vfsz"
+# Через сколько байт несжатых данных ставится контрольная точка распаковки
+CHECKPOINT_SPAN = 4 * 1024 * 1024
+# Сколько байт сжатого архива распаковывается за один шаг
+_COMPRESSED_CHUNK = 16 * 1024
+# Сколько несжатых байт _Inflater получает от zlib за один вызов inflate
+_INFLATE_OUTPUT = 256 * 1024
+# Константы zlib.h для _Inflater
+_Z_STREAM_END = 1
+_Z_BUF_ERROR = -5
+_Z_BLOCK = 5
+_DEFLATE_WINDOW = 32 * 1024
+# После потока deflate в члене gzip идут CRC32 и длина — 8 байт
+_GZIP_TRAILER = 8
+# Сигнатуры сжатых архивов
+_COMPRESSION_MAGIC = ((b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd"))
+# Расширения, по которым save выбирает сжатие нового архива
+_COMPRESSION_SUFFIXES = {".gz": "gzip", ".tgz": "gzip", ".bz2": "bz2", ".tbz2": "bz2",
+                         ".xz": "xz", ".txz": "xz", ".zst": "zstd", ".tzst": "zstd"}
+# Сколько байт за раз save копирует из исходного архива
+_COPY_CHUNK = 1024 * 1024
+# Смещения в архиве слоя i оверлея сдвинуты на i << _LAYER_SHIFT
+_LAYER_SHIFT = 48
+# Удаление записи нижнего слоя обозначается в верхнем файлом .wh.<имя>, скрытие всего каталога — .wh..wh..opq
+_WHITEOUT_PREFIX = ".wh."
+_OPAQUE_WHITEOUT = ".wh..wh..opq"
+# Сколько байт с начала и с конца архива входит в контрольную сумму
+_CHECKSUM_SPAN = 64 * 1024
+# Размер куска, которым отдаётся содержимое файлов
+CHUNK_SIZE = 64 * 1024
+# Сколько разобранных путей хранит кэш VirtualFileSystem
+RESOLVE_CACHE_SIZE = 4096
+# Сколько строк длинного вывода (например, tree) GUI добавляет за один проход цикла событий
+OUTPUT_CHUNK_LINES = 200
+# Через сколько миллисекунд накопленный вывод попадает в окно (примерно один кадр)
+OUTPUT_FRAME_MS = 16
+# Сколько строк истории терминала хранится по умолчанию
+DEFAULT_SCROLLBACK = 5000
+# Как часто (мс) окно забирает результаты из фонового потока и сколько порций вывода может ждать в очереди
+POLL_MS = 20
+RESULT_QUEUE_SIZE = 64
+SPINNER = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"
+# Сколько строк выводит profile
+PROFILE_LINES = 20
+# Сколько вариантов дополнения по Tab показывается
+COMPLETION_LIMIT = 100
+
+
+class _CommandStats:
+    """Счётчики одной команды: число выполнений, ошибки, суммарное и наибольшее время, гистограмма задержек."""
+    __slots__ = ("count", "errors", "total", "max", "histogram")
+
+    def __init__(self):
+        self.count = self.errors = 0
+        self.total = self.max = 0.0
+        self.histogram = [0] * (len(Metrics.BUCKETS) + 1)  # последняя корзина — всё, что дольше верхней границы
+
+    def quantile(self, q):
+        # Верхняя граница корзины, в которую попадает квантиль q
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(Metrics.BUCKETS, self.histogram):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Метрики производительности: для каждой команды — число выполнений, ошибки и гистограмма
+    задержек с логарифмическими корзинами, а также суммарная длительность этапов загрузки архива.
+    Запись выполнения — O(1) и не выделяет память, поэтому метрики собираются всегда.
+    """
+    # Верхние границы корзин гистограммы, секунды: 10 мкс, 20 мкс, 40 мкс, ... около 84 с
+    BUCKETS = tuple(1e-5 * 2 ** i for i in range(24))
+
+    def __init__(self):
+        self.commands = {}  # имя команды -> _CommandStats
+        self.phases = {}    # этап загрузки -> секунды
+
+    def record(self, name, seconds, failed=False):
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = _CommandStats()
+        stats.count += 1
+        stats.errors += failed
+        stats.total += seconds
+        stats.max = max(stats.max, seconds)
+        stats.histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started)
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        commands = {}
+        for name, stats in sorted(self.commands.items()):
+            commands[name] = {
+                "count": stats.count,
+                "errors": stats.errors,
+                "total_seconds": stats.total,
+                "max_seconds": stats.max,
+                "p50_seconds": stats.quantile(0.5),
+                "p90_seconds": stats.quantile(0.9),
+                "p99_seconds": stats.quantile(0.99),
+                # Только непустые корзины: верхняя граница (или "inf") -> число выполнений
+                "histogram": {("inf" if i == len(self.BUCKETS) else f"{self.BUCKETS[i]:.6g}"): count
+                              for i, count in enumerate(stats.histogram) if count},
+            }
+        return {"commands": commands, "load_phases": dict(self.phases)}
+
+
+def _resident_memory():
+    """Резидентная память процесса в байтах (где нет /proc — пиковая) или None, если её не узнать."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def stats_report(vfs):
+    """Все метрики одним словарём: команды, этапы загрузки, дерево и память процесса."""
+    report = vfs.metrics.as_dict()
+    report["tree"] = vfs.tree_stats()
+    report["resident_bytes"] = _resident_memory()
+    return report
+
+
+def _format_stats(report):
+    """Текстовый вывод команды stats."""
+    def ms(seconds):
+        return f"{seconds * 1000:.3f} мс"
+
+    lines = ["Команды:"]
+    for name, item in report["commands"].items():
+        lines.append(f"  {name}: {item['count']} (ошибок {item['errors']}), "
+                     f"среднее {ms(item['total_seconds'] / item['count'])}, p50 ≤ {ms(item['p50_seconds'])}, "
+                     f"p90 ≤ {ms(item['p90_seconds'])}, p99 ≤ {ms(item['p99_seconds'])}, "
+                     f"макс {ms(item['max_seconds'])}")
+    lines.append("Загрузка:")
+    lines.extend(f"  {name}: {ms(seconds)}" for name, seconds in report["load_phases"].items())
+    lines.append("Дерево:")
+    lines.extend(f"  {name}: {'—' if value is None else value}" for name, value in report["tree"].items())
+    resident = report["resident_bytes"]
+    lines.append(f"Память процесса: {'—' if resident is None else f'{resident / (1024 * 1024):.1f} МБ'}")
+    return "\n".join(lines)
+
+
+def write_stats(vfs, path):
+    """Записывает метрики в JSON-файл path."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(stats_report(vfs), f, ensure_ascii=False, indent=2)
+
+
+class CommandCancelled(Exception):
+    """Команда прервана пользователем (Ctrl+C)."""
+
+    def __init__(self, message="Команда прервана"):
+        super().__init__(message)
+
+
+def _iter_tar(tar_path, data=None):
+    """
+    Потоково перебирает заголовки tar-архива.
+    В отличие от getmembers(), прочитанные TarInfo не накапливаются в памяти:
+    в каждый момент времени жив только текущий заголовок.
+    Сжатый архив читается через _CompressedData (её можно передать в data), поэтому
+    чтение заголовков заодно расставляет контрольные точки распаковки.
+    """
+    if data is None and _compression(tar_path) is not None:
+        data = _CompressedData(tar_path)
+    if data is None:
+        tar = tarfile.open(tar_path, "r")
+    else:
+        tar = tarfile.open(fileobj=_DataStream(data), mode="r:")
+    with tar:
+        while True:
+            member = tar.next()
+            if member is None:
+                break
+            # TarFile запоминает каждый прочитанный заголовок в tar.members — не даём списку расти
+            tar.members = []
+            yield member
+
+
+class _File:
+    """
+    Узел обычного файла: смещение его данных в архиве, их размер, время изменения и права доступа.
+    header — смещение заголовка записи в архиве, по нему save копирует запись как есть.
+    """
+    __slots__ = ("offset", "size", "mtime", "mode", "header")
+
+    def __init__(self, offset=None, size=0, mtime=0, mode=0o644, header=None):
+        self.offset = offset  # None — у файла нет данных в архиве (например, создан через touch)
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.header = header
+
+
+# Эпоха каталога, который cp сделал общим для двух мест дерева; не совпадает ни с одной эпохой дерева
+_SHARED_EPOCH = -1
+
+
+class _Dir(dict):
+    """
+    Узел каталога: словарь «имя -> узел».
+    Пока pending не None, каталог ещё не развёрнут: его записи лежат в компактном
+    наборе пар (имя, узел) и переносятся в словарь при первом обращении.
+    epoch — эпоха дерева, в которой узел создан. Менять на месте можно только узлы
+    текущей эпохи, узлы прошлых эпох могут быть общими для нескольких мест дерева.
+    Скопированный cp каталог получает эпоху _SHARED_EPOCH: он общий, хотя дерево не заморожено.
+    size и count — суммарный размер файлов и число записей во всём поддереве каталога;
+    они поддерживаются при каждом изменении дерева, поэтому du не обходит поддерево.
+    names — отсортированный список имён для ls и дополнения по Tab; строится при первом
+    обращении и дальше поддерживается insert, remove и remove_all, None — ещё не построен.
+    """
+    __slots__ = ("pending", "epoch", "size", "count", "mtime", "mode", "header", "names")
+
+    def __init__(self, *args, epoch=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = None
+        self.epoch = epoch
+        self.size = 0
+        self.count = 0
+        self.mtime = 0
+        self.mode = 0o755
+        self.header = None  # каталоги, которых нет в архиве явно, заголовка не имеют
+        self.names = None
+
+    def insert(self, name, node):
+        # Новая запись; отсортированный список имён, если он уже построен, обновляется за O(log n) сравнений
+        self[name] = node
+        if self.names is not None:
+            bisect.insort(self.names, name)
+
+    def remove(self, name):
+        del self[name]
+        if self.names is not None:
+            del self.names[bisect.bisect_left(self.names, name)]
+
+    def remove_all(self, names):
+        # Большую пачку дешевле убрать из списка имён одним проходом, чем сдвигать список на каждое имя
+        if self.names is None or len(names) < 64:
+            for name in names:
+                self.remove(name)
+            return
+        for name in names:
+            del self[name]
+        removed = set(names)
+        self.names = [name for name in self.names if name not in removed]
+
+
+def _split_path(cwd, path):
+    """
+    Нормализует путь относительно текущей директории cwd: учитывает корень, "." и "..".
+    Возвращает абсолютный путь в виде кортежа имён.
+    """
+    parts = [] if path.startswith("/") else [part for part in cwd.split("/") if part]
+    for part in path.split("/"):
+        if part == "..":
+            if parts:
+                parts.pop()
+        elif part and part != ".":
+            parts.append(part)
+    return tuple(parts)
+
+
+def _join_path(parts):
+    return "/" + "/".join(parts)
+
+
+def _has_wildcards(name):
+    return any(char in name for char in "*?[")
+
+
+def _glob_matcher(pattern):
+    """Проверка имени по шаблону одного уровня пути; как в оболочке, имена на «.» подходят только шаблонам на «.»."""
+    matches = re.compile(fnmatch.translate(pattern)).match
+    hidden = pattern.startswith(".")
+    return lambda name: matches(name) is not None and (hidden or not name.startswith("."))
+
+
+def _prefix_range(names, prefix):
+    """Границы [start, stop) имён, начинающихся с prefix, в отсортированном списке names."""
+    start = bisect.bisect_left(names, prefix)
+    # Имена с этим началом идут подряд: до первого имени, большего любого продолжения prefix
+    stop = bisect.bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1), start) if prefix else len(names)
+    return start, stop
+
+
+def _inside(parts, selected):
+    # Лежит ли путь внутри одного из путей selected
+    return any(parts[:depth] in selected for depth in range(1, len(parts)))
+
+
+def _check_batch(sources, dest_parts, cwd, taken, move):
+    """
+    Проверки пачки cp/mv до первого изменения дерева. sources — пути источников (кортежи имён),
+    taken(name) — есть ли уже такое имя в каталоге назначения.
+    """
+    selected = set(sources)
+    names = set()
+    for parts in sources:
+        # Проверяем, что назначение не находится внутри источника
+        if dest_parts[:len(parts)] == parts:
+            raise ValueError("Cannot copy an object to itself.")
+        if move:
+            # Нельзя перемещать каталог, в котором (или внутри которого) находится текущая директория
+            if cwd[:len(parts)] == parts:
+                raise ValueError("Cannot move a directory that contains the current working directory.")
+            if _inside(parts, selected):
+                raise ValueError(f"Cannot move {_join_path(parts)} together with a directory that contains it.")
+        # В целевой директории и среди самих источников не должно быть одинаковых имён
+        if parts[-1] in names or taken(parts[-1]):
+            raise FileExistsError(f"Destination already contains an object named {parts[-1]}.")
+        names.add(parts[-1])
+
+
+def _check_removal(sources, cwd, recursive, is_dir):
+    """Проверки пачки rm до первого изменения дерева. Возвращает пути без вложенных в другие удаляемые каталоги."""
+    for parts in sources:
+        if not parts:
+            raise ValueError("Cannot remove the root directory.")
+        if not recursive and is_dir(parts):
+            raise IsADirectoryError(f"{_join_path(parts)} is a directory.")
+        if cwd[:len(parts)] == parts:
+            raise ValueError("Cannot remove a directory that contains the current working directory.")
+    selected = set(sources)
+    return [parts for parts in sources if not _inside(parts, selected)]
+
+
+def _format_stat(parts, is_dir, size, count, mode, mtime):
+    """Вывод stat: путь, тип, размер (для каталога — всего поддерева), число записей, права и время изменения."""
+    lines = [f"  File: {_join_path(parts)}",
+             f"  Type: {'directory' if is_dir else 'regular file'}",
+             f"  Size: {size}"]
+    if is_dir:
+        lines.append(f"Entries: {count}")
+    file_type = stat.S_IFDIR if is_dir else stat.S_IFREG
+    lines.append(f"  Mode: {stat.filemode(file_type | mode)} ({stat.S_IMODE(mode):04o})")
+    lines.append(f"Modify: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime))}")
+    return "\n".join(lines)
+
+
+def _archive_key(tar_path):
+    """
+    Ключ, по которому индекс сверяется с архивом: размер, время изменения
+    и контрольная сумма начала и конца файла, где лежат первые и последние заголовки.
+    """
+    stat = os.stat(tar_path)
+    with open(tar_path, "rb") as f:
+        checksum = zlib.crc32(f.read(_CHECKSUM_SPAN))
+        if stat.st_size > _CHECKSUM_SPAN:
+            f.seek(max(_CHECKSUM_SPAN, stat.st_size - _CHECKSUM_SPAN))
+            checksum = zlib.crc32(f.read(), checksum)
+    return stat.st_size, stat.st_mtime_ns, checksum
+
+
+def _compression(tar_path):
+    """Вид сжатия архива по его сигнатуре: "gzip", "bz2", "xz", "zstd" или None для несжатого."""
+    with open(tar_path, "rb") as f:
+        magic = f.read(8)
+    for signature, name in _COMPRESSION_MAGIC:
+        if magic.startswith(signature):
+            return name
+    return None
+
+
+class _ZStream(ctypes.Structure):
+    # struct z_stream_s из zlib.h
+    _fields_ = [("next_in", ctypes.c_void_p), ("avail_in", ctypes.c_uint), ("total_in", ctypes.c_ulong),
+                ("next_out", ctypes.c_void_p), ("avail_out", ctypes.c_uint), ("total_out", ctypes.c_ulong),
+                ("msg", ctypes.c_char_p), ("state", ctypes.c_void_p),
+                ("zalloc", ctypes.c_void_p), ("zfree", ctypes.c_void_p), ("opaque", ctypes.c_void_p),
+                ("data_type", ctypes.c_int), ("adler", ctypes.c_ulong), ("reserved", ctypes.c_ulong)]
+
+
+def _load_libz():
+    """
+    Системная библиотека zlib через ctypes или None. Модуль zlib не умеет останавливаться на границах
+    блоков deflate и начинать распаковку с них, а без этого контрольные точки gzip нельзя сохранить в файл.
+    """
+    name = ctypes.util.find_library("z")
+    if name is None:
+        return None  # так обычно на Windows: zlib вшит в Python
+    try:
+        libz = ctypes.CDLL(name)
+        libz.inflateGetDictionary  # есть с zlib 1.2.8
+    except (OSError, AttributeError):
+        return None
+    libz.zlibVersion.restype = ctypes.c_char_p
+    return libz
+
+
+_libz = _load_libz()
+
+
+class _Inflater:
+    """
+    Распаковщик одного члена gzip на системной zlib с интерфейсом zlib.decompressobj (decompress, eof,
+    unused_data). Распаковка идёт с остановкой на каждой границе блоков deflate, как в zran.c из примеров
+    zlib: на границе, отстоящей от прошлой точки списка points хотя бы на CHECKPOINT_SPAN несжатых байт,
+    в points добавляется (несжатое смещение, сжатое смещение, число неиспользованных бит, сжатое окно).
+    С такой точки распаковку можно начать заново (window, bits и byte) — в том числе в следующем запуске.
+    """
+
+    def __init__(self, position, compressed, points, window=None, bits=0, byte=0):
+        self.position = position      # несжатое и сжатое смещения, с которых начата распаковка
+        self.compressed = compressed
+        self.points = points
+        self.eof = False
+        self.unused_data = b""
+        self._raw = window is not None  # с точки внутри члена идёт поток deflate без заголовка gzip
+        self._trailer = 0               # сколько байт конца члена осталось пропустить
+        self._stream = _ZStream()
+        self._end = _libz.inflateEnd
+        self._output = ctypes.create_string_buffer(_INFLATE_OUTPUT)
+        stream = ctypes.byref(self._stream)
+        self._check(_libz.inflateInit2_(stream, -15 if self._raw else 31, _libz.zlibVersion(),
+                                        ctypes.sizeof(_ZStream)))
+        if self._raw:
+            if bits:
+                self._check(_libz.inflatePrime(stream, bits, byte >> (8 - bits)))
+            self._check(_libz.inflateSetDictionary(stream, window, len(window)))
+
+    def __del__(self):
+        self._end(ctypes.byref(self._stream))
+
+    def _check(self, result):
+        if result < 0 and result != _Z_BUF_ERROR:
+            message = self._stream.msg.decode() if self._stream.msg else f"error {result}"
+            raise zlib.error(f"Error while decompressing data: {message}")
+        return result
+
+    def decompress(self, data):
+        if self._trailer:
+            return self._skip_trailer(data)
+        stream = self._stream
+        source = ctypes.create_string_buffer(data, len(data))
+        stream.next_in = ctypes.addressof(source)
+        stream.avail_in = len(data)
+        parts = []
+        while True:
+            stream.next_out = ctypes.addressof(self._output)
+            stream.avail_out = _INFLATE_OUTPUT
+            result = self._check(_libz.inflate(ctypes.byref(stream), _Z_BLOCK))
+            parts.append(ctypes.string_at(self._output, _INFLATE_OUTPUT - stream.avail_out))
+            if result == _Z_STREAM_END:
+                rest = data[len(data) - stream.avail_in:]
+                if self._raw:
+                    self._trailer = _GZIP_TRAILER
+                    self._skip_trailer(rest)
+                else:
+                    self.eof, self.unused_data = True, rest
+                break
+            # Бит 128 — остановка после конца блока, бит 64 — блок последний (после него точка не нужна)
+            if stream.data_type & 128 and not stream.data_type & 64:
+                self._boundary()
+            if result == _Z_BUF_ERROR or (not stream.avail_in and stream.avail_out):
+                break
+        return b"".join(parts)
+
+    def _skip_trailer(self, data):
+        skipped = min(self._trailer, len(data))
+        self._trailer -= skipped
+        if not self._trailer:
+            self.eof, self.unused_data = True, data[skipped:]
+        return b""
+
+    def _boundary(self):
+        stream = self._stream
+        position = self.position + stream.total_out
+        if not stream.total_out or position < (self.points[-1][0] if self.points else 0) + CHECKPOINT_SPAN:
+            return
+        window = ctypes.create_string_buffer(_DEFLATE_WINDOW)
+        length = ctypes.c_uint()
+        self._check(_libz.inflateGetDictionary(ctypes.byref(stream), window, ctypes.byref(length)))
+        self.points.append((position, self.compressed + stream.total_in, stream.data_type & 7,
+                            zlib.compress(window.raw[:length.value])))
+
+
+def _decompressor(compression):
+    # Распаковщик одного члена gzip, потока bzip2/xz или кадра zstd
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if compression == "bz2":
+        return bz2.BZ2Decompressor()
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    if zstandard is None:
+        raise RuntimeError("Reading .tar.zst archives requires the zstandard package.")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _open_data(tar_path):
+    """
+    Содержимое архива с доступом по смещениям: mmap несжатого архива, _CompressedData сжатого
+    или _LayeredData для списка архивов-слоёв.
+    """
+    if isinstance(tar_path, (list, tuple)):
+        return _LayeredData(tar_path)
+    if _compression(tar_path) is not None:
+        return _CompressedData(tar_path)
+    with open(tar_path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _CompressedData:
+    """
+    Несжатое содержимое сжатого архива (gzip, bzip2, xz, zstd) с доступом по смещениям:
+    срезы, find и rfind работают так же, как у mmap несжатого архива.
+    Распаковка начинается с ближайшей точки перед нужным смещением, а не с начала архива:
+    - начала членов gzip, потоков bzip2 и xz и кадров zstd (не чаще чем через CHECKPOINT_SPAN байт).
+      С такой точки распаковку можно начать заново, поэтому после первого полного прохода
+      они сохраняются рядом с архивом и используются при следующих запусках;
+    - у gzip — ещё и точки внутри членов через каждые CHECKPOINT_SPAN байт несжатых данных.
+      С системной zlib это границы блоков deflate с окном (см. _Inflater); они сохраняются вместе
+      с началами членов. Без неё — копии состояния zlib.decompressobj, которые живут только в памяти.
+      Те и другие появляются по мере распаковки — в том числе при чтении заголовков архива.
+    """
 
-class VirtualFileSystem:
     def __init__(self, tar_path):
-        self.filesystem = {}
+        self.path = tar_path
+        self.compression = _compression(tar_path)
+        self._file = open(tar_path, "rb")
+        self._key = list(_archive_key(tar_path))
+        self._points = [(0, 0)]  # (несжатое смещение, сжатое смещение) — начала членов, потоков и кадров
+        # Точки внутри членов gzip: (несжатое смещение, сжатое смещение, бит, окно) у _Inflater
+        # или (несжатое смещение, сжатое смещение, копия zlib.decompressobj) без системной zlib
+        self._states = []
+        self._complete = self._load_points()
+        self._start(0, 0, self._member_decoder(0, 0))
+
+    def _load_points(self):
+        try:
+            with open(self.path + CHECKPOINTS_SUFFIX, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(saved, dict) or saved.get("archive") != self._key or "windows" not in saved:
+            return False
+        self._points = [tuple(point) for point in saved["points"]]
+        if _libz is not None:
+            self._states = [(position, compressed, bits, base64.b64decode(window))
+                            for position, compressed, bits, window in saved["windows"]]
+        return True
+
+    def _save_points(self):
+        points_path = self.path + CHECKPOINTS_SUFFIX
+        tmp_path = points_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                windows = [[state[0], state[1], state[2], base64.b64encode(state[3]).decode("ascii")]
+                           for state in self._states if len(state) == 4]
+                json.dump({"archive": self._key, "points": self._points, "windows": windows}, f)
+            os.replace(tmp_path, points_path)
+        except OSError:
+            # Как и индекс архива, точки — только ускорение
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def close(self):
+        self._file.close()
+
+    def _start(self, position, compressed, decoder):
+        # Распаковщик decoder продолжит с сжатого смещения compressed, которому соответствует несжатое position
+        self._decoder = decoder
+        self._compressed = compressed
+        self._buffer = b""
+        self._buffer_start = position
+
+    def _seek(self, offset):
+        # Готовит распаковку так, чтобы offset был в буфере или впереди него
+        buffer_end = self._buffer_start + len(self._buffer)
+        if self._buffer_start <= offset <= buffer_end:
+            return
+        point = self._points[bisect.bisect_right(self._points, (offset, float("inf"))) - 1]
+        index = bisect.bisect_right(self._states, offset, key=lambda state: state[0]) - 1
+        state = self._states[index] if index >= 0 else None
+        best = max(point[0], state[0] if state else 0)
+        # Вперёд от текущего места распаковывать не дальше, чем от ближайшей точки
+        if buffer_end <= offset and buffer_end >= best:
+            return
+        if state is not None and state[0] >= point[0]:
+            self._start(state[0], state[1], self._resume(state))
+        else:
+            self._start(point[0], point[1], self._member_decoder(point[0], point[1]))
+
+    def _member_decoder(self, position, compressed):
+        # Распаковщик члена (потока, кадра), который начинается с несжатого position и сжатого compressed
+        if self.compression == "gzip" and _libz is not None:
+            return _Inflater(position, compressed, self._states)
+        return _decompressor(self.compression)
+
+    def _resume(self, state):
+        # Распаковщик с точки внутри члена gzip
+        if len(state) == 3:
+            return state[2].copy()
+        position, compressed, bits, window = state
+        # Граница блока может быть внутри байта: его старшие bits бит zlib получает отдельно
+        byte = os.pread(self._file.fileno(), 1, compressed - 1)[0] if bits else 0
+        return _Inflater(position, compressed, self._states, zlib.decompress(window), bits, byte)
+
+    def _step(self):
+        # Распаковывает следующий кусок в буфер. Возвращает False, когда данные кончились
+        self._buffer_start += len(self._buffer)
+        self._buffer = b""
+        if self._decoder is None:
+            return False
+        chunk = os.pread(self._file.fileno(), _COMPRESSED_CHUNK, self._compressed)
+        if not chunk:
+            raise EOFError("Compressed archive ended before the end of the stream.")
+        self._buffer = self._decoder.decompress(chunk)
+        position = self._buffer_start + len(self._buffer)
+        if not self._decoder.eof:
+            self._compressed += len(chunk)
+            if (self.compression == "gzip" and not isinstance(self._decoder, _Inflater)
+                    and position >= (self._states[-1][0] if self._states else 0) + CHECKPOINT_SPAN):
+                self._states.append((position, self._compressed, self._decoder.copy()))
+            return True
+        self._compressed = self._next_member(self._compressed + len(chunk) - len(self._decoder.unused_data))
+        if self._compressed is None:
+            self._decoder = None
+            if not self._complete:
+                self._complete = True
+                self._save_points()
+        else:
+            self._decoder = self._member_decoder(position, self._compressed)
+            if position >= self._points[-1][0] + CHECKPOINT_SPAN:
+                self._points.append((position, self._compressed))
+        return True
+
+    def _next_member(self, compressed):
+        # Начало следующего члена (потока, кадра) или None в конце файла; нули между потоками пропускаются
+        while True:
+            chunk = os.pread(self._file.fileno(), _COMPRESSED_CHUNK, compressed)
+            if not chunk:
+                return None
+            stripped = chunk.lstrip(b"\0")
+            compressed += len(chunk) - len(stripped)
+            if stripped:
+                return compressed
+
+    def __getitem__(self, key):
+        start, end = key.start, key.stop
+        if end <= start:
+            return b""
+        self._seek(start)
+        parts = []
+        pos = start
+        while pos < end:
+            if self._buffer_start <= pos < self._buffer_start + len(self._buffer):
+                piece = self._buffer[pos - self._buffer_start:end - self._buffer_start]
+                parts.append(piece)
+                pos += len(piece)
+            elif not self._step():
+                break
+        return b"".join(parts)
+
+    def find(self, sub, start, end):
+        pos = start
+        while pos < end:
+            chunk = self[pos:min(pos + CHUNK_SIZE, end)]
+            found = chunk.find(sub)
+            if found != -1:
+                return pos + found
+            if len(chunk) < len(sub):
+                break
+            pos += len(chunk) - len(sub) + 1
+        return -1
+
+    def rfind(self, sub, start, end):
+        pos = end
+        while pos > start:
+            low = max(start, pos - CHUNK_SIZE)
+            found = self[low:min(end, pos + len(sub) - 1)].rfind(sub)
+            if found != -1:
+                return low + found
+            pos = low
+        return -1
+
+
+class _DataStream:
+    """Файловый интерфейс (read, seek, tell) над содержимым архива — для tarfile."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def seek(self, position, whence=os.SEEK_SET):
+        self.position = position if whence == os.SEEK_SET else self.position + position
+
+    def tell(self):
+        return self.position
+
+
+class _LayeredData:
+    """
+    Содержимое архивов-слоёв оверлея как одно пространство смещений: смещения в слое i
+    сдвинуты на i << _LAYER_SHIFT. Поэтому узлы дерева хранят обычные целые смещения,
+    а чтение файлов и save не различают, из какого слоя запись. Слои открываются при первом чтении.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.layers = [None] * len(self.paths)
+
+    def _layer(self, offset):
+        layer = offset >> _LAYER_SHIFT
+        if self.layers[layer] is None:
+            self.layers[layer] = _open_data(self.paths[layer])
+        return self.layers[layer], layer << _LAYER_SHIFT
+
+    def __getitem__(self, key):
+        data, base = self._layer(key.start)
+        return data[key.start - base:key.stop - base]
+
+    def find(self, sub, start, end):
+        data, base = self._layer(start)
+        found = data.find(sub, start - base, end - base)
+        return found if found == -1 else found + base
+
+    def rfind(self, sub, start, end):
+        data, base = self._layer(start)
+        found = data.rfind(sub, start - base, end - base)
+        return found if found == -1 else found + base
+
+    def close(self):
+        for data in self.layers:
+            if data is not None:
+                data.close()
+
+
+def _overlay(nodes):
+    """
+    Собирает каталог оверлея из одноимённых каталогов слоёв nodes (сверху вниз).
+    Запись верхнего слоя закрывает одноимённую запись нижних; каталоги, которые есть в нескольких
+    слоях, объединяются тем же способом. Файл .wh.<имя> скрывает <имя> в нижних слоях, .wh..wh..opq —
+    всё содержимое каталога в нижних слоях. Каталоги, которые есть только в одном слое,
+    остаются отложенными, поэтому объединение разворачивает только общую часть деревьев.
+    """
+    # Обход без рекурсии: стек из (объединённый каталог, итератор по группам его записей);
+    # итоги каталога считаются, когда объединены все его подкаталоги
+    root, groups = _overlay_level(nodes)
+    stack = [(root, iter(groups.items()))]
+    while stack:
+        merged, groups = stack[-1]
+        for name, group in groups:
+            if len(group) > 1:
+                child, child_groups = _overlay_level(group)
+                merged.pending.append((name, child))
+                stack.append((child, iter(child_groups.items())))
+                break
+            merged.pending.append((name, group[0]))
+        else:
+            stack.pop()
+            for _, child in merged.pending:
+                merged.size += child.size
+                merged.count += 1 + (child.count if isinstance(child, dict) else 0)
+    return root
+
+
+def _overlay_level(nodes):
+    # Каталог оверлея без записей и группы одноимённых записей слоёв nodes, из которых он составится
+    merged = _Dir()
+    merged.mtime, merged.mode, merged.header = nodes[0].mtime, nodes[0].mode, nodes[0].header
+    groups = {}
+    hidden = set()
+    for node in nodes:
+        entries = list(node.pending if node.pending is not None else node.items())
+        opaque = False
+        whiteouts = set()
+        for name, child in entries:
+            if name.startswith(_WHITEOUT_PREFIX):
+                if name == _OPAQUE_WHITEOUT:
+                    opaque = True
+                else:
+                    whiteouts.add(name[len(_WHITEOUT_PREFIX):])
+            elif name not in hidden:
+                group = groups.get(name)
+                if group is None:
+                    groups[name] = [child]
+                elif isinstance(group[0], dict) and isinstance(child, dict):
+                    group.append(child)
+        hidden |= whiteouts
+        if opaque:
+            break
+    merged.pending = []
+    return merged, groups
+
+
+class _IndexRange:
+    """Отложенное содержимое каталога: диапазон записей в отображённом в память индексе."""
+    __slots__ = ("index", "first", "count")
+
+    def __init__(self, index, first, count):
+        self.index = index
+        self.first = first
+        self.count = count
+
+    def __iter__(self):
+        return self.index.children(self.first, self.count)
+
+
+class _TarIndex:
+    """
+    Индекс архива, отображённый в память.
+    Записи читаются прямо из mmap, узлы создаются только для разворачиваемых каталогов.
+    """
+
+    def __init__(self, buf, count, base=0):
+        self.buf = buf
+        self.names_offset = _INDEX_HEADER.size + count * _INDEX_ENTRY.size
+        self.base = base  # сдвиг смещений в архиве — у слоёв оверлея свои диапазоны смещений
+
+    @classmethod
+    def load(cls, index_path, key, base=0):
+        """Отображает индекс в память и возвращает корневой каталог или None, если индекс непригоден."""
+        try:
+            with open(index_path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        return cls.from_buffer(buf, key, base)
+
+    @classmethod
+    def from_buffer(cls, buf, key, base=0):
+        """Корневой каталог индекса, лежащего в buf (mmap или bytes), или None, если индекс непригоден."""
+        if len(buf) < _INDEX_HEADER.size:
+            return None
+        magic, version, size, mtime_ns, checksum, count = _INDEX_HEADER.unpack_from(buf)
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION or (size, mtime_ns, checksum) != key:
+            return None
+        index = cls(buf, count, base)
+        _, _, _, first, child_count, mtime, mode, size, total, _ = _INDEX_ENTRY.unpack_from(buf, _INDEX_HEADER.size)
+        root = _Dir()
+        root.pending = _IndexRange(index, first, child_count)
+        root.mtime, root.mode, root.size, root.count = mtime, mode, size, total
+        return root
+
+    def _records(self, first, count):
+        # Записи диапазона: (вид, имя, a, b, время, права, размер, число записей, заголовок);
+        # у каталога a и b — диапазон его записей
+        buf = self.buf
+        offset = _INDEX_HEADER.size + first * _INDEX_ENTRY.size
+        for _ in range(count):
+            kind, name_len, name_offset, *fields = _INDEX_ENTRY.unpack_from(buf, offset)
+            offset += _INDEX_ENTRY.size
+            start = self.names_offset + name_offset
+            yield (kind, buf[start:start + name_len].decode("utf-8", "surrogateescape"), *fields)
+
+    def children(self, first, count):
+        base = self.base
+        for kind, name, a, b, mtime, mode, size, total, header in self._records(first, count):
+            header = None if header < 0 else header + base
+            if kind == _KIND_DIR:
+                node = _Dir()
+                node.pending = _IndexRange(self, a, b)
+                node.mtime, node.mode, node.size, node.count, node.header = mtime, mode, size, total, header
+            else:
+                node = _File(None if a == _NO_DATA else a + base, b, mtime, mode, header)
+            yield name, node
+
+    def walk(self):
+        """Все записи индекса парами (путь каталога, имя) — без создания узлов дерева."""
+        _, _, _, first, count, *_ = _INDEX_ENTRY.unpack_from(self.buf, _INDEX_HEADER.size)
+        queue = deque([((), first, count)])
+        while queue:
+            parts, first, count = queue.popleft()
+            for kind, name, a, b, *_ in self._records(first, count):
+                yield parts, name
+                if kind == _KIND_DIR:
+                    queue.append((parts + (name,), a, b))
+
+    @staticmethod
+    def write(index_path, key, root):
+        """Сохраняет дерево в индекс рядом с архивом."""
+        _TarIndex.store(index_path, _TarIndex.pack(key, root))
+
+    @staticmethod
+    def pack(key, root):
+        """
+        Собирает индекс дерева в bytes. Каталоги обходятся в ширину, поэтому записи
+        каждого каталога лежат подряд и описываются парой «первая запись, количество».
+        """
+        entries = bytearray(_INDEX_ENTRY.size)  # запись корня заполняется при его обходе
+        names = bytearray()
+        queue = deque([(0, root)])
+        while queue:
+            position, node = queue.popleft()
+            children = dict(node.pending) if node.pending is not None else node
+            first = len(entries) // _INDEX_ENTRY.size
+            _, name_len, name_offset, *_ = _INDEX_ENTRY.unpack_from(entries, position * _INDEX_ENTRY.size)
+            _INDEX_ENTRY.pack_into(entries, position * _INDEX_ENTRY.size, _KIND_DIR, name_len, name_offset,
+                                   first, len(children), node.mtime, node.mode, node.size, node.count,
+                                   -1 if node.header is None else node.header)
+            for name, child in children.items():
+                encoded = name.encode("utf-8", "surrogateescape")
+                if isinstance(child, dict):
+                    queue.append((len(entries) // _INDEX_ENTRY.size, child))
+                    record = (_KIND_DIR, len(encoded), len(names), 0, 0, 0, 0, 0, 0, -1)
+                else:
+                    record = (_KIND_FILE, len(encoded), len(names), _NO_DATA if child.offset is None else child.offset,
+                              child.size, child.mtime, child.mode, child.size, 0,
+                              -1 if child.header is None else child.header)
+                entries += _INDEX_ENTRY.pack(*record)
+                names += encoded
+
+        header = _INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, *key, len(entries) // _INDEX_ENTRY.size)
+        return b"".join((header, entries, names))
+
+    @staticmethod
+    def store(index_path, buf):
+        tmp_path = index_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(buf)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            # Индекс — только ускорение: если рядом с архивом писать нельзя, работаем без него
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+class _Journal:
+    """
+    Журнал изменений дерева: файл рядом с архивом, в который только дописываются строки JSON —
+    по одной на выполненную команду, с абсолютными путями. Первая строка — ключ архива:
+    журнал, записанный для другой версии архива, не применяется и при первой записи начинается заново.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = list(key)
+        self._valid = None  # совпадает ли ключ в существующем файле журнала; None — ещё не проверяли
+
+    def entries(self):
+        """Записанные команды в виде списков [имя команды, аргументы...]."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                lines = iter(f)
+                try:
+                    self._valid = json.loads(next(lines)) == {"archive": self.key}
+                except (StopIteration, ValueError):
+                    self._valid = False
+                if not self._valid:
+                    return []
+                entries = []
+                for line in lines:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break  # строка, недописанная при аварийном завершении, и всё после неё
+                return entries
+        except FileNotFoundError:
+            self._valid = False
+            return []
+
+    def append(self, *entry):
+        self.extend([entry])
+
+    def extend(self, entries):
+        # Все записи пишутся одним вызовом write: пачка изменений транзакции попадает в журнал целиком
+        if self._valid is None:
+            self.entries()
+        lines = [] if self._valid else [json.dumps({"archive": self.key})]
+        lines.extend(json.dumps(entry, ensure_ascii=False) for entry in entries)
+        with open(self.path, "a" if self._valid else "w", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for line in lines))
+        self._valid = True
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self._valid = False
+
+
+def _member_header(tar, data, header):
+    """
+    Возвращает (путь записи кортежем имён, конец её заголовков) для записи исходного архива,
+    заголовок которой начинается со смещения header. Обычный заголовок разбирается прямо
+    в отображённом архиве; записи с длинными именами и PAX-заголовками разбирает tarfile.
+    """
+    block = data[header:header + tarfile.BLOCKSIZE]
+    if block[156:157] in (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK, tarfile.XHDTYPE, tarfile.XGLTYPE):
+        info = _read_member(tar, header)
+        return tuple(part for part in info.name.split("/") if part and part != "."), info.offset_data
+    name = block[:100].split(b"\0", 1)[0]
+    prefix = block[345:500].split(b"\0", 1)[0]
+    # Как и tarfile, склеиваем префикс ustar с именем у всех записей, кроме особых типов GNU
+    if prefix and block[156:157] not in tarfile.GNU_TYPES:
+        name = prefix + b"/" + name
+    name = name.decode(tarfile.ENCODING, "surrogateescape")
+    return tuple(part for part in name.split("/") if part and part != "."), header + tarfile.BLOCKSIZE
+
+
+def _read_member(tar, header):
+    # Разбирает заголовки одной записи архива средствами tarfile, начиная со смещения header
+    tar.fileobj.seek(header)
+    tar.offset = header
+    return tarfile.TarInfo.fromtarfile(tar)
+
+
+def _write_tar(target, source, entries):
+    """
+    Записывает архив target по записям entries — кортежам
+    (путь, каталог ли, смещение заголовка в source, смещение данных, размер, время, права).
+    Запись, путь которой совпадает с её путём в исходном архиве, копируется из source
+    байт в байт вместе с заголовками; соседние такие записи копируются одним куском,
+    поэтому сохранение почти не изменённого архива — это один последовательный проход по нему.
+    Новые, перемещённые и скопированные записи получают новые заголовки, данные файлов
+    по-прежнему копируются из source без разбора.
+    Сжатие target выбирается по его расширению (.gz, .bz2, .xz, .zst), сжатый source читается
+    через _CompressedData.
+    Архив пишется во временный файл и подменяет target только целиком.
+    """
+    tmp_path = target + ".tmp"
+    compression = _COMPRESSION_SUFFIXES.get(os.path.splitext(target)[1].lower())
+    data = _open_data(source)
+    try:
+        with _open_output(tmp_path, compression) as out:
+            _write_members(out, data, entries)
+        os.replace(tmp_path, target)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    finally:
+        data.close()
+
+
+def _open_output(path, compression):
+    # Файл для записи архива со сжатием compression (None — без сжатия)
+    if compression == "gzip":
+        return gzip.open(path, "wb")
+    if compression == "bz2":
+        return bz2.open(path, "wb")
+    if compression == "xz":
+        return lzma.open(path, "wb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Writing .tar.zst archives requires the zstandard package.")
+        return zstandard.open(path, "wb")
+    return open(path, "wb")
+
+
+def _write_members(out, data, entries):
+    def pad(size):
+        return -size % tarfile.BLOCKSIZE
+
+    run_start = run_end = None
+    written = 0
+
+    def write(chunk):
+        nonlocal written
+        out.write(chunk)
+        written += len(chunk)
+
+    def copy(start, end):
+        # Копирование откладывается, пока следующая запись продолжает тот же кусок исходного архива
+        nonlocal run_start, run_end
+        if run_end != start:
+            flush()
+            run_start = start
+        run_end = end
+
+    def flush():
+        if run_start is None or run_end <= run_start:
+            return
+        if isinstance(data, mmap.mmap):
+            with memoryview(data) as view:
+                write(view[run_start:run_end])
+        else:
+            for start in range(run_start, run_end, _COPY_CHUNK):
+                write(data[start:min(start + _COPY_CHUNK, run_end)])
+
+    with tarfile.open(fileobj=_DataStream(data), mode="r:") as tar:
+        for parts, is_dir, header, offset, size, mtime, mode in entries:
+            info = None
+            if header is not None:
+                original, end = _member_header(tar, data, header)
+                if original == parts:
+                    copy(header, end + size + pad(size) if offset is not None else end)
+                    continue
+                # Запись сменила путь: берём её исходный заголовок со всеми полями и меняем только имя
+                info = _read_member(tar, header)
+                info.pax_headers = {key: value for key, value in info.pax_headers.items()
+                                    if key not in ("path", "size")}
+            if info is None:
+                info = tarfile.TarInfo()
+                info.type = tarfile.DIRTYPE if is_dir else tarfile.REGTYPE
+                info.mtime, info.mode = mtime, mode
+            info.name = "/".join(parts)
+            info.size = size if offset is not None else 0
+            flush()
+            run_start = run_end = None
+            write(info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape"))
+            if offset is not None:
+                copy(offset, offset + size + pad(size))
+        flush()
+    # Конец архива: два нулевых блока, затем дополнение до целой записи, как у tarfile
+    write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+    write(tarfile.NUL * (-written % tarfile.RECORDSIZE))
+
+
+class _Transaction:
+    """
+    Открытая транзакция: base — дерево на момент begin, head — последнее применённое дерево
+    (пока никто другой не применил изменений, это base), cwd — каталог на момент begin,
+    entries — записи журнала, которые попадут в него только при commit.
+    """
+    __slots__ = ("base", "head", "cwd", "entries")
+
+    def __init__(self, base, cwd):
+        self.base = self.head = base
+        self.cwd = cwd
+        self.entries = []
+
+
+class _NameIndex:
+    """
+    Индекс имён для find: имя -> путь каталога (кортеж имён), в котором есть запись с этим именем,
+    или список таких путей, если имя встречается несколько раз.
+    Записи только добавляются: удалённые и перемещённые пути отсеиваются при поиске проверкой по дереву.
+    Каталоги, скопированные или перемещённые целиком, не переиндексируются сразу — их пути копятся
+    в roots, и поддеревья добавляются в индекс при следующем поиске.
+    Для шаблонов с буквальным началом (etc*) нужен отсортированный список имён: он строится при
+    первом таком поиске и дальше поддерживается add и replace.
+    """
+
+    def __init__(self, source=None):
+        self.names = {}
+        self.roots = []
+        self.source = source  # отложенный источник пар (путь каталога, имя), например индекс архива
+        self._parents = {}    # одинаковые пути каталогов храним одним кортежем
+        self._sorted = None   # отсортированные имена индекса, None — ещё не построены
+
+    def add(self, parent, name):
+        parent = self._parents.setdefault(parent, parent)
+        current = self.names.get(name)
+        if current is None:
+            self.names[name] = parent
+            if self._sorted is not None:
+                bisect.insort(self._sorted, name)
+        elif isinstance(current, list):
+            current.append(parent)
+        else:
+            self.names[name] = [current, parent]
+
+    def shrink(self):
+        # Словарь путей нужен только пока индекс пополняется пачкой
+        self._parents = {}
+
+    def match(self, pattern):
+        """
+        Имена из индекса, подходящие под шаблон. Имя без символов шаблона ищется напрямую.
+        Шаблон проверяется только на именах с его буквальным началом — их находит бинарный поиск;
+        шаблону без такого начала (*.conf) приходится проверять все имена.
+        """
+        if self.source is not None:
+            for parent, name in self.source:
+                self.add(parent, name)
+            self.source = None
+            self.shrink()
+        if not _has_wildcards(pattern):
+            return [pattern] if pattern in self.names else []
+        matches = re.compile(fnmatch.translate(pattern)).match
+        literal = re.split(r"[*?[]", pattern, maxsplit=1)[0]
+        if not literal:
+            return [name for name in self.names if matches(name)]
+        if self._sorted is None:
+            self._sorted = sorted(self.names)
+        start, stop = _prefix_range(self._sorted, literal)
+        return [name for name in self._sorted[start:stop] if matches(name)]
+
+    def parents(self, name):
+        # Пути каталогов, где встречается имя
+        current = self.names.get(name)
+        if current is None:
+            return []
+        return [current] if isinstance(current, tuple) else current
+
+    def replace(self, name, parents):
+        if not parents:
+            if self.names.pop(name, None) is not None and self._sorted is not None:
+                del self._sorted[bisect.bisect_left(self._sorted, name)]
+        else:
+            self.names[name] = parents[0] if len(parents) == 1 else parents
+
+
+class _FileContents:
+    """
+    Чтение содержимого файлов (cat, head, tail, wc) по смещению и размеру данных в архиве.
+    Общее для обоих представлений дерева: им нужно только _file_extent(path) -> (смещение или None, размер).
+    """
+
+    def _archive_data(self):
+        # Архив отображается в память (сжатый — открывается для распаковки) один раз, при первом чтении файла
+        if self._data is None:
+            self._data = _open_data(self.tar_path)
+        return self._data
+
+    def iter_file(self, path, chunk_size=CHUNK_SIZE):
+        """
+        Отдаёт содержимое файла кусками.
+        Куски — срезы memoryview над отображённым в память архивом, данные не копируются.
+        Из сжатого архива куски распаковываются начиная с ближайшей контрольной точки.
+        """
+        offset, size = self._file_extent(path)
+        if offset is None or not size:
+            return
+        data = self._archive_data()
+        view = memoryview(data) if isinstance(data, mmap.mmap) else data
+        end = offset + size
+        for start in range(offset, end, chunk_size):
+            yield view[start:min(start + chunk_size, end)]
+
+    def cat(self, path):
+        """Возвращает итератор по тексту файла, декодированному кусками."""
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        for chunk in self.iter_file(path):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+
+    def head(self, path, lines=10):
+        """Первые lines строк файла. Переводы строк ищутся прямо в отображённом архиве."""
+        offset, size = self._file_extent(path)
+        if offset is None or lines <= 0:
+            return ""
+        data = self._archive_data()
+        end = offset + size
+        pos = offset
+        for _ in range(lines):
+            newline = data.find(b"\n", pos, end)
+            if newline == -1:
+                pos = end
+                break
+            pos = newline + 1
+        return self._decode(data, offset, pos)
+
+    def tail(self, path, lines=10):
+        """Последние lines строк файла. Файл просматривается с конца, читается только нужный хвост."""
+        offset, size = self._file_extent(path)
+        if offset is None or not size or lines <= 0:
+            return ""
+        data = self._archive_data()
+        end = offset + size
+        # Завершающий перевод строки не начинает новую строку
+        pos = end - 1 if data[end - 1:end] == b"\n" else end
+        for _ in range(lines):
+            newline = data.rfind(b"\n", offset, pos)
+            if newline == -1:
+                return self._decode(data, offset, end)
+            pos = newline
+        return self._decode(data, pos + 1, end)
+
+    def wc(self, path):
+        """Число строк, слов и байт в файле. Файл читается кусками, память не зависит от его размера."""
+        lines = words = 0
+        in_word = False
+        for chunk in self.iter_file(path):
+            chunk = bytes(chunk)
+            lines += chunk.count(b"\n")
+            words += len(chunk.split())
+            # Слово, разрезанное границей кусков, посчитано дважды
+            if in_word and not chunk[:1].isspace():
+                words -= 1
+            in_word = not chunk[-1:].isspace()
+        return f"{lines} {words} {self._file_extent(path)[1]} {path}"
+
+    @staticmethod
+    def _decode(data, start, end):
+        if isinstance(data, mmap.mmap):
+            data = memoryview(data)
+        return str(data[start:end], "utf-8", "replace").removesuffix("\n")
+
+
+class VirtualFileSystem(_FileContents):
+    # Незавершённый вывод tree, du и find видит дерево на момент своего начала (см. _reading)
+    ISOLATED_OUTPUT = True
+
+    def __init__(self, tar_path, use_index=True, journal=False):
+        self.filesystem = _Dir()
         self.current_path = "/"
+        self.use_index = use_index
+        self.journal = journal    # записывать изменения в журнал рядом с архивом и применять его при загрузке
+        self.cancel_event = None  # threading.Event, по которому прерываются долгие операции
+        # Сколько транзакций открыто в других сессиях над тем же деревом (см. SessionServer):
+        # пока они есть, find не забывает записи, которых не видно в текущем дереве
+        self._shared_transactions = 0
+        self._committed = None  # применённое дерево, пока в vfs подставлено дерево сессии сервера
+        self.metrics = Metrics()
         self.load_tar(tar_path)
 
     def load_tar(self, tar_path):
-        with tarfile.open(tar_path, "r") as tar:
-            for member in tar.getmembers():
-                parts = Path(member.name).parts
-                current = self.filesystem
-                for part in parts[:-1]:
-                    current = current.setdefault(part, {})
-                if member.isfile():
-                    current[parts[-1]] = None
-                else:
-                    current[parts[-1]] = {}
-
-    def ls(self, path=None):
-        if path is None:
-            # Если путь не указан, используем текущую директорию
-            current = self._get_current_dir()
+        """
+        Подготавливает ленивую загрузку архива.
+        Если рядом с архивом лежит актуальный индекс, дерево берётся из него без чтения заголовков.
+        Иначе заголовки читаются по одному и только тогда, когда они нужны: cd дочитывает архив
+        до искомого каталога, а ls, tree и изменяющие команды — до конца; по окончании чтения
+        индекс сохраняется для следующих запусков.
+        Узлы каталогов разворачиваются в словари при первом обращении к ним.
+        Если включён журнал, записанные в нём изменения применяются к загруженному дереву.
+        tar_path может быть списком архивов-слоёв (снизу вверх) — см. _load_layers.
+        """
+        if isinstance(tar_path, (list, tuple)) and len(tar_path) == 1:
+            tar_path = tar_path[0]
+        self.tar_path = tar_path
+        self._journal = None
+        self._data = None
+        self._transaction = None
+        self._snapshots = {}  # имя снимка -> корень замороженного дерева
+        self._generation = 0
+        self._resolve_cache = OrderedDict()  # нормализованный путь -> (поколение дерева, узел)
+        self._epoch = 0
+        self._readers = set()  # незавершённые выводы tree, du и find, начатые после последней заморозки
+        self._scanner = None
+        self._scan_dirs = None
+        if isinstance(tar_path, (list, tuple)):
+            key = self._load_layers(tar_path)
+            if self.journal:
+                with self.metrics.phase("journal_replay"):
+                    self._replay(_Journal(tar_path[-1] + JOURNAL_SUFFIX, key))
+            return
+        # Сжатый архив открывается сразу: чтение заголовков расставит в нём контрольные точки распаковки
+        if _compression(tar_path) is not None:
+            self._data = _CompressedData(tar_path)
+        with self.metrics.phase("archive_key"):
+            key = _archive_key(tar_path)
+        index_path = tar_path + INDEX_SUFFIX
+        with self.metrics.phase("index_load"):
+            root = _TarIndex.load(index_path, key) if self.use_index else None
+        if root is not None:
+            self.filesystem = root
+            # Индекс имён строится из индекса архива при первом поиске
+            self._names = _NameIndex(root.pending.index.walk())
         else:
-            # Получаем абсолютный путь
-            if path == "/":
-                target_path = "/"
-            elif path == "..":
-                target_path = str(Path(self.current_path).parent.as_posix())
+            self._names = _NameIndex()
+            self.filesystem = _Dir()
+            self.filesystem.pending = []
+            self._scan_dirs = {(): self.filesystem}  # каталоги архива по их путям, нужны только на время чтения
+            self._scanner = self._scan_tar(tar_path, index_path if self.use_index else None, key)
+        if self.journal:
+            with self.metrics.phase("journal_replay"):
+                self._replay(_Journal(tar_path + JOURNAL_SUFFIX, key))
+
+    def _load_layers(self, paths):
+        """
+        Монтирует архивы paths как слои оверлея: нижние слои только читаются, изменения дерева
+        (и журнал рядом с верхним архивом) образуют над ними записываемый верхний слой.
+        Каждый слой загружается из своего индекса; устаревшие индексы строятся параллельно
+        в пуле процессов, поэтому время запуска определяет самый большой слой, а не их сумма.
+        Затем деревья слоёв объединяются сверху вниз (_overlay).
+        Возвращает ключ оверлея — ключи всех архивов подряд.
+        """
+        with self.metrics.phase("archive_key"):
+            keys = [_archive_key(path) for path in paths]
+        with self.metrics.phase("index_load"):
+            roots = [_TarIndex.load(path + INDEX_SUFFIX, key, layer << _LAYER_SHIFT) if self.use_index else None
+                     for layer, (path, key) in enumerate(zip(paths, keys))]
+        stale = [layer for layer, root in enumerate(roots) if root is None]
+        with self.metrics.phase("layer_scan"):
+            if len(stale) > 1:
+                with ProcessPoolExecutor(max_workers=min(len(stale), os.cpu_count() or 1)) as pool:
+                    built = list(pool.map(_layer_index, [paths[layer] for layer in stale], repeat(self.use_index)))
             else:
-                target_path = (Path(self.current_path) / path).as_posix()
+                built = [_layer_index(paths[layer], self.use_index) for layer in stale]
+        for layer, buf in zip(stale, built):
+            roots[layer] = _TarIndex.from_buffer(buf, keys[layer], layer << _LAYER_SHIFT)
+        # Индекс имён строится из индексов слоёв; скрытые и закрытые верхними слоями записи find отсеет проверкой
+        self._names = _NameIndex(chain.from_iterable(root.pending.index.walk() for root in roots))
+        with self.metrics.phase("overlay_merge"):
+            self.filesystem = _overlay(roots[::-1])
+            self._strip_whiteouts(roots)
+        return [part for key in keys for part in key]
 
-            # Проверяем доступность указанного пути
-            current = self.filesystem
+    def _strip_whiteouts(self, roots):
+        """
+        Убирает записи .wh.* из каталогов, которые _overlay оставил отложенными (они есть только в одном
+        слое, в том числе в нижнем). Такие записи ничего не скрывают, но в дерево оверлея попадать не должны.
+        Индекс слоя обходится, только если в его именах вообще встречается .wh. — поиск по байтам mmap.
+        """
+        marker = _WHITEOUT_PREFIX.encode()
+        parents = set()
+        for root in roots:
+            index = root.pending.index
+            if index.buf.find(marker, index.names_offset) >= 0:
+                parents.update(parts for parts, name in index.walk() if name.startswith(_WHITEOUT_PREFIX))
+        for parts in parents:
+            path = [self.filesystem]
             try:
-                if target_path == "/":
-                    current = self.filesystem
-                else:
-                    for part in target_path.split("/")[1:]:  # Пропускаем корень "/"
-                        # Проверяем, что current — словарь, иначе путь некорректен
-                        if not isinstance(current, dict):
-                            raise NotADirectoryError(f"{path} is not a directory.")
-                        current = current[part]
-                    # Проверяем, что конечный объект — это словарь
-                    if not isinstance(current, dict):
-                        raise NotADirectoryError(f"{path} is not a directory.")
+                for part in parts:
+                    if not isinstance(path[-1], dict):
+                        raise KeyError(part)
+                    path.append(self._child(path[-1], part))
             except KeyError:
-                raise FileNotFoundError(f"There is no such directory.")
+                continue  # каталог закрыт верхним слоем или на его месте файл
+            if not isinstance(path[-1], dict):
+                continue
+            entries = self._entries(path[-1])
+            whiteouts = [name for name in entries if name.startswith(_WHITEOUT_PREFIX)]
+            if not whiteouts:
+                continue  # каталог объединён из нескольких слоёв — _overlay уже убрал их
+            size = sum(entries[name].size for name in whiteouts)
+            entries.remove_all(whiteouts)
+            for node in path:
+                node.size -= size
+                node.count -= len(whiteouts)
 
-        # Возвращаем содержимое директории
-        return "\n".join(current.keys())
+    def _replay(self, journal):
+        # Повторяем записанные команды; пока журнал не подключён, они в него не попадают
+        for name, *args in journal.entries():
+            try:
+                if name == "touch":
+                    self._touch(_split_path("/", args[0]), args[1])
+                elif name in ("cp", "mv", "rm", "snapshot", "restore"):
+                    getattr(self, name)(*args)
+            except (OSError, ValueError, KeyError):
+                pass  # запись, которую нельзя применить (журнал правили вручную), пропускаем
+        self._journal = journal
 
-    def _get_current_dir(self):
-        # Приводим путь в POSIX-совместимый формат и получаем текущую директорию
-        current = self.filesystem
-        for part in Path(self.current_path).as_posix().split("/"):
-            if part:  # Пропускаем пустые части пути
-                current = current[part]
-        return current
+    def _record(self, *entry):
+        if self._transaction is not None:
+            self._transaction.entries.append(entry)
+        elif self._journal is not None:
+            self._journal.append(*entry)
 
-    def cd(self, path):
-        # Реализация перехода по директориям
-        if path == "/":
-            self.current_path = "/"
-        elif path == "..":
-            self.current_path = str(Path(self.current_path).parent.as_posix())
+    def _scan_tar(self, tar_path, index_path, key):
+        numbers = {}
+        for member in _iter_tar(tar_path, self._data):
+            parts = tuple(part for part in member.name.split("/") if part and part != ".")
+            if not parts:
+                continue
+            # Права и время изменения обычно совпадают у множества записей — храним их одним объектом int
+            if len(numbers) > 1 << 16:
+                numbers.clear()
+            mtime = numbers.setdefault(int(member.mtime), int(member.mtime))
+            mode = numbers.setdefault(member.mode, member.mode)
+            if member.isdir():
+                node = self._scan_dir(parts)
+                node.mtime, node.mode, node.header = mtime, mode, member.offset
+            else:
+                parent = self._scan_dir(parts[:-1])
+                if member.isreg():
+                    node = _File(member.offset_data, member.size, mtime, mode, member.offset)
+                else:
+                    node = _File(None, 0, mtime, mode, member.offset)
+                self._attach(parent, parts[-1], node)
+                self._names.add(parts[:-1], parts[-1])
+            yield parts
+        with self.metrics.phase("scan_totals"):
+            # Итоги считаются по окончательным записям каталогов: запись, повторённая в архиве
+            # (tar -r или -u), заменяет прежнюю и учитывается один раз
+            live = set()
+            for node in self._scan_dirs.values():
+                entries = node if node.pending is None else dict(node.pending)
+                if node.pending is not None and len(entries) != len(node.pending):
+                    node.pending = list(entries.items())
+                node.size = sum(child.size for child in entries.values() if not isinstance(child, dict))
+                node.count = len(entries)
+                live.update(id(child) for child in entries.values() if isinstance(child, dict))
+            # Складываем итоги снизу вверх; каталог, заменённый более поздней записью, не учитывается
+            for parts in sorted(self._scan_dirs, key=len, reverse=True):
+                node = self._scan_dirs[parts]
+                if parts and id(node) in live:
+                    parent = self._scan_dirs[parts[:-1]]
+                    parent.size += node.size
+                    parent.count += node.count
+        if index_path is not None:
+            with self.metrics.phase("index_write"):
+                _TarIndex.write(index_path, key, self.filesystem)
+
+    def _scan_dir(self, parts):
+        # Возвращает узел каталога архива, при необходимости создавая его и всех предков
+        node = self._scan_dirs.get(parts)
+        if node is not None:
+            return node
+        # Ищем ближайшего известного предка и создаём недостающие каталоги под ним
+        known = len(parts) - 1
+        while parts[:known] not in self._scan_dirs:
+            known -= 1
+        node = self._scan_dirs[parts[:known]]
+        for depth in range(known + 1, len(parts) + 1):
+            child = _Dir()
+            child.pending = []
+            self._scan_dirs[parts[:depth]] = child
+            self._attach(node, parts[depth - 1], child)
+            self._names.add(parts[:depth - 1], parts[depth - 1])
+            node = child
+        return node
+
+    def _attach(self, parent, name, node):
+        if parent.pending is None:
+            parent[name] = node
+            self._tree_changed()
         else:
-            new_path = (Path(self.current_path) / path).as_posix()
-            current = self.filesystem
+            parent.pending.append((name, node))
+
+    def _scan_until(self, done=None):
+        """
+        Дочитывает заголовки архива, пока done() не вернёт True.
+        Без условия архив дочитывается до конца.
+        Время чтения копится в этапе загрузки scan (вместе с scan_totals и index_write).
+        """
+        if self._scanner is None:
+            return
+        started = time.perf_counter()
+        try:
+            while self._scanner is not None:
+                if done is not None and done():
+                    return
+                # Чтение большого архива можно прервать; прочитанное сохраняется, чтение продолжится позже
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    raise CommandCancelled()
+                try:
+                    next(self._scanner)
+                except StopIteration:
+                    self._scanner = None
+                    self._scan_dirs = None
+                    self._names.shrink()
+        finally:
+            self.metrics.add_phase("scan", time.perf_counter() - started)
+
+    @staticmethod
+    def _entries(node):
+        # Разворачиваем отложенные записи каталога при первом обращении к нему
+        if node.pending is not None:
+            node.update(node.pending)
+            node.pending = None
+        return node
+
+    def _listing(self, node):
+        # Полное содержимое каталога известно только после чтения всего архива
+        self._scan_until()
+        return self._entries(node)
+
+    def _child(self, node, name):
+        # Ищем запись в каталоге, при необходимости дочитывая архив до её появления
+        entries = self._entries(node)
+        if name not in entries and self._scanner is not None:
+            self._scan_until(lambda: name in entries)
+        return entries[name]
+
+    def _sorted_names(self, node):
+        # Отсортированные имена каталога: сортировка — один раз, дальше список поддерживают insert и remove
+        entries = self._listing(node)
+        if entries.names is None:
+            entries.names = sorted(entries)
+        return entries.names
+
+    def ls(self, path=None, limit=None, offset=0):
+        return "\n".join(self.iter_ls(path, limit, offset))
+
+    def iter_ls(self, path=None, limit=None, offset=0):
+        """
+        Имена записей каталога по алфавиту, начиная с offset-й и не больше limit.
+        Страница берётся срезом отсортированного списка, остальные имена не перебираются.
+        Срез — копия, поэтому изменения каталога во время вывода его не затрагивают.
+        """
+        # Получаем узел по абсолютному или относительному пути (без пути — текущая директория)
+        try:
+            _, current = self._resolve(path)
+        except KeyError:
+            raise FileNotFoundError(f"There is no such directory.")
+        # Проверяем, что конечный объект — это словарь
+        if not isinstance(current, dict):
+            raise NotADirectoryError(f"{path} is not a directory.")
+
+        names = self._sorted_names(current)
+        return iter(names[offset:None if limit is None else offset + limit])
+
+    def complete(self, path, limit=COMPLETION_LIMIT):
+        """
+        Дополнение пути по Tab. Возвращает (дополненный путь, варианты): путь дополняется до общего
+        начала всех подходящих имён, варианты — не больше limit подходящих имён, каталоги — с «/».
+        Подходящие имена ищутся двоичным поиском в отсортированном списке имён каталога.
+        """
+        directory, _, prefix = path.rpartition("/")
+        directory = directory + "/" if directory or path.startswith("/") else ""
+        try:
+            _, node = self._resolve(directory)
+        except (KeyError, NotADirectoryError):
+            return path, []
+        if not isinstance(node, dict):
+            return path, []
+        names = self._sorted_names(node)
+        start, stop = _prefix_range(names, prefix)
+        if start == stop:
+            return path, []
+        matches = [name + "/" if isinstance(node[name], dict) else name for name in names[start:min(stop, start + limit)]]
+        if stop - start == 1:
+            return directory + matches[0], matches
+        return directory + os.path.commonprefix([names[start], names[stop - 1]]), matches
+
+    def _resolve(self, path=None):
+        """
+        Единая точка разбора путей: нормализует путь относительно текущей директории
+        и возвращает пару (кортеж имён, узел). Отсутствующий путь — KeyError.
+        """
+        parts = _split_path(self.current_path, path or "")
+        return parts, self._walk(parts)
+
+    def _walk(self, parts):
+        # Спуск от корня по кортежу имён; результаты кэшируются до следующего изменения дерева
+        cached = self._resolve_cache.get(parts)
+        if cached is not None and cached[0] == self._generation:
+            self._resolve_cache.move_to_end(parts)
+            return cached[1]
+
+        node = self.filesystem
+        for i, part in enumerate(parts):
+            if not isinstance(node, dict):
+                raise NotADirectoryError(f"{_join_path(parts[:i])} is not a directory.")
+            node = self._child(node, part)
+
+        self._resolve_cache[parts] = (self._generation, node)
+        self._resolve_cache.move_to_end(parts)
+        if len(self._resolve_cache) > RESOLVE_CACHE_SIZE:
+            self._resolve_cache.popitem(last=False)
+        return node
+
+    def _tree_changed(self):
+        # Новое поколение дерева делает недействительными все закэшированные пути
+        self._generation += 1
+
+    def _writable(self, parts, create=False):
+        """
+        Возвращает каталог по пути, который можно менять на месте (копирование при записи).
+        Каталоги прошлых эпох на пути копируются: копия принадлежит текущей эпохе и
+        подменяет оригинал в родителе, поэтому изменение не затрагивает другие места,
+        где оригинал разделяется. Под общим каталогом общими считаются и все его потомки,
+        поэтому после первой копии копируется и остаток пути. С create=True недостающие каталоги создаются.
+        """
+        self._tree_changed()
+        if self._readers:
+            # Идёт вывод по этому дереву: замораживаем его только сейчас, когда оно действительно меняется
+            self._freeze()
+        shared = self.filesystem.epoch != self._epoch
+        if shared:
+            self.filesystem = self._clone(self.filesystem)
+        node = self.filesystem
+        path = [node]
+        for depth, part in enumerate(parts):
+            entries = node
             try:
-                for part in new_path.split("/")[1:]:
-                    current = current[part]
-                if current is None:
-                    raise NotADirectoryError(f"{path} is not a directory.")
-                self.current_path = "/" + str(new_path)[1:]
+                node = self._child(entries, part)
             except KeyError:
-                raise FileNotFoundError(f"Directory {path} not found.")
-
-    def cp(self, source, destination):
-        # Получаем абсолютные пути
-        src_path = (Path(self.current_path) / source).as_posix()
-        dest_path = (Path(self.current_path) / destination).as_posix()
-
-        # Обработка специальных случаев для корня и родителя
-        if source == "/":
-            src_path = "/"
-        elif source == "..":
-            src_path = str(Path(self.current_path).parent.as_posix())
-        if destination == "/":
-            dest_path = "/"
-        elif destination == "..":
-            dest_path = str(Path(self.current_path).parent.as_posix())
-        src_parts = src_path.split("/")
-        dest_parts = dest_path.split("/")
-        # Проверяем, что источник существует
-        current = self.filesystem
-        try:
-            for part in src_parts[1:]:
-                current = current[part]
-        except KeyError:
-            raise FileNotFoundError(f"Source {source} not found.")
+                if not create:
+                    raise
+                node = _Dir(epoch=self._epoch)
+                entries.insert(part, node)
+                node.mtime = entries.mtime = int(time.time())
+                self._names.add(parts[:depth], part)
+                for ancestor in path:
+                    ancestor.count += 1
+                path.append(node)
+                continue
+            if not isinstance(node, dict):
+                raise NotADirectoryError(f"{part} is not a directory.")
+            if shared or node.epoch != self._epoch:
+                node = entries[part] = self._clone(node)
+                shared = True
+            path.append(node)
+        return self._entries(node)
 
-        # Проверяем, что источник и цель не совпадают
-        if dest_path.startswith(src_path):
-            raise ValueError("Cannot copy an object to itself.")
+    def _crosses_shared(self, parts):
+        # Проходит ли путь к каталогу parts через узел прошлой эпохи или общий узел, скопированный cp
+        node = self.filesystem
+        if node.epoch != self._epoch:
+            return True
+        for part in parts:
+            node = self._child(node, part)
+            if node.epoch != self._epoch:
+                return True
+        return False
 
-        # Проверяем, что в целевой директории нет объекта с тем же именем
-        parent_dest = self.filesystem
+    def _clone(self, node):
+        # Поверхностная копия каталога: дочерние узлы остаются общими
+        clone = _Dir(self._entries(node), epoch=self._epoch)
+        clone.size, clone.count, clone.mtime, clone.mode = node.size, node.count, node.mtime, node.mode
+        clone.header = node.header
+        if node.names is not None:
+            clone.names = list(node.names)
+        return clone
 
+    def _account(self, parts, item, sign=1):
+        """
+        Добавляет (sign=1) или вычитает (sign=-1) размер и число записей объекта item
+        в итогах каталога parts и всех его предков — O(глубины).
+        Вызывается после _writable(parts): все каталоги на пути уже принадлежат текущей эпохе.
+        """
+        self._adjust(parts, sign * item.size, sign * (item.count + 1 if isinstance(item, dict) else 1))
+
+    def _adjust(self, parts, size, count):
+        # Поправляет итоги каталога parts и всех его предков на size байт и count записей
+        node = self.filesystem
+        node.size += size
+        node.count += count
+        for part in parts:
+            node = node[part]
+            node.size += size
+            node.count += count
+        node.mtime = int(time.time())
+
+    def _freeze(self):
+        """
+        Замораживает всё текущее дерево за O(1): узлы прошлых эпох больше не меняются
+        на месте, поэтому их можно разделять между несколькими местами дерева.
+        """
+        self._epoch += 1
+        # Незавершённые выводы теперь идут по замороженным узлам, повторная заморозка им не нужна
+        self._readers.clear()
+
+    def _reading(self, lines):
+        """
+        Регистрирует вывод по текущему дереву. Дерево не замораживается: если до конца вывода
+        его никто не изменит, копировать каталоги не придётся. Первая запись во время вывода
+        заморозит дерево (см. _writable), и вывод продолжится по прежним узлам.
+        """
+        token = object()
+        self._readers.add(token)
+        return self._read_lines(lines, token)
+
+    def _read_lines(self, lines, token):
+        try:
+            yield from lines
+        finally:
+            self._readers.discard(token)
+
+    def begin(self):
+        """
+        Начинает транзакцию: следующие изменения применяются все вместе при commit
+        или отменяются rollback. Дерево на момент begin сохраняется за O(1) — заморозкой,
+        изменённые каталоги копируются при первой записи в них.
+        """
+        if self._transaction is not None:
+            raise ValueError("A transaction is already open.")
+        self._scan_until()
+        self._freeze()
+        self._transaction = _Transaction(self.filesystem, self.current_path)
+
+    def commit(self):
+        """
+        Применяет изменения транзакции и записывает их в журнал одной пачкой.
+        Если за время транзакции другая сессия применила свои изменения, транзакция отменяется.
+        """
+        transaction = self._open_transaction()
+        if transaction.head is not transaction.base:
+            self.rollback()
+            raise ValueError("Another session committed changes during the transaction; it was rolled back.")
+        self._transaction = None
+        if self._journal is not None and transaction.entries:
+            self._journal.extend(transaction.entries)
+        # Изменения уже в дереве; новая эпоха — чтобы следующая транзакция не меняла их на месте
+        self._freeze()
+
+    def rollback(self):
+        """Отменяет изменения транзакции: дерево возвращается к последнему применённому состоянию."""
+        transaction = self._open_transaction()
+        self._transaction = None
+        self._reset_tree(transaction.head, transaction.cwd)
+
+    def _open_transaction(self):
+        if self._transaction is None:
+            raise ValueError("No transaction is open.")
+        return self._transaction
+
+    def snapshot(self, name):
+        """Сохраняет именованный снимок дерева за O(1): дерево замораживается, снимок разделяет с ним все узлы."""
+        if self._transaction is not None:
+            raise ValueError("Snapshots cannot be taken inside a transaction.")
+        self._scan_until()
+        self._freeze()
+        self._snapshots[name] = self.filesystem
+        self._record("snapshot", name)
+
+    def restore(self, name):
+        """Возвращает дерево к снимку name. Снимок остаётся и может быть восстановлен снова."""
+        if self._transaction is not None:
+            raise ValueError("Snapshots cannot be restored inside a transaction.")
+        if name not in self._snapshots:
+            raise ValueError(f"Snapshot {name} not found.")
+        self._reset_tree(self._snapshots[name], "/")
+        self._record("restore", name)
+
+    def snapshots(self):
+        return "\n".join(self._snapshots)
+
+    def enter_session(self, session, shared_transactions):
+        """
+        Подставляет состояние сессии сервера на время шага её команды: текущий каталог,
+        открытую транзакцию и её дерево. Применённое дерево запоминается до leave_session.
+        """
+        self._committed = self.filesystem
+        if session.transaction is not None:
+            session.transaction.head = self.filesystem
+            self.filesystem = session.root
+            self._tree_changed()
+        self._transaction = session.transaction
+        self._shared_transactions = shared_transactions
+        self.current_path = session.cwd
+
+    def leave_session(self, session):
+        # Запоминает состояние сессии после шага и возвращает в vfs общее применённое дерево
+        session.cwd = self.current_path
+        session.transaction, self._transaction = self._transaction, None
+        if session.transaction is not None:
+            session.root = self.filesystem
+            self.filesystem = self._committed
+            self._tree_changed()
+        else:
+            session.root = None
+        self._committed = None
+
+    def tree_stats(self):
+        """Размеры структур дерева для stats; число записей известно, только когда архив прочитан целиком."""
+        return {
+            "entries": None if self._scanner is not None else self.filesystem.count,
+            "bytes": None if self._scanner is not None else self.filesystem.size,
+            "indexed_names": len(self._names.names),
+            "cached_paths": len(self._resolve_cache),
+            "snapshots": len(self._snapshots),
+            "epoch": self._epoch,
+        }
+
+    def _reset_tree(self, root, fallback_cwd):
+        # Подменяет дерево целиком; текущий каталог сохраняется, если он есть в новом дереве
+        self.filesystem = root
+        self._freeze()
+        self._tree_changed()
+        # find забывал записи, которых не было в дереве; в восстановленном они могут быть — строим индекс заново
+        self._names = _NameIndex()
+        self._names.roots.append(())
+        try:
+            if not isinstance(self._walk(_split_path(self.current_path, "")), dict):
+                raise NotADirectoryError(self.current_path)
+        except (KeyError, NotADirectoryError):
+            self.current_path = fallback_cwd
+
+    def _get_current_dir(self):
+        return self._resolve()[1]
+
+    def cd(self, path):
+        # Реализация перехода по директориям
         try:
-            for part in dest_parts[1:]:  # Переходим к родительской директории
-                parent_dest = parent_dest[part]
-            if dest_parts[-1] in parent_dest:  # Проверяем последний сегмент пути
-                raise FileExistsError(f"Destination already contains an object named {dest_parts[-1]}.")
+            parts, current = self._resolve(path)
         except KeyError:
-            pass  # Путь назначения пока не существует, можно продолжать.
+            raise FileNotFoundError(f"Directory {path} not found.")
+        if not isinstance(current, dict):
+            raise NotADirectoryError(f"{path} is not a directory.")
+        self.current_path = _join_path(parts)
+
+    def _expand(self, patterns):
+        """
+        Разворачивает пути с шаблонами (*, ?, [...]) в список пар (кортеж имён, узел) без повторов.
+        Путь, который существует буквально, не разворачивается. Остальные проходятся от корня один раз:
+        на уровне с шаблоном из отсортированного списка имён каталога двоичным поиском берутся только
+        имена с тем же постоянным началом, что у шаблона.
+        """
+        # Изменять дерево можно только после чтения всего архива
+        self._scan_until()
+        found = {}
+        for pattern in patterns:
+            parts = _split_path(self.current_path, pattern)
+            try:
+                found.setdefault(parts, self._walk(parts))
+                continue
+            except (KeyError, NotADirectoryError):
+                if not any(_has_wildcards(part) for part in parts):
+                    raise FileNotFoundError(f"Source {pattern} not found.")
+            level = [((), self.filesystem)]
+            for part in parts:
+                matched = []
+                for prefix, node in level:
+                    if not isinstance(node, dict):
+                        continue
+                    entries = self._entries(node)
+                    if not _has_wildcards(part):
+                        if part in entries:
+                            matched.append((prefix + (part,), entries[part]))
+                        continue
+                    names = self._sorted_names(node)
+                    matches = _glob_matcher(part)
+                    literal = re.split(r"[*?[]", part, maxsplit=1)[0]
+                    start, stop = _prefix_range(names, literal)
+                    matched.extend((prefix + (name,), entries[name]) for name in names[start:stop] if matches(name))
+                level = matched
+            if not level:
+                raise FileNotFoundError(f"No match for {pattern}.")
+            for parts, node in level:
+                found.setdefault(parts, node)
+        return list(found.items())
 
-        # Выполняем копирование
-        self._copy_item(src_path.split("/")[1:], dest_path.split("/")[1:])
+    def _plan_transfer(self, sources, destination, move=False):
+        """
+        Общие проверки cp и mv — для всей пачки источников, до изменения дерева. Объекты помещаются
+        внутрь каталога назначения под своими именами; недостающие каталоги назначения будут созданы.
+        Возвращает (список пар (путь источника, узел), путь назначения).
+        """
+        items = self._expand([sources] if isinstance(sources, str) else sources)
+        dest_parts = _split_path(self.current_path, destination)
+        try:
+            dest = self._walk(dest_parts)
+        except KeyError:
+            dest = None  # Путь назначения пока не существует, можно продолжать.
+        if dest is not None and not isinstance(dest, dict):
+            raise NotADirectoryError(f"{destination} is not a directory.")
+        taken = self._entries(dest).__contains__ if dest is not None else (lambda name: False)
+        _check_batch([parts for parts, _ in items], dest_parts, _split_path(self.current_path, ""), taken, move)
+        return items, dest_parts
 
-    def _copy_item(self, src_parts, dest_parts):
-        # Рекурсивное копирование файлов и директорий
-        current_src = self.filesystem
-        current_dest = self.filesystem
+    def _record_batch(self, name, items, *args):
+        # Пачка попадает в журнал одной записью; единственный путь пишется строкой, как у одиночной команды
+        paths = [_join_path(parts) for parts, _ in items]
+        self._record(name, paths[0] if len(paths) == 1 else paths, *args)
+        return paths
 
-        # Переходим к источнику
-        for part in src_parts[:-1]:
-            current_src = current_src[part]
-        item_to_copy = current_src[src_parts[-1]]
+    def cp(self, sources, destination):
+        """
+        Копирует объекты sources (путь или список путей, в них допустимы шаблоны) в каталог destination.
+        Путь назначения разбирается, а итоги его каталогов обновляются один раз на всю пачку.
+        Возвращает пути скопированных объектов.
+        """
+        items, dest_parts = self._plan_transfer(sources, destination)
+        # Копия разделяет узел с источником: и каталог любого размера, и файл копируются за O(1).
+        # Общий каталог помечается эпохой _SHARED_EPOCH, и запись в любую из копий сначала скопирует
+        # каталоги на пути от него; остальное дерево не замораживается.
+        target = self._writable(dest_parts, create=True)
+        size = count = 0
+        for parts, item in items:
+            if isinstance(item, dict):
+                item.epoch = _SHARED_EPOCH
+            target.insert(parts[-1], item)
+            self._index_moved(dest_parts, parts[-1], item)
+            size += item.size
+            count += item.count + 1 if isinstance(item, dict) else 1
+        self._adjust(dest_parts, size, count)
+        self._tree_changed()
+        return self._record_batch("cp", items, _join_path(dest_parts))
 
-        # Переходим к месту назначения
-        for part in dest_parts:
-            if part:  # Пропускаем пустые части пути
-                current_dest = current_dest.setdefault(part, {})
+    def _detach(self, items):
+        # Убирает объекты из их каталогов: каждый каталог-источник становится изменяемым
+        # и пересчитывает итоги один раз, сколько бы записей из него ни уходило
+        groups = {}
+        for parts, item in items:
+            groups.setdefault(parts[:-1], []).append((parts[-1], item))
+        for parent, group in groups.items():
+            self._writable(parent).remove_all([name for name, _ in group])
+            size = count = 0
+            for _, item in group:
+                size += item.size
+                count += item.count + 1 if isinstance(item, dict) else 1
+            self._adjust(parent, -size, -count)
 
-        # Копируем объект
-        if isinstance(item_to_copy, dict):  # Если это директория
-            current_dest[src_parts[-1]] = {k: v for k, v in item_to_copy.items()}
-        else:  # Если это файл
-            current_dest[src_parts[-1]] = None
+    def _index_moved(self, dest_parts, name, item):
+        # Новое место объекта попадает в индекс имён сразу, содержимое каталога — при следующем поиске
+        self._names.add(dest_parts, name)
+        if isinstance(item, dict):
+            self._names.roots.append(dest_parts + (name,))
 
     def touch(self, filename):
         # Создает пустой файл в текущей директории
-        current = self._get_current_dir()
+        parts = _split_path(self.current_path, "")
+        self._touch(parts, filename)
+        self._record("touch", _join_path(parts), filename)
+
+    def _touch(self, parts, filename):
+        self._scan_until()
+        current = self._writable(parts)
         if filename in current:
             raise FileExistsError(f"File '{filename}' already exists.")
-        current[filename] = None  # None символизирует пустой файл
+        item = _File(mtime=int(time.time()))  # Пустой файл без данных в архиве
+        current.insert(filename, item)
+        self._account(parts, item)
+        self._names.add(parts, filename)
+        self._tree_changed()
 
-    def tree(self, path=None, prefix=""):
+    def _file_extent(self, path):
+        # Смещение данных и размер обычного файла по абсолютному или относительному пути
+        try:
+            _, node = self._resolve(path)
+        except KeyError:
+            raise FileNotFoundError(f"File {path} not found.")
+        if isinstance(node, dict):
+            raise IsADirectoryError(f"{path} is a directory.")
+        return node.offset, node.size
+
+    def stat(self, path=None):
+        """Метаданные файла или каталога. Размер и число записей каталога берутся из его итогов."""
+        try:
+            parts, node = self._resolve(path)
+        except KeyError:
+            raise FileNotFoundError(f"Path {path} not found.")
+        # Итоги каталогов окончательны только после чтения всего архива
+        self._scan_until()
+        is_dir = isinstance(node, dict)
+        return _format_stat(parts, is_dir, node.size, node.count if is_dir else 0, node.mode, node.mtime)
+
+    def du(self, path=None, summarize=False):
+        """
+        Возвращает генератор строк «размер<TAB>путь» (размер в байтах), как du -b.
+        С summarize выводится только итог path — это O(1), итог хранится в узле.
+        Без него выводятся все подкаталоги, каждый после своих подкаталогов; файлы не обходятся.
+        """
+        try:
+            parts, node = self._resolve(path)
+        except KeyError:
+            raise FileNotFoundError(f"Path {path} not found.")
+        self._scan_until()
+        if summarize or not isinstance(node, dict):
+            return iter([f"{node.size}\t{_join_path(parts)}"])
+        return self._reading(self._du_lines(parts, node))
+
+    def _du_lines(self, parts, node):
+        # Обход без рекурсии: стек из (путь, каталог, итератор по его записям)
+        stack = [(parts, node, iter(self._entries(node).items()))]
+        while stack:
+            parts, node, children = stack[-1]
+            for name, child in children:
+                if isinstance(child, dict):
+                    stack.append((parts + (name,), child, iter(self._entries(child).items())))
+                    break
+            else:
+                stack.pop()
+                yield f"{node.size}\t{_join_path(parts)}"
+
+    def tree(self, path=None, prefix="", max_depth=None, limit=None):
         """
         Выводит дерево файлов и папок начиная с указанного пути.
         Если путь не указан, используется текущая директория.
         """
-        if path is None:
-            path = self.current_path
+        return "\n".join(self.iter_tree(path, prefix, max_depth, limit))
 
-        # Получаем текущую директорию
-        current = self.filesystem
+    def iter_tree(self, path=None, prefix="", max_depth=None, limit=None):
+        """
+        Возвращает генератор строк дерева. Путь проверяется сразу, строки строятся по мере чтения.
+        max_depth ограничивает глубину (как tree -L), limit — число выводимых записей.
+        Изменения, сделанные во время вывода, его не затрагивают: первая из них заморозит дерево.
+        """
         try:
-            for part in Path(path).parts[1:]:
-                current = current[part]
+            _, current = self._resolve(path)
         except KeyError:
             raise FileNotFoundError(f"Path {path} not found.")
+        if not isinstance(current, dict):
+            raise NotADirectoryError(f"{path} is not a directory.")
+        self._scan_until()
+        return self._reading(self._tree_lines(self._entries(current), prefix, max_depth, limit))
 
-        # Строка для накопления результата
-        result = []
-
-        # Рекурсивная функция для построения дерева
-        def _build_tree(subtree, pref):
-            items = list(subtree.keys())
-            for i, item in enumerate(items):
-                # Определяем символ для последнего элемента
-                connector = "└── " if i == len(items) - 1 else "├── "
-                result.append(f"{pref}{connector}{item}")
-
-                # Если элемент — директория, рекурсивно выводим её содержимое
-                if isinstance(subtree[item], dict):
-                    extension = "    " if i == len(items) - 1 else "│   "
-                    _build_tree(subtree[item], pref + extension)
-
-        # Построение дерева
-        _build_tree(current, prefix)
-
-        # Возвращаем результат в виде строки
-        return "\n".join(result)
-
-    def mv(self, source, destination):
-        # print("self.current_path:")
-        # print(self.current_path)
-
-        # Получаем абсолютные пути
-        src_path = (Path(self.current_path) / source).as_posix()
-        dest_path = (Path(self.current_path) / destination).as_posix()
-        if source == "/":
-            src_path = "/"
-        elif source == "..":
-            src_path = str(Path(self.current_path).parent.as_posix())
-        if destination == "/":
-            dest_path = "/"
-        elif destination == "..":
-            dest_path = str(Path(self.current_path).parent.as_posix())
-        dest_parts = dest_path.split("/")
-        if src_path in self.current_path or self.current_path.startswith(src_path):
-            raise ValueError("Cannot move a directory that contains the current working directory.")
-
-        # Проверяем, что источник существует
-        current = self.filesystem
-        # print("current:")
-        # print(current)
-        try:
-            for part in src_path.split("/")[1:]:
-                # print("part:")
-                # print(part)
-                current = current[part]
-                # print("current:")
-                # print(current)
+    def _tree_lines(self, root, prefix, max_depth, limit):
+        # Обход без рекурсии: стек из [итератор записей, сколько записей осталось, префикс, глубина]
+        stack = [[iter(root.items()), len(root), prefix, 1]]
+        emitted = 0
+        while stack:
+            frame = stack[-1]
+            entry = next(frame[0], None)
+            if entry is None:
+                stack.pop()
+                continue
+            if limit is not None and emitted >= limit:
+                yield f"... (output limited to {limit} entries)"
+                return
+            frame[1] -= 1
+            item, node = entry
+            # Определяем символ для последнего элемента
+            is_last = frame[1] == 0
+            yield f"{frame[2]}{'└── ' if is_last else '├── '}{item}"
+            emitted += 1
+
+            # Если элемент — директория, спускаемся в неё
+            if isinstance(node, dict) and (max_depth is None or frame[3] < max_depth):
+                children = self._entries(node)
+                extension = "    " if is_last else "│   "
+                stack.append([iter(children.items()), len(children), frame[2] + extension, frame[3] + 1])
+
+    def mv(self, sources, destination):
+        """
+        Перемещает объекты sources (путь или список путей, в них допустимы шаблоны) в каталог destination.
+        Как и cp, сначала проверяет всю пачку, затем применяет её одним проходом. Возвращает пути источников.
+        """
+        items, dest_parts = self._plan_transfer(sources, destination, move=True)
+        # Каталог из-под общего узла остаётся и в других местах, где этот узел разделяется:
+        # на новом месте он тоже общий, иначе запись в него изменила бы и их
+        shared = [isinstance(item, dict) and self._crosses_shared(parts[:-1]) for parts, item in items]
+        target = self._writable(dest_parts, create=True)
+        # Удаляем объекты из источников только когда место назначения уже готово
+        self._detach(items)
+        size = count = 0
+        for (parts, item), is_shared in zip(items, shared):
+            if is_shared:
+                item.epoch = _SHARED_EPOCH
+            target.insert(parts[-1], item)
+            self._index_moved(dest_parts, parts[-1], item)
+            size += item.size
+            count += item.count + 1 if isinstance(item, dict) else 1
+        self._adjust(dest_parts, size, count)
+        self._tree_changed()
+        return self._record_batch("mv", items, _join_path(dest_parts))
+
+    def rm(self, paths, recursive=False):
+        """
+        Удаляет объекты paths (путь или список путей, в них допустимы шаблоны); каталоги — только с recursive.
+        Пачка проверяется целиком до изменения дерева; каталог удаляется вместе с поддеревом за O(1).
+        Индекс имён не меняется: удалённые пути find отсеет проверкой по дереву. Возвращает удалённые пути.
+        """
+        found = dict(self._expand([paths] if isinstance(paths, str) else paths))
+        kept = _check_removal(list(found), _split_path(self.current_path, ""), recursive,
+                              lambda parts: isinstance(found[parts], dict))
+        items = [(parts, found[parts]) for parts in kept]
+        self._detach(items)
+        self._tree_changed()
+        return self._record_batch("rm", items, recursive)
+
+    def save(self, path=None):
+        """
+        Записывает текущее дерево в tar-архив path (по умолчанию — поверх исходного архива).
+        Неизменённые записи копируются из исходного архива байт в байт, новые заголовки
+        пишутся только для созданных, скопированных и перемещённых записей.
+        После сохранения поверх исходного архива журнал очищается, а архив загружается заново.
+        Оверлей слоёв сохраняется одним архивом, поэтому для него path обязателен.
+        """
+        if self._transaction is not None:
+            raise ValueError("Commit or roll back the transaction before saving.")
+        self._scan_until()
+        layers = self.tar_path if isinstance(self.tar_path, (list, tuple)) else [self.tar_path]
+        if path is None and len(layers) > 1:
+            raise ValueError("Saving a layered image needs a target path.")
+        target = path or self.tar_path
+        _write_tar(target, self.tar_path, self._save_entries())
+        if os.path.abspath(target) in map(os.path.abspath, layers):
+            if self._journal is not None:
+                self._journal.clear()
+            cwd = self.current_path
+            self.load_tar(self.tar_path)
+            self.current_path = cwd
+        return target
+
+    def _save_entries(self):
+        # Записи дерева в прямом порядке обхода: каталог перед своим содержимым
+        stack = [((), self.filesystem)]
+        while stack:
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                raise CommandCancelled()
+            parts, node = stack.pop()
+            if isinstance(node, dict):
+                if parts:
+                    yield parts, True, node.header, None, 0, node.mtime, node.mode
+                stack.extend((parts + (name,), child) for name, child in reversed(self._entries(node).items()))
+            else:
+                yield parts, False, node.header, node.offset, node.size, node.mtime, node.mode
+
+    def find(self, path=None, name=None, kind=None):
+        """
+        Возвращает генератор абсолютных путей записей внутри path (включая сам path),
+        чьё имя подходит под шаблон name и чей вид совпадает с kind ("f" — файл, "d" — каталог).
+        С шаблоном имени записи берутся из индекса имён, дерево не обходится.
+        """
+        try:
+            start, node = self._resolve(path)
         except KeyError:
-            raise FileNotFoundError(f"Source {source} not found.")
+            raise FileNotFoundError(f"Path {path} not found.")
+        self._scan_until()
+        if name is None:
+            return self._reading(self._find_walk(start, node, kind))
+        self._index_roots()
+        return self._find_indexed(start, name, kind)
 
-        # Проверяем, что источник и цель не совпадают
-        if dest_path.startswith(src_path):
-            raise ValueError("Cannot copy an object to itself.")
+    def _find_walk(self, start, node, kind):
+        # Без шаблона имени выдаётся всё поддерево, индекс тут не помогает
+        stack = [(start, node)]
+        while stack:
+            parts, node = stack.pop()
+            is_dir = isinstance(node, dict)
+            if kind is None or kind == ("d" if is_dir else "f"):
+                yield _join_path(parts)
+            if is_dir:
+                stack.extend((parts + (child,), item) for child, item in reversed(self._entries(node).items()))
+
+    def _index_roots(self):
+        # Добавляем в индекс имён содержимое каталогов, скопированных или перемещённых с прошлого поиска
+        roots, self._names.roots = self._names.roots, []
+        for root in roots:
+            try:
+                node = self._walk(root)
+            except (KeyError, NotADirectoryError):
+                continue  # каталог уже перемещён дальше, его новое место тоже в списке
+            stack = [(root, node)]
+            while stack:
+                parts, node = stack.pop()
+                for child, item in self._entries(node).items():
+                    self._names.add(parts, child)
+                    if isinstance(item, dict):
+                        stack.append((parts + (child,), item))
+        self._names.shrink()
+
+    def _find_indexed(self, start, pattern, kind):
+        found = []
+        for name in self._names.match(pattern):
+            parents = self._names.parents(name)
+            alive = []
+            for parent in parents:
+                parts = parent + (name,)
+                if parts[:len(start)] != start:
+                    alive.append(parent)  # вне области поиска, не проверяем
+                    continue
+                try:
+                    node = self._child(self._walk(parent), name)
+                except (KeyError, NotADirectoryError):
+                    continue  # запись удалена или перемещена — забываем её
+                alive.append(parent)
+                if kind is None or kind == ("d" if isinstance(node, dict) else "f"):
+                    found.append(parts)
+            if len(alive) != len(parents) and not self._shared_transactions:
+                self._names.replace(name, alive)
+        # Одна запись могла попасть в индекс дважды: при загрузке и при переиндексации каталога
+        for parts in sorted(set(found)):
+            yield _join_path(parts)
+
+
+def _layer_index(tar_path, use_index):
+    """
+    Читает заголовки архива-слоя и возвращает его индекс в виде bytes; если use_index,
+    индекс сохраняется и рядом с архивом. Выполняется в пуле процессов — по процессу на слой.
+    """
+    vfs = VirtualFileSystem(tar_path, use_index=False)
+    vfs._scan_until()
+    buf = _TarIndex.pack(_archive_key(tar_path), vfs.filesystem)
+    if use_index:
+        _TarIndex.store(tar_path + INDEX_SUFFIX, buf)
+    return buf
+
+
+class InodeFileSystem(_FileContents):
+    """
+    Компактное хранилище дерева — плоская таблица inode.
+    Узел — это целочисленный номер, его поля лежат в параллельных массивах array,
+    а связи родитель/потомок/сосед хранятся как номера узлов.
+    Имена интернируются в общем пуле байт: одинаковые имена хранятся один раз,
+    а у узла есть только смещение и длина имени в пуле.
+    Поддерживает те же команды работы с деревом и чтения файлов, что и VirtualFileSystem,
+    включая журнал и save; транзакций и снимков у неё нет.
+    """
+    ROOT = 0
+    _NONE = -1
+    # Обход держит номера строк, которые rm, mv и новые узлы могут изменить или занять:
+    # сервер выполняет команду целиком за один шаг (см. SessionServer._step)
+    ISOLATED_OUTPUT = False
+    _INTERN_LIMIT = 1 << 16
+    # Каталог, в котором поиск имени прошёл больше стольких потомков, получает упорядоченный индекс имён
+    _LINEAR_CHILDREN = 32
+
+    def __init__(self, tar_path, journal=False):
+        self.current_path = "/"
+        self.journal = journal
+        self.cancel_event = None
+        self.metrics = Metrics()
+        self.load_tar(tar_path)
+
+    def load_tar(self, tar_path):
+        if isinstance(tar_path, (list, tuple)):
+            if len(tar_path) > 1:
+                raise ValueError("The inode backend mounts a single archive; use the dict backend for layers.")
+            tar_path = tar_path[0]
+        self.tar_path = tar_path
+        self._data = None
+        self.names = bytearray()           # пул имён в UTF-8
+        self.name_offset = array("I")
+        self.name_length = array("H")
+        self.parent = array("i")
+        self.first_child = array("i")
+        self.last_child = array("i")       # хвост списка потомков: добавление за O(1) с сохранением порядка
+        self.next_sibling = array("i")
+        self.is_dir = array("b")
+        self.offset = array("q")           # смещение данных файла в архиве, -1 — данных нет
+        self.size = array("Q")             # размер файла; у каталога — суммарный размер его поддерева
+        self.count = array("I")            # у каталога — число записей в его поддереве
+        self.mtime = array("q")
+        self.mode = array("H")
+        self.header = array("q")           # смещение заголовка записи в архиве, -1 — записи в архиве нет
+        self._interned = {}
+        self._by_name = None               # номера узлов, упорядоченные по имени; строится при первом find
+        self._child_index = {}             # большой каталог -> его потомки, упорядоченные по имени
+        self._free = array("i")            # номера освобождённых rm узлов, занимаются новыми узлами
+        self._journal = None
+        self._new_inode("", self._NONE, True)
+
+        # Каталоги по их путям, хэши прочитанных пар (каталог, имя) и словарь интернированных имён
+        # нужны только на время чтения архива
+        dirs = {(): self.ROOT}
+        seen = set()
+        replaced = []  # записи, которые заменила более поздняя запись с тем же путём
 
-            # Проверяем, что в целевой директории нет объекта с тем же именем
-        parent_dest = self.filesystem
+        def take_over(parent, parts, is_dir):
+            """
+            Находит запись с путём parts, если она уже была прочитана (архив, дописанный tar -r или -u).
+            Действует последняя запись: файл, заменённый файлом, возвращается для перезаписи его полей,
+            запись другого вида отсоединяется. Потомки просматриваются, только если совпал хэш.
+            """
+            key = hash((parent, parts[-1]))
+            if key not in seen:
+                seen.add(key)
+                return self._NONE
+            encoded = parts[-1].encode("utf-8", "surrogateescape")
+            for child in self._children(parent):
+                if self._name_bytes(child) == encoded:
+                    break
+            else:
+                return self._NONE
+            if not is_dir and not self.is_dir[child]:
+                return child
+            self._unlink(child)
+            replaced.append(child)
+            for stale in [key for key in dirs if key[:len(parts)] == parts]:
+                del dirs[stale]
+            return self._NONE
+
+        def dir_inode(parts):
+            inode = dirs.get(parts)
+            if inode is not None:
+                return inode
+            # Ищем ближайшего известного предка и создаём недостающие каталоги под ним
+            known = len(parts) - 1
+            while parts[:known] not in dirs:
+                known -= 1
+            inode = dirs[parts[:known]]
+            for depth in range(known + 1, len(parts) + 1):
+                take_over(inode, parts[:depth], True)
+                inode = dirs[parts[:depth]] = self._new_inode(parts[depth - 1], inode, True)
+            return inode
+
+        with self.metrics.phase("scan"):
+            for member in _iter_tar(tar_path):
+                parts = tuple(part for part in member.name.split("/") if part and part != ".")
+                if not parts:
+                    continue
+                if member.isdir():
+                    inode = dir_inode(parts)
+                else:
+                    parent = dir_inode(parts[:-1])
+                    inode = take_over(parent, parts, False)
+                    if inode == self._NONE:
+                        inode = self._new_inode(parts[-1], parent, False)
+                    self.offset[inode], self.size[inode] = (member.offset_data, member.size) if member.isreg() else (-1, 0)
+                self.mtime[inode] = int(member.mtime)
+                self.mode[inode] = member.mode
+                self.header[inode] = member.offset
+        self._interned = {}
+        # Родитель всегда создаётся раньше потомков, поэтому итоги каталогов складываются одним проходом с конца
+        with self.metrics.phase("scan_totals"):
+            for inode in range(len(self.parent) - 1, self.ROOT, -1):
+                parent = self.parent[inode]
+                if parent != self._NONE:
+                    self.size[parent] += self.size[inode]
+                    self.count[parent] += self.count[inode] + 1
+        # Строки заменённых записей освобождаются только теперь: при чтении архива порядок строк важен для итогов
+        self._release(replaced)
+        if self.journal:
+            with self.metrics.phase("journal_replay"):
+                self._replay(_Journal(tar_path + JOURNAL_SUFFIX, _archive_key(tar_path)))
+
+    def _replay(self, journal):
+        for name, *args in journal.entries():
+            try:
+                if name == "touch":
+                    self._touch(_split_path("/", args[0]), args[1])
+                elif name in ("cp", "mv", "rm"):
+                    getattr(self, name)(*args)
+            except (OSError, ValueError, KeyError):
+                pass  # запись, которую нельзя применить, пропускаем
+        self._journal = journal
+
+    def _record(self, *entry):
+        if self._journal is not None:
+            self._journal.append(*entry)
+
+    def _intern(self, name):
+        # Возвращает смещение имени в пуле, добавляя его туда при первой встрече
+        encoded = name.encode("utf-8", "surrogateescape")
+        offset = self._interned.get(encoded)
+        if offset is None:
+            # Словарь ограничен: уникальные имена не должны раздувать его во время загрузки
+            if len(self._interned) >= self._INTERN_LIMIT:
+                self._interned.clear()
+            offset = self._interned[encoded] = len(self.names)
+            self.names += encoded
+        return offset, len(encoded)
+
+    def _name(self, inode):
+        start = self.name_offset[inode]
+        return self.names[start:start + self.name_length[inode]].decode("utf-8", "surrogateescape")
+
+    def _new_inode(self, name, parent, is_dir, name_ref=None):
+        # name_ref — готовые (смещение, длина) имени в пуле, например у копируемого узла
+        offset, length = name_ref if name_ref is not None else self._intern(name)
+        fields = (offset, length, parent, self._NONE, self._NONE, self._NONE, is_dir,
+                  -1, 0, 0, 0, 0o755 if is_dir else 0o644, -1)
+        columns = (self.name_offset, self.name_length, self.parent, self.first_child, self.last_child,
+                   self.next_sibling, self.is_dir, self.offset, self.size, self.count, self.mtime, self.mode,
+                   self.header)
+        if self._free:
+            # Строка таблицы, освобождённая rm, занимается снова: таблица не растёт от циклов cp/rm
+            inode = self._free.pop()
+            for column, value in zip(columns, fields):
+                column[inode] = value
+        else:
+            inode = len(self.parent)
+            for column, value in zip(columns, fields):
+                column.append(value)
+        if parent != self._NONE:
+            self._link(parent, inode)
+        if self._by_name is not None:
+            self._by_name.insert(self._name_bound(self._name_bytes(inode)), inode)
+        return inode
+
+    def _link(self, parent, inode):
+        # Добавляет узел в конец списка потомков каталога
+        self.parent[inode] = parent
+        self.next_sibling[inode] = self._NONE
+        if self.first_child[parent] == self._NONE:
+            self.first_child[parent] = inode
+        else:
+            self.next_sibling[self.last_child[parent]] = inode
+        self.last_child[parent] = inode
+        index = self._child_index.get(parent)
+        if index is not None:
+            index.insert(self._name_bound(self._name_bytes(inode), inodes=index), inode)
+
+    def _unlink(self, inode):
+        # Исключает узел из списка потомков его каталога
+        parent = self.parent[inode]
+        index = self._child_index.get(parent)
+        if index is not None:
+            position = self._name_bound(self._name_bytes(inode), inodes=index)
+            while index[position] != inode:  # среди одинаковых имён
+                position += 1
+            del index[position]
+        previous = self._NONE
+        child = self.first_child[parent]
+        while child != inode:
+            previous, child = child, self.next_sibling[child]
+        following = self.next_sibling[inode]
+        if previous == self._NONE:
+            self.first_child[parent] = following
+        else:
+            self.next_sibling[previous] = following
+        if self.last_child[parent] == inode:
+            self.last_child[parent] = previous
+        self.parent[inode] = self._NONE
+
+    def _account(self, inode, size, count):
+        # Поправляет итоги каталога и всех его предков — O(глубины)
+        self.mtime[inode] = int(time.time())
+        while inode != self._NONE:
+            self.size[inode] += size
+            self.count[inode] += count
+            inode = self.parent[inode]
 
+    def _children(self, inode):
+        child = self.first_child[inode]
+        while child != self._NONE:
+            yield child
+            child = self.next_sibling[child]
+
+    def _find_child(self, inode, name):
+        """
+        Потомок каталога по имени. Небольшой каталог просматривается подряд; каталог, в котором
+        просмотр прошёл больше _LINEAR_CHILDREN потомков, получает упорядоченный по имени индекс
+        потомков, и дальше имя ищется в нём двоичным поиском. _link и _unlink поддерживают индекс.
+        """
+        encoded = name.encode("utf-8", "surrogateescape")
+        index = self._child_index.get(inode)
+        if index is None:
+            names, offsets, lengths = self.names, self.name_offset, self.name_length
+            for scanned, child in enumerate(self._children(inode)):
+                # Имя сравнивается прямо в пуле, без создания строки
+                if lengths[child] == len(encoded) and names.startswith(encoded, offsets[child]):
+                    return child
+                if scanned == self._LINEAR_CHILDREN:
+                    break
+            else:
+                return self._NONE
+            index = self._child_index[inode] = array("i", sorted(self._children(inode), key=self._name_bytes))
+        position = self._name_bound(encoded, inodes=index)
+        if position < len(index) and self._name_bytes(index[position]) == encoded:
+            return index[position]
+        return self._NONE
+
+    def _split(self, path):
+        return _split_path(self.current_path, path)
+
+    def _lookup(self, parts):
+        inode = self.ROOT
+        for part in parts:
+            if not self.is_dir[inode]:
+                raise NotADirectoryError(f"{part} is not a directory.")
+            inode = self._find_child(inode, part)
+            if inode == self._NONE:
+                raise KeyError(part)
+        return inode
+
+    def _make_dirs(self, parts):
+        # Находит каталог по пути, создавая недостающие каталоги
+        inode = self.ROOT
+        for part in parts:
+            child = self._find_child(inode, part)
+            if child == self._NONE:
+                child = self._new_inode(part, inode, True)
+                self.mtime[child] = int(time.time())
+                self._account(inode, 0, 1)
+            elif not self.is_dir[child]:
+                raise NotADirectoryError(f"{part} is not a directory.")
+            inode = child
+        return inode
+
+    def _name_bytes(self, inode):
+        start = self.name_offset[inode]
+        return self.names[start:start + self.name_length[inode]]
+
+    def _name_bound(self, encoded, upper=False, inodes=None):
+        # Двоичный поиск по упорядоченному по именам списку узлов (по умолчанию — индексу find):
+        # первая позиция с именем >= encoded (с upper=True — с именем, которое больше encoded и не начинается с него)
+        if inodes is None:
+            inodes = self._by_name
+        low, high = 0, len(inodes)
+        while low < high:
+            middle = (low + high) // 2
+            name = self._name_bytes(inodes[middle])
+            if name < encoded or (upper and name.startswith(encoded)):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _path(self, inode):
+        # Путь узла по ссылкам на родителей; None, если узел отсоединён от дерева
+        parts = []
+        while inode != self.ROOT:
+            if inode == self._NONE:
+                return None
+            parts.append(self._name(inode))
+            inode = self.parent[inode]
+        return tuple(reversed(parts))
+
+    def find(self, path=None, name=None, kind=None):
+        """
+        Поиск как у VirtualFileSystem.find. Индекс имён — массив номеров узлов, упорядоченный
+        по имени: точное имя и постоянная часть шаблона до первого спецсимвола находятся двоичным поиском.
+        """
+        start = self._split(path or "")
         try:
-            for part in dest_parts[1:]:  # Переходим к родительской директории
-                parent_dest = parent_dest[part]
-            if dest_parts[-1] in parent_dest:  # Проверяем последний сегмент пути
-                raise FileExistsError(f"Destination already contains an object named {dest_parts[-1]}.")
+            inode = self._lookup(start)
         except KeyError:
-            pass  # Путь назначения пока не существует, можно продолжать.
+            raise FileNotFoundError(f"Path {path} not found.")
+        if name is None:
+            return self._find_walk(start, inode, kind)
+        if self._by_name is None:
+            # Свободные и отсоединённые строки таблицы в индекс не попадают
+            self._by_name = array("i", sorted((inode for inode in range(1, len(self.parent))
+                                               if self.parent[inode] != self._NONE), key=self._name_bytes))
 
-        # Перемещаем объект
-        self._move_item(src_path.split("/")[1:], dest_path.split("/")[1:])
+        literal = re.split(r"[*?[]", name, maxsplit=1)[0].encode("utf-8", "surrogateescape")
+        matches = re.compile(fnmatch.translate(name)).match
+        found = []
+        for inode in self._by_name[self._name_bound(literal):self._name_bound(literal, upper=True)]:
+            if kind is not None and kind != ("d" if self.is_dir[inode] else "f"):
+                continue
+            if not matches(self._name(inode)):
+                continue
+            parts = self._path(inode)
+            if parts is not None and parts[:len(start)] == start:
+                found.append(parts)
+        return (_join_path(parts) for parts in sorted(found))
 
-    def _move_item(self, src_parts, dest_parts):
-        # Рекурсивное перемещение файлов и директорий
-        current_src = self.filesystem
-        current_dest = self.filesystem
+    def _find_walk(self, start, inode, kind):
+        stack = [(start, inode)]
+        while stack:
+            parts, inode = stack.pop()
+            if kind is None or kind == ("d" if self.is_dir[inode] else "f"):
+                yield _join_path(parts)
+            children = [(parts + (self._name(child),), child) for child in self._children(inode)]
+            stack.extend(reversed(children))
 
-        # Переходим к источнику
-        for part in src_parts[:-1]:
-            current_src = current_src[part]
-        item_to_move = current_src.pop(src_parts[-1])  # Удаляем объект из источника
+    def _copy_subtree(self, inode, parent):
+        # Обход без рекурсии: стек пар (исходный узел, каталог, куда кладётся его копия).
+        # Копия ссылается на имя источника в пуле, пул имён не растёт
+        root = None
+        stack = [(inode, parent)]
+        while stack:
+            source, target = stack.pop()
+            copy = self._new_inode(None, target, self.is_dir[source],
+                                   (self.name_offset[source], self.name_length[source]))
+            self.offset[copy] = self.offset[source]
+            self.size[copy] = self.size[source]
+            self.count[copy] = self.count[source]
+            self.mtime[copy] = self.mtime[source]
+            self.mode[copy] = self.mode[source]
+            self.header[copy] = self.header[source]
+            if root is None:
+                root = copy
+            # Список потомков фиксируем заранее: копия может оказаться внутри обходимого каталога
+            stack.extend((child, copy) for child in reversed(list(self._children(source))))
+        return root
 
-        # Переходим к месту назначения
-        for part in dest_parts:
-            if part:
-                current_dest = current_dest.setdefault(part, {})
+    def ls(self, path=None, limit=None, offset=0):
+        return "\n".join(self.iter_ls(path, limit, offset))
 
-        # Перемещаем объект
-        current_dest[src_parts[-1]] = item_to_move
+    def iter_ls(self, path=None, limit=None, offset=0):
+        # Списки потомков не упорядочены, поэтому имена сортируются при каждом вызове
+        try:
+            inode = self._lookup(self._split(path or ""))
+        except KeyError:
+            raise FileNotFoundError(f"There is no such directory.")
+        if not self.is_dir[inode]:
+            raise NotADirectoryError(f"{path} is not a directory.")
+        names = sorted(self._name(child) for child in self._children(inode))
+        return iter(names[offset:None if limit is None else offset + limit])
+
+    def complete(self, path, limit=COMPLETION_LIMIT):
+        directory, _, prefix = path.rpartition("/")
+        directory = directory + "/" if directory or path.startswith("/") else ""
+        try:
+            inode = self._lookup(self._split(directory))
+        except (KeyError, NotADirectoryError):
+            return path, []
+        if not self.is_dir[inode]:
+            return path, []
+        matches = sorted((self._name(child), child) for child in self._children(inode)
+                         if self._name(child).startswith(prefix))
+        if not matches:
+            return path, []
+        shown = [name + "/" if self.is_dir[child] else name for name, child in matches[:limit]]
+        if len(matches) == 1:
+            return directory + shown[0], shown
+        return directory + os.path.commonprefix([matches[0][0], matches[-1][0]]), shown
+
+    def cd(self, path):
+        parts = self._split(path)
+        try:
+            inode = self._lookup(parts)
+        except KeyError:
+            raise FileNotFoundError(f"Directory {path} not found.")
+        if not self.is_dir[inode]:
+            raise NotADirectoryError(f"{path} is not a directory.")
+        self.current_path = _join_path(parts)
+
+    def _expand(self, patterns):
+        # Как у VirtualFileSystem._expand; списки потомков не упорядочены, поэтому на уровне
+        # с шаблоном перебираются все имена каталога
+        found = {}
+        for pattern in patterns:
+            parts = self._split(pattern)
+            try:
+                found.setdefault(parts, self._lookup(parts))
+                continue
+            except (KeyError, NotADirectoryError):
+                if not any(_has_wildcards(part) for part in parts):
+                    raise FileNotFoundError(f"Source {pattern} not found.")
+            level = [((), self.ROOT)]
+            for part in parts:
+                matched = []
+                for prefix, inode in level:
+                    if not self.is_dir[inode]:
+                        continue
+                    if not _has_wildcards(part):
+                        child = self._find_child(inode, part)
+                        if child != self._NONE:
+                            matched.append((prefix + (part,), child))
+                        continue
+                    matches = _glob_matcher(part)
+                    names = sorted((self._name(child), child) for child in self._children(inode))
+                    matched.extend((prefix + (name,), child) for name, child in names if matches(name))
+                level = matched
+            if not level:
+                raise FileNotFoundError(f"No match for {pattern}.")
+            for parts, inode in level:
+                found.setdefault(parts, inode)
+        return list(found.items())
+
+    def _plan_transfer(self, sources, destination, move=False):
+        items = self._expand([sources] if isinstance(sources, str) else sources)
+        dest_parts = self._split(destination)
+        try:
+            dest = self._lookup(dest_parts)
+        except KeyError:
+            dest = self._NONE  # Путь назначения пока не существует, он будет создан
+        if dest != self._NONE and not self.is_dir[dest]:
+            raise NotADirectoryError(f"{destination} is not a directory.")
+        taken = (lambda name: self._find_child(dest, name) != self._NONE) if dest != self._NONE else (lambda name: False)
+        _check_batch([parts for parts, _ in items], dest_parts, self._split(""), taken, move)
+        return items, dest_parts
+
+    def _record_batch(self, name, items, *args):
+        paths = [_join_path(parts) for parts, _ in items]
+        self._record(name, paths[0] if len(paths) == 1 else paths, *args)
+        return paths
+
+    def cp(self, sources, destination):
+        items, dest_parts = self._plan_transfer(sources, destination)
+        self._by_name = None  # копия поддерева добавляет много узлов — индекс имён проще построить заново
+        dest = self._make_dirs(dest_parts)
+        size = count = 0
+        for _, src in items:
+            self._copy_subtree(src, dest)
+            size += self.size[src]
+            count += self.count[src] + 1
+        self._account(dest, size, count)
+        return self._record_batch("cp", items, _join_path(dest_parts))
+
+    def _detach(self, items):
+        # Исключает узлы из списков потомков: список каждого каталога, из которого уходит
+        # несколько узлов, перестраивается за один проход, а его индекс имён строится заново при поиске
+        groups = {}
+        for _, inode in items:
+            groups.setdefault(self.parent[inode], set()).add(inode)
+        for parent, removed in groups.items():
+            if len(removed) == 1:
+                self._unlink(next(iter(removed)))
+            else:
+                self._child_index.pop(parent, None)
+                kept = [child for child in self._children(parent) if child not in removed]
+                self.first_child[parent] = self.last_child[parent] = self._NONE
+                for child in kept:
+                    self._link(parent, child)
+                for inode in removed:
+                    self.parent[inode] = self._NONE
+            self._account(parent, -sum(self.size[inode] for inode in removed),
+                          -sum(self.count[inode] + 1 for inode in removed))
+
+    def mv(self, sources, destination):
+        items, dest_parts = self._plan_transfer(sources, destination, move=True)
+        dest = self._make_dirs(dest_parts)
+        self._detach(items)
+        size = count = 0
+        for _, src in items:
+            self._link(dest, src)
+            size += self.size[src]
+            count += self.count[src] + 1
+        self._account(dest, size, count)
+        return self._record_batch("mv", items, _join_path(dest_parts))
+
+    def rm(self, paths, recursive=False):
+        found = dict(self._expand([paths] if isinstance(paths, str) else paths))
+        kept = _check_removal(list(found), self._split(""), recursive, lambda parts: self.is_dir[found[parts]])
+        items = [(parts, found[parts]) for parts in kept]
+        self._detach(items)
+        self._release([inode for _, inode in items])
+        return self._record_batch("rm", items, recursive)
+
+    def _release(self, inodes):
+        # Строки таблицы удалённых поддеревьев уходят в список свободных и занимаются новыми узлами
+        stack = list(inodes)
+        while stack:
+            inode = stack.pop()
+            stack.extend(self._children(inode))
+            self._child_index.pop(inode, None)
+            self.parent[inode] = self._NONE
+            self._free.append(inode)
+        self._by_name = None  # освобождённые номера ещё есть в индексе find — он строится заново при поиске
+
+    def touch(self, filename):
+        parts = self._split("")
+        self._touch(parts, filename)
+        self._record("touch", _join_path(parts), filename)
+
+    def _touch(self, parts, filename):
+        current = self._lookup(parts)
+        if self._find_child(current, filename) != self._NONE:
+            raise FileExistsError(f"File '{filename}' already exists.")
+        inode = self._new_inode(filename, current, False)
+        self.mtime[inode] = int(time.time())
+        self._account(current, 0, 1)
+
+    def save(self, path=None):
+        target = path or self.tar_path
+        _write_tar(target, self.tar_path, self._save_entries())
+        if os.path.abspath(target) == os.path.abspath(self.tar_path):
+            if self._journal is not None:
+                self._journal.clear()
+            cwd = self.current_path
+            self.load_tar(self.tar_path)
+            self.current_path = cwd
+        return target
+
+    def _save_entries(self):
+        stack = [((), self.ROOT)]
+        while stack:
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                raise CommandCancelled()
+            parts, inode = stack.pop()
+            if parts:
+                header = self.header[inode] if self.header[inode] >= 0 else None
+                if self.is_dir[inode]:
+                    yield parts, True, header, None, 0, self.mtime[inode], self.mode[inode]
+                else:
+                    offset = self.offset[inode] if self.offset[inode] >= 0 else None
+                    yield parts, False, header, offset, self.size[inode], self.mtime[inode], self.mode[inode]
+            if self.is_dir[inode]:
+                stack.extend(reversed([(parts + (self._name(child),), child) for child in self._children(inode)]))
+
+    def enter_session(self, session, shared_transactions):
+        # Транзакций у таблицы inode нет, у сессии сервера своё только текущий каталог
+        self.current_path = session.cwd
+
+    def leave_session(self, session):
+        session.cwd = self.current_path
+
+    def tree_stats(self):
+        """Размеры таблицы inode для stats: записи дерева и занятые строки таблицы (с отсоединёнными узлами)."""
+        return {
+            "entries": self.count[self.ROOT],
+            "inodes": len(self.parent) - 1,
+            "free_inodes": len(self._free),
+            "bytes": self.size[self.ROOT],
+            "name_pool_bytes": len(self.names),
+        }
+
+    def _file_extent(self, path):
+        try:
+            inode = self._lookup(self._split(path))
+        except (KeyError, NotADirectoryError):
+            raise FileNotFoundError(f"File {path} not found.")
+        if self.is_dir[inode]:
+            raise IsADirectoryError(f"{path} is a directory.")
+        return (self.offset[inode] if self.offset[inode] >= 0 else None), self.size[inode]
+
+    def stat(self, path=None):
+        parts = self._split(path or "")
+        try:
+            inode = self._lookup(parts)
+        except KeyError:
+            raise FileNotFoundError(f"Path {path} not found.")
+        return _format_stat(parts, self.is_dir[inode], self.size[inode], self.count[inode],
+                            self.mode[inode], self.mtime[inode])
+
+    def du(self, path=None, summarize=False):
+        parts = self._split(path or "")
+        try:
+            inode = self._lookup(parts)
+        except KeyError:
+            raise FileNotFoundError(f"Path {path} not found.")
+        if summarize or not self.is_dir[inode]:
+            return iter([f"{self.size[inode]}\t{_join_path(parts)}"])
+        return self._du_lines(parts, inode)
+
+    def _du_lines(self, parts, inode):
+        stack = [(parts, inode, self._children(inode))]
+        while stack:
+            parts, inode, children = stack[-1]
+            for child in children:
+                if self.is_dir[child]:
+                    stack.append((parts + (self._name(child),), child, self._children(child)))
+                    break
+            else:
+                stack.pop()
+                yield f"{self.size[inode]}\t{_join_path(parts)}"
+
+    def tree(self, path=None, prefix="", max_depth=None, limit=None):
+        return "\n".join(self.iter_tree(path, prefix, max_depth, limit))
+
+    def iter_tree(self, path=None, prefix="", max_depth=None, limit=None):
+        try:
+            inode = self._lookup(self._split(path or ""))
+        except KeyError:
+            raise FileNotFoundError(f"Path {path} not found.")
+        if not self.is_dir[inode]:
+            raise NotADirectoryError(f"{path} is not a directory.")
+        return self._tree_lines(inode, prefix, max_depth, limit)
+
+    def _tree_lines(self, inode, prefix, max_depth, limit):
+        # Обход без рекурсии: стек из [следующий потомок, префикс, глубина]
+        stack = [[self.first_child[inode], prefix, 1]]
+        emitted = 0
+        while stack:
+            frame = stack[-1]
+            child = frame[0]
+            if child == self._NONE:
+                stack.pop()
+                continue
+            if limit is not None and emitted >= limit:
+                yield f"... (output limited to {limit} entries)"
+                return
+            frame[0] = self.next_sibling[child]
+            is_last = frame[0] == self._NONE
+            yield f"{frame[1]}{'└── ' if is_last else '├── '}{self._name(child)}"
+            emitted += 1
+            if self.is_dir[child] and (max_depth is None or frame[2] < max_depth):
+                stack.append([self.first_child[child], frame[1] + ("    " if is_last else "│   "), frame[2] + 1])
+
+
+# Доступные представления дерева: вложенные словари и плоская таблица inode
+BACKENDS = {"dict": VirtualFileSystem, "inode": InodeFileSystem}
+
+
+def _last_lines(text, count):
+    """Оставляет от текста не больше count последних строк, незавершённая последняя строка тоже считается."""
+    overflow = text.count("\n") + (not text.endswith("\n")) - count
+    if overflow > 0:
+        text = text.split("\n", overflow)[-1]
+    return text
+
+
+class CommandDispatcher:
+    """
+    Разбор и выполнение команд оболочки над виртуальной файловой системой.
+    Общий для окна терминала и пакетного режима; команды самого интерфейса (clear, exit)
+    обрабатываются на их стороне.
+    """
+
+    TRANSACTION_MESSAGES = {
+        "begin": "Транзакция начата",
+        "commit": "Изменения применены",
+        "rollback": "Изменения отменены",
+    }
+
+    # Команды, которые метрики учитывают по имени; остальное попадает в other
+    COMMANDS = ("ls", "cd", "touch", "cp", "mv", "rm", "cat", "head", "tail", "wc", "save", "stats", "stat", "du",
+                "find", "tree", "begin", "commit", "rollback", "snapshot", "restore", "profile")
+
+    def __init__(self, vfs):
+        self.vfs = vfs
+
+    def execute(self, command):
+        """
+        Выполняет команду и отдаёт её вывод парами (текст, окончание строки).
+        Длинный вывод отдаётся порциями, между которыми вызывающая сторона может прервать команду.
+        Время выполнения (без ожидания между порциями вывода) записывается в метрики vfs.
+        """
+        name = command.split(maxsplit=1)[0] if command.strip() else ""
+        if not name:
+            return
+        name = name if name in self.COMMANDS else "other"
+        output = self._execute(command)
+        elapsed = 0.0
+        failed = True
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(output)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield item
+            failed = False
+        finally:
+            self.vfs.metrics.record(name, elapsed, failed)
+
+    def _execute(self, command):
+        name = command.split(maxsplit=1)[0]
+        if name in self.COMMANDS and name not in ("stats", "profile") and not hasattr(self.vfs, name):
+            # Например, транзакций и снимков нет у представления inode
+            backend = next((key for key, cls in BACKENDS.items() if isinstance(self.vfs, cls)), type(self.vfs).__name__)
+            raise ValueError(f"Команда {name} не поддерживается представлением {backend}")
+        if command.startswith("ls"):
+            limit, offset, path = self._parse_ls_args(command[2:])
+            # Имена выводятся порциями, без склейки всего каталога в одну строку
+            names = self.vfs.iter_ls(path, limit, offset)
+            batch = list(islice(names, OUTPUT_CHUNK_LINES))
+            yield "\n".join(batch), "\n"  # пустой каталог — пустая строка, как и раньше
+            for batch in iter(lambda: list(islice(names, OUTPUT_CHUNK_LINES)), []):
+                yield "\n".join(batch), "\n"
+        elif command.startswith("cd"):
+            _, path = command.split(" ", 1)
+            self.vfs.cd(path)
+        elif command.startswith("touch"):
+            _, filename = command.split(" ", 1)
+            self.vfs.touch(filename)
+        elif command.startswith("cp") or command.startswith("mv"):
+            name, *sources = command.split()
+            if len(sources) < 2:
+                raise ValueError(f"Использование: {name} <source>... <destination>")
+            destination = sources.pop()
+            done = getattr(self.vfs, name)(sources, destination)
+            verb = "Скопировано" if name == "cp" else "Перемещено"
+            if len(sources) == 1 and len(done) == 1:
+                yield f"{verb}: {sources[0]} -> {destination}", "\n"
+            else:
+                yield f"{verb} объектов: {len(done)} -> {destination}", "\n"
+        elif command.startswith("rm"):
+            _, *paths = command.split()
+            recursive = paths[:1] == ["-r"]
+            if recursive:
+                paths = paths[1:]
+            if not paths:
+                raise ValueError("Использование: rm [-r] <path>...")
+            removed = self.vfs.rm(paths, recursive)
+            yield (f"Удалено: {paths[0]}" if len(paths) == 1 and len(removed) == 1
+                   else f"Удалено объектов: {len(removed)}"), "\n"
+        elif command.startswith("cat"):
+            _, path = command.split(" ", 1)
+            for text in self.vfs.cat(path):
+                yield text, ""
+            yield "", "\n"
+        elif command.startswith("head") or command.startswith("tail"):
+            name, *args = command.split()
+            lines, path = self._parse_line_count(args)
+            yield getattr(self.vfs, name)(path, lines), "\n"
+        elif command.startswith("wc"):
+            _, path = command.split(" ", 1)
+            yield self.vfs.wc(path), "\n"
+        elif command.startswith("save"):
+            _, *path = command.split(maxsplit=1)
+            yield f"Сохранено: {self.vfs.save(path[0] if path else None)}", "\n"
+        elif command.startswith("stats"):
+            yield _format_stats(stats_report(self.vfs)), "\n"
+        elif command.startswith("profile"):
+            yield from self._profile(command.split()[1:])
+        elif command.startswith("stat"):
+            _, *path = command.split(maxsplit=1)
+            yield self.vfs.stat(path[0] if path else None), "\n"
+        elif command.startswith("du"):
+            args = command.split()[1:]
+            summarize = "-s" in args
+            paths = [arg for arg in args if arg != "-s"]
+            if len(paths) > 1 or any(arg.startswith("-") for arg in paths):
+                raise ValueError("Использование: du [-s] [path]")
+            lines = self.vfs.du(paths[0] if paths else None, summarize)
+            for batch in iter(lambda: list(islice(lines, OUTPUT_CHUNK_LINES)), []):
+                yield "\n".join(batch), "\n"
+        elif command.startswith("find"):
+            path, name, kind = self._parse_find_args(command.split()[1:])
+            paths = self.vfs.find(path, name, kind)
+            for batch in iter(lambda: list(islice(paths, OUTPUT_CHUNK_LINES)), []):
+                yield "\n".join(batch), "\n"
+        elif command.startswith("tree"):
+            max_depth, limit, path = self._parse_tree_args(command.split()[1:])
+            lines = self.vfs.iter_tree(path, max_depth=max_depth, limit=limit)
+            for batch in iter(lambda: list(islice(lines, OUTPUT_CHUNK_LINES)), []):
+                yield "\n".join(batch), "\n"
+        elif command.strip() in self.TRANSACTION_MESSAGES:
+            getattr(self.vfs, command.strip())()
+            yield self.TRANSACTION_MESSAGES[command.strip()], "\n"
+        elif command.startswith("snapshot"):
+            _, *name = command.split(maxsplit=1)
+            if name:
+                self.vfs.snapshot(name[0])
+                yield f"Снимок сохранён: {name[0]}", "\n"
+            elif self.vfs.snapshots():
+                yield self.vfs.snapshots(), "\n"
+        elif command.startswith("restore"):
+            _, name = command.split(" ", 1)
+            self.vfs.restore(name)
+            yield f"Восстановлен снимок: {name}", "\n"
+        elif command.strip():
+            yield f"Неизвестная команда: {command}", "\n"
+
+    def _profile(self, args):
+        """
+        profile [--memory] <команда>: выполняет одну команду под cProfile и выводит самые дорогие функции
+        или, с --memory, под tracemalloc и выводит пик памяти и строки, выделившие больше всего.
+        Вывод самой команды отбрасывается.
+        """
+        memory = args[:1] == ["--memory"]
+        command = " ".join(args[1:] if memory else args)
+        if not command or command.split()[0] == "profile":
+            raise ValueError("Использование: profile [--memory] <команда>")
+        if not memory:
+            profiler = cProfile.Profile()
+            profiler.runcall(lambda: deque(self.execute(command), maxlen=0))
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            yield report.getvalue().strip("\n"), "\n"
+            return
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        try:
+            before = tracemalloc.take_snapshot()
+            deque(self.execute(command), maxlen=0)
+            peak = tracemalloc.get_traced_memory()[1]
+            top = tracemalloc.take_snapshot().compare_to(before, "lineno")[:PROFILE_LINES]
+        finally:
+            if started:
+                tracemalloc.stop()
+        yield f"Пик памяти: {peak / 1024:.1f} КБ", "\n"
+        yield "\n".join(str(line) for line in top), "\n"
+
+    def complete(self, line):
+        """
+        Дополнение по Tab. Первое слово дополняется по именам команд, остальные — как пути.
+        Возвращает (дополненная строка, варианты).
+        """
+        head, space, word = line.rpartition(" ")
+        if not space:
+            matches = [name for name in self.COMMANDS + ("clear", "exit") if name.startswith(word)]
+            if not matches:
+                return line, []
+            return (matches[0] + " " if len(matches) == 1 else os.path.commonprefix(matches)), sorted(matches)
+        completed, matches = self.vfs.complete(word)
+        return head + space + completed, matches
+
+    @staticmethod
+    def _parse_ls_args(rest):
+        # Разбор аргументов ls: [--limit <число>] [--offset <число>] [path]; путь может содержать пробелы
+        limit, offset = None, 0
+        parts = rest.split(maxsplit=2)
+        while parts and parts[0] in ("--limit", "--offset"):
+            if len(parts) < 2 or not parts[1].isdigit():
+                raise ValueError("Использование: ls [--limit <число>] [--offset <число>] [path]")
+            if parts[0] == "--limit":
+                limit = int(parts[1])
+            else:
+                offset = int(parts[1])
+            parts = parts[2].split(maxsplit=2) if len(parts) == 3 else []
+        path = " ".join(parts) if parts else None
+        return limit, offset, path
+
+    @staticmethod
+    def _parse_tree_args(args):
+        # Разбор аргументов tree: [-L <глубина>] [--limit <число>] [path]
+        max_depth = limit = path = None
+        i = 0
+        while i < len(args):
+            if args[i] in ("-L", "--limit") and i + 1 < len(args):
+                value = int(args[i + 1])
+                if args[i] == "-L":
+                    max_depth = value
+                else:
+                    limit = value
+                i += 2
+            elif path is None and not args[i].startswith("-"):
+                path = args[i]
+                i += 1
+            else:
+                raise ValueError("Использование: tree [-L <глубина>] [--limit <число>] [path]")
+        return max_depth, limit, path
+
+    @staticmethod
+    def _parse_find_args(args):
+        # Разбор аргументов find: [path] [-name <шаблон>] [-type f|d]
+        path = name = kind = None
+        i = 0
+        while i < len(args):
+            if args[i] == "-name" and i + 1 < len(args):
+                name = args[i + 1]
+                i += 2
+            elif args[i] == "-type" and i + 1 < len(args) and args[i + 1] in ("f", "d"):
+                kind = args[i + 1]
+                i += 2
+            elif path is None and i == 0 and not args[i].startswith("-"):
+                path = args[i]
+                i += 1
+            else:
+                raise ValueError("Использование: find [path] [-name <шаблон>] [-type f|d]")
+        return path, name, kind
+
+    @staticmethod
+    def _parse_line_count(args):
+        # Разбор аргументов head/tail: [-n <число>] <path>
+        lines = 10
+        if len(args) == 3 and args[0] == "-n":
+            lines = int(args[1])
+            args = args[2:]
+        if len(args) != 1:
+            raise ValueError("Использование: head|tail [-n <число>] <path>")
+        return lines, args[0]
+
+
+def run_headless(vfs, commands, out, echo=False):
+    """
+    Выполняет команды без графического интерфейса.
+    commands — итерируемый источник строк (файл сценария, stdin), пустые строки и комментарии (#) пропускаются,
+    exit завершает выполнение. Вывод пишется в out.
+    Возвращает (число команд, число ошибок, затраченное время в секундах).
+    """
+    dispatcher = CommandDispatcher(vfs)
+    count = errors = 0
+    started = time.perf_counter()
+    for line in commands:
+        command = line.rstrip("\r\n")
+        if not command.strip() or command.lstrip().startswith("#"):
+            continue
+        if command.strip() == "exit":
+            break
+        count += 1
+        if echo:
+            out.write(f"$ {command}\n")
+        try:
+            for text, end in dispatcher.execute(command):
+                out.write(text + end)
+        except Exception as e:
+            errors += 1
+            out.write(f"Ошибка: {str(e)}\n")
+    return count, errors, time.perf_counter() - started
+
+
+class _Session:
+    """
+    Сессия сервера: у клиента свои только имя пользователя и текущий каталог, дерево общее.
+    Пока открыта транзакция, у сессии ещё и своё дерево root — неприменённые изменения видны только ей.
+    """
+    __slots__ = ("user", "cwd", "transaction", "root")
+
+    def __init__(self, user, cwd="/"):
+        self.user = user
+        self.cwd = cwd
+        self.transaction = None
+        self.root = None
+
+    def prompt(self):
+        return f"{self.user}@vfs:{self.cwd}$ "
+
+
+class SessionServer:
+    """
+    Асинхронный сервер: много клиентов работают с одним загруженным деревом.
+    Протокол строковый: первая строка клиента — имя пользователя, дальше — команды, как в терминале;
+    после вывода каждой команды сервер присылает приглашение. exit или закрытие соединения завершают сессию.
+    Все команды всех сессий выполняются по шагам в одном рабочем потоке, поэтому изменения дерева
+    не пересекаются. На время шага в дерево подставляется текущий каталог сессии, а после шага
+    запоминается обратно. Длинный вывод отдаётся порциями; между порциями выполняются команды
+    других сессий, а медленный клиент задерживает только себя. Если представление не изолирует
+    незавершённый вывод от изменений (ISOLATED_OUTPUT), вывод команды собирается за один шаг.
+    Сессия с открытой транзакцией работает со своим деревом, остальные видят только применённое;
+    commit подменяет общее дерево деревом сессии, если за время транзакции его никто не менял.
+    """
+
+    def __init__(self, vfs):
+        self.vfs = vfs
+        self.dispatcher = CommandDispatcher(vfs)
+        self.sessions = set()
+        self._transactions = 0  # сколько сессий сейчас в транзакции
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vfs-server")
+
+    async def start(self, address):
+        """Начинает слушать address: "host:port" — TCP, иначе путь Unix-сокета. Возвращает asyncio.Server."""
+        host, _, port = address.rpartition(":")
+        if host and port.isdigit():
+            return await asyncio.start_server(self.handle, host, int(port))
+        return await asyncio.start_unix_server(self.handle, address)
+
+    def _step(self, session, output):
+        # Один шаг команды сессии в рабочем потоке; None — команда завершилась.
+        # Между шагами в vfs лежит общее применённое дерево, на время шага — дерево и состояние сессии
+        transaction = session.transaction
+        self.vfs.enter_session(session, self._transactions)
+        try:
+            if self.vfs.ISOLATED_OUTPUT:
+                return next(output, None)
+            text = "".join(item[0] + item[1] for item in output)
+            return (text, "") if text else None
+        finally:
+            self.vfs.leave_session(session)
+            self._transactions += (session.transaction is not None) - (transaction is not None)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        session = None
+        try:
+            user = (await reader.readline()).decode("utf-8", "replace").strip()
+            if not user:
+                return
+            session = _Session(user)
+            self.sessions.add(session)
+            writer.write(f"Добро пожаловать, {user}!\n{session.prompt()}".encode())
+            await writer.drain()
+            while line := await reader.readline():
+                command = line.decode("utf-8", "replace").rstrip("\r\n")
+                if command.strip() == "exit":
+                    break
+                output = self.dispatcher.execute(command)
+                try:
+                    while (item := await loop.run_in_executor(self._executor, self._step, session, output)) is not None:
+                        writer.write((item[0] + item[1]).encode("utf-8", "surrogateescape"))
+                        await writer.drain()
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    writer.write(f"Ошибка: {str(e)}\n".encode())
+                finally:
+                    await loop.run_in_executor(self._executor, output.close)
+                writer.write(session.prompt().encode("utf-8", "surrogateescape"))
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass  # клиент отключился или прислал слишком длинную строку
+        finally:
+            # Незавершённая транзакция отключившегося клиента просто отбрасывается
+            if session is not None and session.transaction is not None:
+                self._transactions -= 1
+            self.sessions.discard(session)
+            writer.close()
+
+
+def run_server(vfs, address):
+    """Обслуживает клиентов на address, пока процесс не остановят."""
+    async def serve():
+        server = await SessionServer(vfs).start(address)
+        print(f"Сервер слушает {address}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
 
 
 class TerminalGUI:
-    def __init__(self, user, tar_path):
-        self.vfs = VirtualFileSystem(tar_path)
+    def __init__(self, user, tar_path, backend="dict", scrollback=DEFAULT_SCROLLBACK, journal=True):
+        self.vfs = None  # создаётся в фоновом потоке
         self.user = user
+        # История ограничена scrollback строками, вывод копится и сбрасывается в виджет раз за кадр
+        self.scrollback = scrollback
+        self._pending_output = []
+        self._flush_job = None
 
         # Создание окна GUI
         self.root = tk.Tk()
@@ -277,74 +3406,185 @@ class TerminalGUI:
         self.command_entry = tk.Entry(self.root, width=60)
         self.command_entry.grid(row=1, column=0, padx=10, pady=10)
         self.command_entry.bind("<Return>", self.process_command)
+        self.command_entry.bind("<Tab>", self.complete_command)
 
         # Кнопка отправки команды
         self.send_button = tk.Button(self.root, text="Send", command=self.process_command)
         self.send_button.grid(row=1, column=1, padx=10, pady=10)
 
+        # Строка состояния: что выполняется сейчас и сколько команд ждёт в очереди
+        self.status_label = tk.Label(self.root, anchor="w")
+        self.status_label.grid(row=2, column=0, columnspan=2, padx=10, sticky="we")
+        self.root.bind("<Control-c>", self.cancel_command)
+
         self.print_output(f"Добро пожаловать, {self.user}!")
         self.print_output(
-            "Введите команду. Доступные команды: ls, cd <path>, touch <filename>, cp <source> <destination>, "
-            "mv <source> <destination>, exit")
-        self.print_output(f"{self.user}@vfs:{self.vfs.current_path}$", end=" ")
+            "Введите команду. Доступные команды: ls, cd <path>, touch <filename>, cp <source>... <destination>, "
+            "mv <source>... <destination>, rm [-r] <path>..., cat <path>, head [-n N] <path>, tail [-n N] <path>, wc <path>, "
+            "tree [-L N] [--limit N] [path], clear, exit. Ctrl+C прерывает выполняемую команду, "
+            "Tab дополняет команды и пути.")
+
+        # Загрузка архива и команды выполняются в фоновом потоке, цикл Tk только забирает результаты из очереди.
+        # Очередь результатов ограничена: если окно не успевает выводить, поток команд ждёт.
+        self._commands = queue.Queue()
+        self._results = queue.Queue(maxsize=RESULT_QUEUE_SIZE)
+        self._cancel = threading.Event()
+        self._running = "загрузка архива"
+        self._started = time.monotonic()
+        self._spinner = 0
+        self._worker = threading.Thread(target=self._work, args=(backend, tar_path, journal), daemon=True)
+        self._worker.start()
+        self._poll_results()
 
     def print_output(self, text, end="\n"):
         """
         Вывод текста в текстовую область эмулятора.
+        Текст не вставляется сразу: все выводы за кадр собираются и попадают в виджет одним обновлением.
         :param text: Текст для вывода.
         :param end: Окончание строки (по умолчанию "\n").
         """
+        self._pending_output.append(text + end)  # Используем заданное окончание строки
+        if self._flush_job is None:
+            self._flush_job = self.root.after(OUTPUT_FRAME_MS, self._flush_output)
+
+    def _flush_output(self):
+        # Одно обновление виджета на все накопленные выводы
+        self._flush_job = None
+        text = _last_lines("".join(self._pending_output), self.scrollback)
+        self._pending_output.clear()
+
         self.output_area.configure(state='normal')
-        self.output_area.insert(tk.END, text + end)  # Используем заданное окончание строки
+        self.output_area.insert(tk.END, text)
+        # Самые старые строки вытесняются, как в кольцевом буфере
+        excess = int(self.output_area.index("end-1c").split(".")[0]) - self.scrollback
+        if excess > 0:
+            self.output_area.delete("1.0", f"{excess + 1}.0")
         self.output_area.configure(state='disabled')
         self.output_area.see(tk.END)
 
+    def clear_output(self):
+        # Очищает историю терминала вместе с ещё не выведенным текстом
+        self._pending_output.clear()
+        self.output_area.configure(state='normal')
+        self.output_area.delete("1.0", tk.END)
+        self.output_area.configure(state='disabled')
+
+    def print_prompt(self, path):
+        self.print_output(f"{self.user}@vfs:{path}$ ", end="")
+
     def process_command(self, event=None):
-        # Your command processing logic here
-        pass
+        # Команда ставится в очередь; если поток занят, она выполнится после текущей
         command = self.command_entry.get()
         self.command_entry.delete(0, tk.END)
+        self._commands.put(command)
 
-        if command.strip():
-            self.print_output(command)
-
-        try:
-            if command.startswith("ls"):
-                # Разделить команду на части
-                parts = command.split(maxsplit=1)
-                if len(parts) == 1:  # Если путь не указан
-                    path = None
-                else:  # Если путь указан
-                    path = parts[1]
-
-                # Выполнить ls с переданным путём
-                result = self.vfs.ls(path)
-                self.print_output(result)
-            elif command.startswith("cd"):
-                _, path = command.split(" ", 1)
-                self.vfs.cd(path)
-            elif command.startswith("touch"):
-                _, filename = command.split(" ", 1)
-                self.vfs.touch(filename)
-            elif command.startswith("cp"):
-                _, source, destination = command.split(" ", 2)
-                self.vfs.cp(source, destination)
-                self.print_output(f"Скопировано: {source} -> {destination}")
-            elif command.startswith("mv"):
-                _, source, destination = command.split(" ", 2)
-                self.vfs.mv(source, destination)
-                self.print_output(f"Перемещено: {source} -> {destination}")
-            elif command.startswith("tree"):
-                result = self.vfs.tree()
-                self.print_output(result)
-            elif command == "exit":
-                self.root.quit()
-            else:
-                self.print_output(f"Неизвестная команда: {command}")
+    def complete_command(self, event=None):
+        # Дополнение считается в потоке команд, где живёт дерево; ответ применится, если строку не успели изменить
+        self._commands.put(("complete", self.command_entry.get()))
+        return "break"  # Tab не переводит фокус на кнопку
+
+    def cancel_command(self, event=None):
+        # Ctrl+C: выполняемая команда прерывается при следующей проверке флага
+        if self._running is not None:
+            self._cancel.set()
+
+    def _post(self, *message):
+        self._results.put(message)
+
+    def _work(self, backend, tar_path, journal):
+        """Фоновый поток: загружает архив, затем по очереди выполняет команды."""
+        try:
+            vfs = BACKENDS[backend](tar_path, journal=journal)
         except Exception as e:
-            self.print_output(f"Ошибка: {str(e)}")
+            self._post("fatal", f"Ошибка загрузки архива: {e}")
+            return
+        vfs.cancel_event = self._cancel
+        self.vfs = vfs
+        dispatcher = CommandDispatcher(vfs)
+        self._post("done", vfs.current_path)
+
+        while True:
+            command = self._commands.get()
+            if isinstance(command, tuple):  # ("complete", строка)
+                try:
+                    completed, matches = dispatcher.complete(command[1])
+                except Exception:
+                    continue  # не удалось дополнить — строка остаётся как есть
+                self._post("completion", command[1], completed, matches, vfs.current_path)
+                continue
+            self._cancel.clear()
+            self._post("start", command)
+            if command.strip() == "exit":
+                self._post("exit")
+                return
+            if command.strip() == "clear":
+                self._post("clear")
+                self._post("done", vfs.current_path)
+                continue
+            try:
+                for text, end in dispatcher.execute(command):
+                    if self._cancel.is_set():
+                        raise CommandCancelled()
+                    self._post("output", text, end)
+            except CommandCancelled as e:
+                self._post("output", f"^C {e}", "\n")
+            except Exception as e:
+                self._post("output", f"Ошибка: {str(e)}", "\n")
+            self._post("done", vfs.current_path)
 
-        self.print_output(f"{self.user}@vfs:{self.vfs.current_path}$ ", end="")
+    def _poll_results(self):
+        # Забираем всё, что успел передать фоновый поток, и обновляем строку состояния
+        try:
+            while True:
+                kind, *args = self._results.get_nowait()
+                if kind == "output":
+                    self.print_output(*args)
+                elif kind == "start":
+                    self._running, self._started = args[0], time.monotonic()
+                    if args[0].strip():
+                        self.print_output(args[0])
+                elif kind == "done":
+                    self._running = None
+                    self.print_prompt(args[0])
+                elif kind == "completion":
+                    self._apply_completion(*args)
+                elif kind == "clear":
+                    self.clear_output()
+                elif kind == "fatal":
+                    self._running = None
+                    self.print_output(args[0])
+                    self.command_entry.configure(state='disabled')
+                elif kind == "exit":
+                    self.root.quit()
+                    return
+        except queue.Empty:
+            pass
+        self._show_status()
+        self.root.after(POLL_MS, self._poll_results)
+
+    def _apply_completion(self, line, completed, matches, path):
+        if self.command_entry.get() != line:
+            return
+        if completed != line:
+            self.command_entry.delete(0, tk.END)
+            self.command_entry.insert(0, completed)
+            self.command_entry.icursor(tk.END)
+        elif len(matches) > 1:
+            # Дополнять нечего — показываем варианты и заново выводим приглашение
+            self.print_output("\n" + "  ".join(matches))
+            self.print_prompt(path)
+
+    def _show_status(self):
+        queued = self._commands.qsize()
+        if self._running is None:
+            status = ""
+        else:
+            self._spinner = (self._spinner + 1) % len(SPINNER)
+            elapsed = time.monotonic() - self._started
+            status = f"{SPINNER[self._spinner]} {self._running} — {elapsed:.1f} с"
+        if queued:
+            status += f"   в очереди: {queued}"
+        self.status_label.configure(text=status)
 
     def run(self):
         self.root.mainloop()
@@ -352,12 +3592,67 @@ class TerminalGUI:
 
 def main():
     parser = argparse.ArgumentParser(description="Эмулятор виртуальной файловой системы.")
-    parser.add_argument('--user', required=True, help="Имя пользователя для отображения в эмуляторе.")
-    parser.add_argument('--tar', required=True, help="Путь к tar-архиву виртуальной файловой системы.")
+    parser.add_argument('--user', help="Имя пользователя для отображения в эмуляторе.")
+    parser.add_argument('--tar', required=True, nargs='+',
+                        help="Путь к tar-архиву виртуальной файловой системы. Несколько архивов "
+                             "монтируются слоями: первый — нижний, последний — верхний.")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default="dict",
+                        help="Представление дерева в памяти: вложенные словари или компактная таблица inode.")
+    parser.add_argument('--scrollback', type=int, default=DEFAULT_SCROLLBACK,
+                        help="Сколько строк истории хранит окно терминала.")
+    # В окне журнал включён по умолчанию; пакетный режим и сервер ведут его только по --journal,
+    # иначе повторный запуск сценария применял бы к архиву изменения прошлого запуска
+    journal = parser.add_mutually_exclusive_group()
+    journal.add_argument('--journal', action='store_true',
+                         help="В пакетном режиме и в режиме сервера записывать изменения в журнал рядом "
+                              "с архивом и применять его при загрузке.")
+    journal.add_argument('--no-journal', action='store_true',
+                         help="Не записывать изменения в журнал рядом с архивом и не применять его при загрузке.")
+    parser.add_argument('--script', help="Выполнить команды из файла без графического интерфейса.")
+    parser.add_argument('--headless', action='store_true',
+                        help="Читать команды со стандартного ввода без графического интерфейса.")
+    parser.add_argument('--echo', action='store_true', help="В пакетном режиме печатать каждую команду перед выводом.")
+    parser.add_argument('--quiet', action='store_true', help="В пакетном режиме не печатать вывод команд.")
+    parser.add_argument('--rate', action='store_true',
+                        help="В пакетном режиме сообщить в stderr число команд в секунду.")
+    parser.add_argument('--serve', metavar="ADDRESS",
+                        help="Запустить сервер для многих клиентов на host:port или на пути Unix-сокета.")
+    parser.add_argument('--stats-json', metavar="PATH",
+                        help="При выходе записать метрики команд, загрузки и памяти в JSON-файл.")
     args = parser.parse_args()
+    tar_path = args.tar[0] if len(args.tar) == 1 else args.tar
+
+    if args.serve:
+        vfs = BACKENDS[args.backend](tar_path, journal=args.journal)
+        run_server(vfs, args.serve)
+        if args.stats_json:
+            write_stats(vfs, args.stats_json)
+        return
+
+    if args.script or args.headless:
+        vfs = BACKENDS[args.backend](tar_path, journal=args.journal)
+        out = open(os.devnull, "w") if args.quiet else sys.stdout
+        if args.script:
+            with open(args.script, encoding="utf-8") as commands:
+                count, errors, elapsed = run_headless(vfs, commands, out, args.echo)
+        else:
+            count, errors, elapsed = run_headless(vfs, sys.stdin, out, args.echo)
+        out.flush()
+        if args.rate:
+            rate = count / elapsed if elapsed else float("inf")
+            print(f"Команд: {count}, ошибок: {errors}, время: {elapsed:.3f} с, {rate:.0f} команд/с", file=sys.stderr)
+        if args.stats_json:
+            write_stats(vfs, args.stats_json)
+        return
+
+    if not args.user:
+        parser.error("для графического интерфейса нужен --user")
     user = args.user
-    gui = TerminalGUI(user=user, tar_path=args.tar)
+    gui = TerminalGUI(user=user, tar_path=tar_path, backend=args.backend, scrollback=args.scrollback,
+                      journal=not args.no_journal)
     gui.run()
+    if args.stats_json and gui.vfs is not None:
+        write_stats(gui.vfs, args.stats_json)
 
 
 if __name__ == "__main__":
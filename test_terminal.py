@@ -1,6 +1,34 @@
 import unittest
+import asyncio
+import re
 import os
-from emulator import VirtualFileSystem
+import io
+import json
+import gzip
+import lzma
+import tarfile
+import tempfile
+import contextlib
+import threading
+import tracemalloc
+from unittest import mock
+from emulator import (VirtualFileSystem, InodeFileSystem, CommandDispatcher, CommandCancelled, INDEX_SUFFIX, JOURNAL_SUFFIX,
+                      CHECKPOINTS_SUFFIX, _CompressedData, SessionServer, _Session, _IndexRange, _last_lines,
+                      run_headless, write_stats, main, _libz)
+from benchmark import make_synthetic_tar, compare
+
+
+def make_tar(path, files, dirs=()):
+    """Создаёт tar-архив с указанными каталогами и файлами {имя: содержимое}."""
+    with tarfile.open(path, "w") as tar:
+        for name in dirs:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
 
 
 class TestVirtualFileSystem(unittest.TestCase):
@@ -165,5 +193,1342 @@ class TestVirtualFileSystem(unittest.TestCase):
         self.assertTrue(result, "Ошибка: метод 'cd' не существует в классе VirtualFileSystem")
 
 
+class TestInodeFileSystem(TestVirtualFileSystem):
+    # Компактное представление должно проходить те же тесты команд
+    def setUp(self):
+        self.vfs = InodeFileSystem(self.TAR_FILE)
+
+    def test_tree(self):
+        expected = VirtualFileSystem(self.TAR_FILE, use_index=False).tree("/archive/home")
+        self.assertEqual(self.vfs.tree("/archive/home"), expected)
+
+    def test_cp_directory_is_independent(self):
+        self.vfs.cp("/archive/home/user1", "/archive/tmp")
+        self.vfs.cd("/archive/tmp/user1/docs")
+        self.vfs.touch("new.md")
+        self.assertNotIn("new.md", self.vfs.ls("/archive/home/user1/docs").splitlines())
+
+    def test_memory_compared_to_dict_layout(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tar_path = os.path.join(tmp, "wide.tar")
+            make_tar(tar_path, {f"img/d{i % 50}/file{i}.log": b"" for i in range(2000)})
+
+            tracemalloc.start()
+            vfs = VirtualFileSystem(tar_path, use_index=False)
+            vfs.tree("/")  # разворачиваем все каталоги
+            dict_size = tracemalloc.get_traced_memory()[0]
+            del vfs
+            tracemalloc.stop()
+
+            tracemalloc.start()
+            inode_fs = InodeFileSystem(tar_path)
+            inode_size = tracemalloc.get_traced_memory()[0]
+            del inode_fs
+            tracemalloc.stop()
+
+        self.log_test("memory: dict vs inode", dict_size, inode_size)
+        self.assertLess(inode_size, dict_size / 2)
+
+    def test_large_directory_lookup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tar_path = os.path.join(tmp, "wide.tar")
+            make_tar(tar_path, {f"img/file{i:03d}": b"" for i in range(200)})
+            vfs = InodeFileSystem(tar_path)
+            vfs.cd("/img")
+            vfs.touch("new")
+            vfs.mv(["file005", "file150"], "/moved")
+            vfs.rm("file199")
+            with mock.patch.object(vfs, "_children", wraps=vfs._children) as children:
+                self.assertIn("File: /img/file100", vfs.stat("/img/file100"))
+                self.assertIn("File: /img/new", vfs.stat("/img/new"))
+                img = vfs._lookup(("img",))
+                self.assertNotIn(mock.call(img), children.call_args_list,
+                                 "Имя в большом каталоге ищется по индексу, а не перебором")
+            for path in ("/img/file005", "/img/file150", "/img/file199"):
+                with self.assertRaises(FileNotFoundError):
+                    vfs.stat(path)
+            self.assertEqual(vfs.ls("/moved").split(), ["file005", "file150"])
+
+    def test_rm_reuses_rows(self):
+        self.vfs.cd("/archive")
+        self.vfs.cp("home", "/archive/tmp")
+        rows = len(self.vfs.parent)
+        for _ in range(3):
+            self.vfs.rm("/archive/tmp/home", recursive=True)
+            self.vfs.cp("home", "/archive/tmp")
+        self.assertEqual(len(self.vfs.parent), rows, "Строки, освобождённые rm, занимаются снова")
+        self.assertEqual(self.vfs.tree("/archive/tmp/home"), self.vfs.tree("/archive/home"))
+        self.assertEqual(list(self.vfs.find("/archive/tmp", "*.txt")),
+                         ["/archive/tmp/home/user1/trinity.txt", "/archive/tmp/home/user2/demon.txt",
+                          "/archive/tmp/temp.txt"])
+
+
+class TestDeepPaths(unittest.TestCase):
+    # Путь глубже предела рекурсии, каталогов в архиве явно нет: чтение, обход и копирование не рекурсивны
+    backend = VirtualFileSystem
+    DEPTH = 1500
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tar_path = os.path.join(self.tmp.name, "deep.tar")
+        self.deep = "/".join(["d"] * self.DEPTH)
+        make_tar(self.tar_path, {self.deep + "/leaf": b"x"})
+        self.vfs = self.backend(self.tar_path, journal=False)
+
+    def test_deep_path(self):
+        self.assertEqual(self.vfs.ls("/" + self.deep), "leaf")
+        self.assertEqual(len(self.vfs.tree("/").splitlines()), self.DEPTH + 1)
+        self.assertEqual(len(list(self.vfs.du("/"))), self.DEPTH + 1)
+        self.assertEqual(list(self.vfs.find("/", "leaf")), ["/" + self.deep + "/leaf"])
+        self.vfs.cp("/d", "/copy")
+        self.assertEqual(self.vfs.ls("/copy/" + self.deep), "leaf")
+        self.assertEqual(list(self.vfs.du("/copy", True)), ["1\t/copy"])
+
+    def test_deep_layers(self):
+        # Слои с общим путём глубже предела рекурсии объединяются без рекурсии
+        upper = os.path.join(self.tmp.name, "upper.tar")
+        make_tar(upper, {self.deep + "/top": b"yy"})
+        vfs = self.backend([self.tar_path, upper], journal=False)
+        self.assertEqual(vfs.ls("/" + self.deep).split(), ["leaf", "top"])
+        self.assertEqual(list(vfs.du("/", True)), ["3\t/"])
+
+
+class TestInodeDeepPaths(TestDeepPaths):
+    backend = InodeFileSystem
+
+    @unittest.skip("представление inode не монтирует слои")
+    def test_deep_layers(self):
+        pass
+
+
+class TestPathResolver(unittest.TestCase):
+    def setUp(self):
+        self.vfs = VirtualFileSystem(TestVirtualFileSystem.TAR_FILE)
+
+    def test_relative_paths_are_normalized(self):
+        self.vfs.cd("/archive/home/user1")
+        self.vfs.cd("../user2/./")
+        self.assertEqual(self.vfs.current_path, "/archive/home/user2")
+        self.assertEqual(set(self.vfs.ls("../../etc").splitlines()), {"config.cfg", "settings.ini"})
+        self.vfs.cd("//archive/../archive/tmp/")
+        self.assertEqual(self.vfs.current_path, "/archive/tmp")
+        self.vfs.cd("../../..")
+        self.assertEqual(self.vfs.current_path, "/")
+
+    def test_repeated_lookups_are_cached(self):
+        self.vfs.ls("/archive/home/user1/docs")
+        with mock.patch.object(self.vfs, "_child", wraps=self.vfs._child) as child:
+            self.vfs.ls("/archive/home/user1/docs")
+            self.vfs.cd("/archive/home/user1/docs")
+            self.assertEqual(child.call_count, 0, "Повторный разбор пути не должен спускаться от корня")
+
+    def test_mutation_invalidates_cache(self):
+        self.vfs.ls("/archive/tmp")
+        self.vfs.mv("/archive/tmp", "/archive/var")
+        with self.assertRaises(FileNotFoundError):
+            self.vfs.ls("/archive/tmp")
+        self.assertIn("temp.txt", self.vfs.ls("/archive/var/tmp").splitlines())
+
+    def test_cp_into_directory_with_same_name(self):
+        with self.assertRaises(FileExistsError):
+            self.vfs.cp("/archive/home/user1/trinity.txt", "/archive/home/user1")
+
+    def test_cp_to_sibling_with_common_prefix(self):
+        self.vfs.cp("/archive/tmp", "/archive/tmp2")
+        self.assertEqual(self.vfs.ls("/archive/tmp2/tmp"), "temp.txt")
+
+
+class TestFind(unittest.TestCase):
+    def setUp(self):
+        self.vfs = VirtualFileSystem(TestVirtualFileSystem.TAR_FILE)
+
+    def find(self, path=None, name=None, kind=None):
+        return list(self.vfs.find(path, name, kind))
+
+    def test_find_by_name(self):
+        self.assertEqual(self.find("/", "system.log"), ["/archive/home/system.log", "/archive/var/log/system.log"])
+        self.assertEqual(self.find("/archive", "*.txt"),
+                         ["/archive/home/user1/trinity.txt", "/archive/home/user2/demon.txt", "/archive/tmp/temp.txt"])
+        self.assertEqual(self.find("/", "missing"), [])
+
+    def test_find_type_and_prefix(self):
+        self.assertEqual(self.find("/archive/var", kind="d"), ["/archive/var", "/archive/var/cache", "/archive/var/log"])
+        self.assertEqual(self.find("/archive/home", "user?", "d"), ["/archive/home/user1", "/archive/home/user2"])
+        self.assertEqual(self.find("/archive/var", "system.log", "f"), ["/archive/var/log/system.log"])
+        self.vfs.cd("/archive/home/user1")
+        self.assertEqual(self.find(kind="f"), ["/archive/home/user1/docs/lord.md", "/archive/home/user1/trinity.txt"])
+        with self.assertRaises(FileNotFoundError):
+            self.find("/archive/nowhere", "x")
+
+    def test_index_follows_mutations(self):
+        self.vfs.cd("/archive/tmp")
+        self.vfs.touch("new.cfg")
+        self.vfs.cp("/archive/home/user1", "/archive/var/backup")
+        self.vfs.mv("/archive/home/user2", "/archive/tmp")
+        self.assertEqual(self.find("/", "*.cfg"), ["/archive/etc/config.cfg", "/archive/tmp/new.cfg"])
+        self.assertEqual(self.find("/", "lord.md"),
+                         ["/archive/home/user1/docs/lord.md", "/archive/var/backup/user1/docs/lord.md"])
+        self.assertEqual(self.find("/", "demon.txt"), ["/archive/tmp/user2/demon.txt"])
+        self.assertEqual(self.find("/", "backup", "d"), ["/archive/var/backup"])
+
+    def test_prefix_pattern_follows_mutations(self):
+        self.assertEqual(self.find("/", "us*"), ["/archive/home/user1", "/archive/home/user2"])
+        self.vfs.cd("/archive/tmp")
+        self.vfs.touch("usage.txt")
+        self.vfs.rm("/archive/home/user2", recursive=True)
+        self.assertEqual(self.find("/", "us*"), ["/archive/home/user1", "/archive/tmp/usage.txt"])
+        self.assertEqual(self.find("/", "use[r]?", "d"), ["/archive/home/user1"])
+
+    def test_prefix_pattern_checks_only_prefixed_names(self):
+        self.find("/", "warmup*")
+        checked = []
+        compile_pattern = re.compile
+
+        def counting_compile(pattern):
+            matches = compile_pattern(pattern).match
+            return mock.Mock(match=lambda name: checked.append(name) or matches(name))
+
+        with mock.patch("emulator.re.compile", counting_compile):
+            self.assertEqual(self.find("/", "sys*"), ["/archive/home/system.log", "/archive/var/log/system.log"])
+        self.assertEqual(checked, ["system.log"], "Шаблону с буквальным началом не нужно проверять все имена")
+
+    def test_lookup_does_not_walk_tree(self):
+        self.find("/", "warmup")
+        with mock.patch.object(self.vfs, "_entries", wraps=self.vfs._entries) as entries:
+            self.assertEqual(self.find("/", "config.cfg"), ["/archive/etc/config.cfg"])
+            self.assertLessEqual(entries.call_count, 3, "Поиск по имени не должен обходить дерево")
+
+    def test_find_after_index_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tar_path = os.path.join(tmp, "a.tar")
+            make_tar(tar_path, {"img/a/conf.ini": b"", "img/b/conf.ini": b"", "img/b/c/readme": b""})
+            VirtualFileSystem(tar_path).ls("/")  # сохраняем индекс архива
+            vfs = VirtualFileSystem(tar_path)
+            vfs.mv("/img/a", "/img/b/c")
+            self.assertEqual(list(vfs.find("/", "conf.ini")), ["/img/b/c/a/conf.ini", "/img/b/conf.ini"])
+
+    def test_dispatcher(self):
+        dispatcher = CommandDispatcher(self.vfs)
+        output = "".join(text + end for text, end in dispatcher.execute("find /archive/etc -name *.ini"))
+        self.assertEqual(output, "/archive/etc/settings.ini\n")
+        with self.assertRaises(ValueError):
+            list(dispatcher.execute("find -type x"))
+
+
+class TestInodeFind(TestFind):
+    def setUp(self):
+        self.vfs = InodeFileSystem(TestVirtualFileSystem.TAR_FILE)
+
+    def test_lookup_does_not_walk_tree(self):
+        self.find("/", "warmup")
+        with mock.patch.object(self.vfs, "_children", wraps=self.vfs._children) as children:
+            self.assertEqual(self.find("/", "config.cfg"), ["/archive/etc/config.cfg"])
+            self.assertEqual(children.call_count, 0, "Поиск по имени не должен обходить дерево")
+
+    @unittest.skip("у таблицы inode нет индекса архива на диске")
+    def test_find_after_index_load(self):
+        pass
+
+    @unittest.skip("у таблицы inode имена отбираются по общему отсортированному массиву, а не по индексу имён")
+    def test_prefix_pattern_checks_only_prefixed_names(self):
+        pass
+
+
+class TestStat(unittest.TestCase):
+    def setUp(self):
+        self.vfs = VirtualFileSystem(TestVirtualFileSystem.TAR_FILE)
+
+    def stat_field(self, path, field):
+        for line in self.vfs.stat(path).splitlines():
+            if line.strip().startswith(field + ":"):
+                return line.split(":", 1)[1].strip()
+
+    def assert_totals(self, path):
+        # Итоги каталога должны совпадать с пересчётом по всем его файлам
+        files = list(self.vfs.find(path, kind="f"))
+        size = sum(int(self.stat_field(file, "Size")) for file in files)
+        self.assertEqual(int(self.stat_field(path, "Size")), size, path)
+        self.assertEqual(int(self.stat_field(path, "Entries")), len(list(self.vfs.find(path))) - 1, path)
+
+    def test_stat(self):
+        self.assertEqual(self.stat_field("/archive/etc", "Type"), "directory")
+        self.assertEqual(self.stat_field("/archive/etc", "Entries"), "2")
+        self.assertEqual(self.stat_field("/archive/home/user1/trinity.txt", "Type"), "regular file")
+        self.assertEqual(self.stat_field("/archive/home/user1/trinity.txt", "Size"),
+                         str(sum(len(chunk) for chunk in VirtualFileSystem(TestVirtualFileSystem.TAR_FILE)
+                                 .iter_file("/archive/home/user1/trinity.txt"))))
+        self.assertIsNone(self.stat_field("/archive/tmp/temp.txt", "Entries"))
+        with self.assertRaises(FileNotFoundError):
+            self.vfs.stat("/archive/nowhere")
+
+    def test_totals_follow_mutations(self):
+        for path in ("/", "/archive/home", "/archive/var"):
+            self.assert_totals(path)
+        self.vfs.cp("/archive/home", "/archive/tmp/backup")
+        self.vfs.mv("/archive/etc", "/archive/var/old")
+        self.vfs.cd("/archive/var/old/etc")
+        self.vfs.touch("new.cfg")
+        for path in ("/", "/archive/home", "/archive/tmp", "/archive/tmp/backup", "/archive/var/old/etc"):
+            self.assert_totals(path)
+
+    def test_du(self):
+        self.vfs.cd("/archive/var")
+        lines = [line.split("\t") for line in self.vfs.du()]
+        self.assertEqual([path for _, path in lines], ["/archive/var/cache", "/archive/var/log", "/archive/var"])
+        self.assertEqual(list(self.vfs.du("/", summarize=True)), [f"{self.stat_field('/', 'Size')}\t/"])
+        dispatcher = CommandDispatcher(self.vfs)
+        output = "".join(text + end for text, end in dispatcher.execute("du -s /archive/var/cache"))
+        self.assertEqual(output, "0\t/archive/var/cache\n")
+
+    def test_du_summary_does_not_walk_tree(self):
+        self.vfs.ls("/")
+        with mock.patch.object(self.vfs, "_entries", wraps=self.vfs._entries) as entries:
+            list(self.vfs.du("/", summarize=True))
+            self.assertEqual(entries.call_count, 0)
+
+    def test_metadata_survives_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tar_path = os.path.join(tmp, "a.tar")
+            with tarfile.open(tar_path, "w") as tar:
+                info = tarfile.TarInfo("img/run.sh")
+                info.size, info.mode, info.mtime = 4, 0o750, 1700000000
+                tar.addfile(info, io.BytesIO(b"echo"))
+            first = VirtualFileSystem(tar_path)
+            expected = first.stat("/img/run.sh"), first.stat("/img")
+            vfs = VirtualFileSystem(tar_path)
+            self.assertIsNone(vfs._scanner, "Дерево должно загрузиться из индекса")
+            self.assertEqual((vfs.stat("/img/run.sh"), vfs.stat("/img")), expected)
+            self.assertIn("-rwxr-x--- (0750)", expected[0])
+
+
+class TestInodeStat(TestStat):
+    def setUp(self):
+        self.vfs = InodeFileSystem(TestVirtualFileSystem.TAR_FILE)
+
+    def test_du_summary_does_not_walk_tree(self):
+        with mock.patch.object(self.vfs, "_children", wraps=self.vfs._children) as children:
+            list(self.vfs.du("/", summarize=True))
+            self.assertEqual(children.call_count, 0)
+
+    @unittest.skip("у таблицы inode нет индекса архива на диске")
+    def test_metadata_survives_index(self):
+        pass
+
+
+class TestJournal(unittest.TestCase):
+    BACKEND = VirtualFileSystem
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tar_path = os.path.join(self.tmp.name, "archive.tar")
+        with open(TestVirtualFileSystem.TAR_FILE, "rb") as src, open(self.tar_path, "wb") as dst:
+            dst.write(src.read())
+
+    def open(self, path=None):
+        return self.BACKEND(path or self.tar_path, journal=True)
+
+    def edit(self, vfs):
+        vfs.cp("/archive/home/user1", "/archive/tmp")
+        vfs.mv("/archive/etc", "/archive/var/old")
+        vfs.cd("/archive/var")
+        vfs.touch("new.txt")
+
+    def test_journal_is_replayed(self):
+        vfs = self.open()
+        self.edit(vfs)
+        reopened = self.open()
+        self.assertEqual(reopened.tree("/"), vfs.tree("/"))
+        self.assertNotEqual(self.BACKEND(self.tar_path).tree("/"), vfs.tree("/"), "Без журнала архив не меняется")
+
+    def test_journal_of_other_archive_is_ignored(self):
+        self.edit(self.open())
+        with open(self.tar_path + JOURNAL_SUFFIX, "a", encoding="utf-8") as f:
+            f.write('["touch", "/archive", "hal')  # недописанная строка
+        self.assertIn("new.txt", self.open().ls("/archive/var").split())
+        make_tar(self.tar_path, {"other/file": b"x"})
+        vfs = self.open()
+        self.assertEqual(vfs.ls("/"), "other")
+        vfs.cd("/other")
+        vfs.touch("a")
+        self.assertEqual(self.open().ls("/other").split(), ["a", "file"])
+
+    def test_save_without_changes_copies_archive(self):
+        target = os.path.join(self.tmp.name, "copy.tar")
+        self.BACKEND(self.tar_path).save(target)
+        with open(self.tar_path, "rb") as a, open(target, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_save_writes_only_changed_entries(self):
+        vfs = self.open()
+        self.edit(vfs)
+        target = os.path.join(self.tmp.name, "saved.tar")
+        with mock.patch.object(tarfile.TarInfo, "tobuf", autospec=True, side_effect=tarfile.TarInfo.tobuf) as tobuf:
+            vfs.save(target)
+        # Новые заголовки: копия user1 (4 записи), перемещённый etc (3 записи), каталог old и new.txt
+        self.assertEqual(tobuf.call_count, 9)
+        saved = self.BACKEND(target)
+        self.assertEqual(saved.tree("/"), vfs.tree("/"))
+        with tarfile.open(target) as tar:
+            member = tar.getmember("archive/var/old/etc/settings.ini")
+            self.assertEqual(tar.extractfile(member).read().splitlines()[0], b"[General]")
+
+    def test_save_in_place_clears_journal(self):
+        vfs = self.open()
+        self.edit(vfs)
+        expected = vfs.tree("/")
+        self.assertEqual(list(CommandDispatcher(vfs).execute("save")), [(f"Сохранено: {self.tar_path}", "\n")])
+        self.assertFalse(os.path.exists(self.tar_path + JOURNAL_SUFFIX))
+        self.assertEqual(vfs.current_path, "/archive/var")
+        self.assertEqual(vfs.tree("/"), expected)
+        self.assertEqual(self.BACKEND(self.tar_path).tree("/"), expected)
+
+
+class TestInodeJournal(TestJournal):
+    BACKEND = InodeFileSystem
+
+
+class TestCopyOnWrite(unittest.TestCase):
+    def setUp(self):
+        self.vfs = VirtualFileSystem(TestVirtualFileSystem.TAR_FILE)
+
+    def node(self, path):
+        return self.vfs._resolve(path)[1]
+
+    def test_cp_shares_subtree(self):
+        self.vfs.cp("/archive/home", "/archive/tmp")
+        self.assertIs(self.node("/archive/tmp/home"), self.node("/archive/home"),
+                      "Копия каталога должна разделять узел с источником")
+
+    def test_write_into_copy_keeps_source_intact(self):
+        self.vfs.cp("/archive/home", "/archive/tmp")
+        self.vfs.cd("/archive/tmp/home/user1/docs")
+        self.vfs.touch("draft.md")
+        self.assertIn("draft.md", self.vfs.ls("/archive/tmp/home/user1/docs").splitlines())
+        self.assertNotIn("draft.md", self.vfs.ls("/archive/home/user1/docs").splitlines())
+
+    def test_write_into_source_keeps_copy_intact(self):
+        self.vfs.cp("/archive/home", "/archive/tmp")
+        self.vfs.mv("/archive/home/user2", "/archive/var")
+        self.assertIn("user2", self.vfs.ls("/archive/tmp/home").splitlines())
+        self.assertNotIn("user2", self.vfs.ls("/archive/home").splitlines())
+
+    def test_write_deep_into_source_keeps_copy_intact(self):
+        # Каталоги под общим узлом не заморожены, но менять их на месте нельзя: они тоже общие
+        self.vfs.cp("/archive/home", "/archive/tmp")
+        self.vfs.cd("/archive/home/user1/docs")
+        self.vfs.touch("draft.md")
+        self.assertNotIn("draft.md", self.vfs.ls("/archive/tmp/home/user1/docs").splitlines())
+        self.assertIn("draft.md", self.vfs.ls("/archive/home/user1/docs").splitlines())
+
+    def test_move_out_of_copy_keeps_copy_intact(self):
+        self.vfs.cp("/archive/home", "/archive/tmp")
+        count = self.node("/archive/tmp/home").count
+        self.vfs.mv("/archive/home/user1", "/archive/var")
+        self.vfs.cd("/archive/var/user1")
+        self.vfs.touch("leak.txt")
+        self.assertIn("leak.txt", self.vfs.ls("/archive/var/user1").splitlines())
+        self.assertNotIn("leak.txt", self.vfs.ls("/archive/tmp/home/user1").splitlines())
+        self.assertEqual(self.node("/archive/tmp/home").count, count)
+        self.assertEqual(self.node("/archive/tmp/home/user1").count, len(list(self.vfs.find("/archive/tmp/home/user1"))) - 1)
+
+    def test_readers_and_cp_do_not_force_copies(self):
+        var = self.node("/archive/var")
+        self.vfs.tree("/archive")
+        list(self.vfs.du("/archive"))
+        list(self.vfs.find("/archive"))
+        self.vfs.cp("/archive/home/user1", "/archive/tmp")
+        self.vfs.cd("/archive/var")
+        self.vfs.touch("new.txt")
+        self.assertIs(self.node("/archive/var"), var, "Запись после вывода и cp не должна копировать каталог")
+        self.assertEqual(self.vfs._epoch, 0)
+
+    def test_changes_during_find(self):
+        paths = self.vfs.find("/archive/home")
+        self.assertEqual(next(paths), "/archive/home")
+        self.vfs.cd("/archive/home/user2")
+        self.vfs.touch("late.txt")
+        self.assertNotIn("/archive/home/user2/late.txt", list(paths))
+        self.assertIn("late.txt", self.vfs.ls("/archive/home/user2").splitlines())
+
+    def test_copy_of_copy(self):
+        self.vfs.cp("/archive/home/user1", "/archive/tmp")
+        self.vfs.cp("/archive/tmp/user1", "/archive/var")
+        self.vfs.cd("/archive/var/user1")
+        self.vfs.touch("only-here.txt")
+        self.assertNotIn("only-here.txt", self.vfs.ls("/archive/tmp/user1").splitlines())
+        self.assertNotIn("only-here.txt", self.vfs.ls("/archive/home/user1").splitlines())
+
+
+class TestTransactions(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tar_path = os.path.join(self.tmp.name, "archive.tar")
+        with open(TestVirtualFileSystem.TAR_FILE, "rb") as src, open(self.tar_path, "wb") as dst:
+            dst.write(src.read())
+        self.vfs = VirtualFileSystem(self.tar_path, journal=True)
+        self.original = self.vfs.tree("/")
+
+    def edit(self):
+        self.vfs.cp("/archive/home/user1", "/archive/tmp")
+        self.vfs.mv("/archive/etc", "/archive/var/old")
+        self.vfs.cd("/archive/var/old")
+        self.vfs.touch("new.txt")
+
+    def test_rollback(self):
+        self.vfs.begin()
+        self.edit()
+        self.assertNotEqual(self.vfs.tree("/"), self.original)
+        self.vfs.rollback()
+        self.assertEqual(self.vfs.tree("/"), self.original)
+        self.assertEqual(self.vfs.current_path, "/")
+        self.assertEqual(list(self.vfs.find("/", "etc")), ["/archive/etc"])
+        self.assertFalse(os.path.exists(self.tar_path + JOURNAL_SUFFIX))
+
+    def test_commit_journals_whole_batch(self):
+        self.vfs.begin()
+        self.edit()
+        self.assertFalse(os.path.exists(self.tar_path + JOURNAL_SUFFIX), "До commit журнал не пишется")
+        self.vfs.commit()
+        edited = self.vfs.tree("/")
+        self.assertEqual(VirtualFileSystem(self.tar_path, journal=True).tree("/"), edited)
+        with self.assertRaises(ValueError):
+            self.vfs.commit()
+
+    def test_snapshots(self):
+        self.vfs.snapshot("clean")
+        self.assertIs(self.vfs._snapshots["clean"], self.vfs.filesystem, "Снимок разделяет дерево, а не копирует его")
+        self.edit()
+        edited = self.vfs.tree("/")
+        self.vfs.snapshot("edited")
+        self.vfs.restore("clean")
+        self.assertEqual(self.vfs.tree("/"), self.original)
+        self.assertEqual(list(self.vfs.find("/", "new.txt")), [])
+        self.vfs.restore("edited")
+        self.assertEqual(self.vfs.tree("/"), edited)
+        self.assertEqual(self.vfs.snapshots().split(), ["clean", "edited"])
+        # Снимки и восстановления попадают в журнал и повторяются при загрузке
+        self.vfs.restore("clean")
+        self.assertEqual(VirtualFileSystem(self.tar_path, journal=True).tree("/"), self.original)
+        with self.assertRaises(ValueError):
+            self.vfs.restore("missing")
+
+    def test_dispatcher(self):
+        dispatcher = CommandDispatcher(self.vfs)
+        run = lambda command: "".join(text + end for text, end in dispatcher.execute(command))
+        self.assertEqual(run("begin"), "Транзакция начата\n")
+        run("touch draft")
+        self.assertEqual(run("rollback"), "Изменения отменены\n")
+        self.assertNotIn("draft", self.vfs.ls("/").split())
+        self.assertEqual(run("snapshot base"), "Снимок сохранён: base\n")
+        self.assertEqual(run("snapshot"), "base\n")
+        self.assertEqual(run("restore base"), "Восстановлен снимок: base\n")
+
+
+class TestTree(unittest.TestCase):
+    HOME_TREE = "\n".join([
+        "├── system.log",
+        "├── user1",
+        "│   ├── docs",
+        "│   │   └── lord.md",
+        "│   └── trinity.txt",
+        "└── user2",
+        "    └── demon.txt",
+    ])
+
+    def setUp(self):
+        self.vfs = VirtualFileSystem(TestVirtualFileSystem.TAR_FILE)
+
+    def test_tree(self):
+        self.assertEqual(self.vfs.tree("/archive/home"), self.HOME_TREE)
+        self.assertEqual(InodeFileSystem(TestVirtualFileSystem.TAR_FILE).tree("/archive/home"), self.HOME_TREE)
+
+    def test_iter_tree_is_lazy(self):
+        lines = self.vfs.iter_tree("/archive")
+        self.assertEqual(next(lines), "├── etc")
+
+    def test_depth_limit(self):
+        self.assertEqual(self.vfs.tree("/archive/home", max_depth=1).splitlines(),
+                         ["├── system.log", "├── user1", "└── user2"])
+
+    def test_entry_limit(self):
+        lines = self.vfs.tree("/archive/home", limit=2).splitlines()
+        self.assertEqual(lines[:2], ["├── system.log", "├── user1"])
+        self.assertEqual(len(lines), 3)
+
+    def test_missing_path_fails_before_iteration(self):
+        with self.assertRaises(FileNotFoundError):
+            self.vfs.iter_tree("/archive/nonexistent")
+
+    def test_changes_during_output(self):
+        lines = self.vfs.iter_tree("/archive/home")
+        next(lines)
+        self.vfs.cd("/archive/home")
+        self.vfs.touch("late.txt")
+        self.assertEqual("\n".join(["├── system.log", *lines]), self.HOME_TREE)
+
+    def test_deeper_than_recursion_limit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tar_path = os.path.join(tmp, "deep.tar")
+            make_tar(tar_path, {"/".join(["d"] * 1500) + "/leaf.txt": b""})
+            vfs = VirtualFileSystem(tar_path, use_index=False)
+            lines = vfs.tree("/").splitlines()
+        self.assertEqual(len(lines), 1501)
+        self.assertTrue(lines[-1].endswith("└── leaf.txt"))
+
+
+class TestScrollback(unittest.TestCase):
+    def test_last_lines(self):
+        text = "".join(f"line {i}\n" for i in range(10))
+        self.assertEqual(_last_lines(text, 3), "line 7\nline 8\nline 9\n")
+        self.assertEqual(_last_lines(text, 100), text)
+        self.assertEqual(_last_lines("a\nb\nprompt$ ", 1), "prompt$ ")
+
+
+class TestHeadless(unittest.TestCase):
+    def setUp(self):
+        self.vfs = VirtualFileSystem(TestVirtualFileSystem.TAR_FILE)
+        self.dispatcher = CommandDispatcher(self.vfs)
+
+    def run_command(self, command):
+        return "".join(text + end for text, end in self.dispatcher.execute(command))
+
+    def test_dispatcher(self):
+        self.assertEqual(set(self.run_command("ls /archive").split()), {"etc", "home", "tmp", "var"})
+        self.assertEqual(self.run_command("cd /archive/home/user1"), "")
+        self.assertEqual(self.vfs.current_path, "/archive/home/user1")
+        self.assertEqual(self.run_command("cp trinity.txt docs"), "Скопировано: trinity.txt -> docs\n")
+        self.assertEqual(self.run_command("tree -L 1 docs"), "├── lord.md\n└── trinity.txt\n")
+        self.assertEqual(self.run_command("foo"), "Неизвестная команда: foo\n")
+
+    def test_script(self):
+        script = io.StringIO("# комментарий\ncd /archive/etc\n\nls\ncd nowhere\nexit\nls /\n")
+        out = io.StringIO()
+        count, errors, elapsed = run_headless(self.vfs, script, out)
+        self.assertEqual((count, errors), (3, 1))
+        self.assertEqual(out.getvalue(), "config.cfg\nsettings.ini\nОшибка: Directory nowhere not found.\n")
+        self.assertGreaterEqual(elapsed, 0)
+
+    def test_script_journal_is_opt_in(self):
+        # Без --journal сценарий можно запускать повторно; с ним второй запуск видит изменения первого
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        tar_path = os.path.join(tmp.name, "image.tar")
+        script = os.path.join(tmp.name, "script.txt")
+        make_tar(tar_path, {"etc/hosts": b"localhost\n"})
+        with open(script, "w", encoding="utf-8") as f:
+            f.write("touch a.txt\nls\n")
+
+        def run(*flags):
+            out = io.StringIO()
+            with mock.patch("sys.argv", ["emulator.py", "--tar", tar_path, "--script", script, *flags]), \
+                    contextlib.redirect_stdout(out):
+                main()
+            return out.getvalue()
+
+        for _ in range(2):
+            self.assertEqual(run(), "a.txt\netc\n")
+        self.assertFalse(os.path.exists(tar_path + JOURNAL_SUFFIX))
+        self.assertEqual(run("--journal"), "a.txt\netc\n")
+        self.assertEqual(run("--journal"), "Ошибка: File 'a.txt' already exists.\na.txt\netc\n")
+
+
+class TestCompletion(unittest.TestCase):
+    backend = VirtualFileSystem
+
+    def setUp(self):
+        self.vfs = self.backend(TestVirtualFileSystem.TAR_FILE, journal=False)
+        self.dispatcher = CommandDispatcher(self.vfs)
+
+    def run_command(self, command):
+        return "".join(text + end for text, end in self.dispatcher.execute(command))
+
+    def test_paths(self):
+        self.assertEqual(self.vfs.complete("/archive/h"), ("/archive/home/", ["home/"]))
+        self.assertEqual(self.vfs.complete("/archive/"), ("/archive/", ["etc/", "home/", "tmp/", "var/"]))
+        self.vfs.cd("/archive/etc")
+        self.assertEqual(self.vfs.complete("con"), ("config.cfg", ["config.cfg"]))
+        self.assertEqual(self.vfs.complete("x"), ("x", []))
+        self.assertEqual(self.vfs.complete("nowhere/x"), ("nowhere/x", []))
+        self.vfs.touch("config.bak")
+        self.assertEqual(self.vfs.complete("con"), ("config.", ["config.bak", "config.cfg"]))
+        self.assertEqual(self.vfs.complete("con", limit=1), ("config.", ["config.bak"]))
+
+    def test_commands(self):
+        self.assertEqual(self.dispatcher.complete("tou"), ("touch ", ["touch"]))
+        self.assertEqual(self.dispatcher.complete("st"), ("stat", ["stat", "stats"]))
+        self.assertEqual(self.dispatcher.complete("cd /archive/va"), ("cd /archive/var/", ["var/"]))
+        self.assertEqual(self.dispatcher.complete("zz"), ("zz", []))
+
+    def test_ls_paging(self):
+        self.vfs.cd("/archive")
+        for name in ("b", "a", "z"):
+            self.vfs.touch(name)
+        self.assertEqual(self.run_command("ls"), "a\nb\netc\nhome\ntmp\nvar\nz\n")
+        self.assertEqual(self.run_command("ls --limit 2 --offset 3"), "home\ntmp\n")
+        self.assertEqual(self.run_command("ls --offset 6 /archive"), "z\n")
+        self.assertEqual(self.run_command("ls --offset 10"), "\n")
+        with self.assertRaises(ValueError):
+            self.run_command("ls --limit")
+
+    def test_index_follows_changes(self):
+        self.vfs.ls("/archive")
+        self.vfs.cp("/archive/etc", "/archive/home")
+        self.vfs.mv("/archive/tmp", "/archive/var")
+        self.assertEqual(self.vfs.ls("/archive").split(), ["etc", "home", "var"])
+        self.assertIn("etc", self.vfs.ls("/archive/home").split())
+        self.assertIn("tmp", self.vfs.ls("/archive/var").split())
+
+
+class TestInodeCompletion(TestCompletion):
+    backend = InodeFileSystem
+
+
+class TestSortedNames(unittest.TestCase):
+    def test_snapshot_keeps_its_names(self):
+        vfs = VirtualFileSystem(TestVirtualFileSystem.TAR_FILE, journal=False)
+        names = vfs.ls("/archive")
+        vfs.snapshot("before")
+        vfs.cd("/archive")
+        vfs.touch("a")
+        self.assertEqual(vfs.ls("/archive").split(), ["a"] + names.split())
+        vfs.restore("before")
+        self.assertEqual(vfs.ls("/archive"), names)
+
+
+class TestBatch(unittest.TestCase):
+    backend = VirtualFileSystem
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tar_path = os.path.join(self.tmp.name, "archive.tar")
+        with open(TestVirtualFileSystem.TAR_FILE, "rb") as src, open(self.tar_path, "wb") as dst:
+            dst.write(src.read())
+        self.vfs = self.backend(self.tar_path, journal=True)
+        self.dispatcher = CommandDispatcher(self.vfs)
+
+    def run_command(self, command):
+        return "".join(text + end for text, end in self.dispatcher.execute(command))
+
+    def totals(self):
+        list(self.vfs.du("/", True))  # итоги окончательны после чтения всего архива
+        stats = self.vfs.tree_stats()
+        return stats["entries"], stats["bytes"]
+
+    def test_glob_cp(self):
+        entries, size = self.totals()
+        copied = self.vfs.cp(["/archive/home/user?/*.txt", "/archive/etc/config.cfg"], "/archive/tmp/texts")
+        self.assertEqual(copied, ["/archive/home/user1/trinity.txt", "/archive/home/user2/demon.txt",
+                                  "/archive/etc/config.cfg"])
+        self.assertEqual(self.vfs.ls("/archive/tmp/texts").split(), ["config.cfg", "demon.txt", "trinity.txt"])
+        copied_size = sum(int(line.split("\t")[0]) for path in copied for line in self.vfs.du(path, True))
+        self.assertEqual(self.totals(), (entries + 4, size + copied_size))
+
+    def test_glob_mv_and_replay(self):
+        entries, size = self.totals()
+        self.assertEqual(self.run_command("mv /archive/etc/* /archive/home/user* /archive/var"),
+                         "Перемещено объектов: 4 -> /archive/var\n")
+        self.assertEqual(self.vfs.ls("/archive/etc"), "")
+        self.assertEqual(self.vfs.ls("/archive/home"), "system.log")
+        self.assertEqual(self.vfs.ls("/archive/var").split(),
+                         ["cache", "config.cfg", "log", "settings.ini", "user1", "user2"])
+        self.assertEqual(self.totals(), (entries, size))
+        tree = self.vfs.tree("/")
+        self.assertEqual(self.backend(self.tar_path, journal=True).tree("/"), tree)
+
+    def test_conflicts_leave_tree_unchanged(self):
+        tree = self.vfs.tree("/")
+        with self.assertRaises(FileExistsError):
+            self.vfs.cp(["/archive/home/system.log", "/archive/var/log/system.log"], "/archive/tmp")
+        with self.assertRaises(FileExistsError):
+            self.vfs.mv(["/archive/tmp/temp.txt", "/archive/etc/*"], "/archive/etc")
+        with self.assertRaises(FileNotFoundError):
+            self.vfs.mv(["/archive/tmp/temp.txt", "/archive/nowhere/*"], "/archive/etc")
+        with self.assertRaises(ValueError):
+            self.vfs.mv(["/archive/home", "/archive/home/user1"], "/archive/tmp")
+        with self.assertRaises(NotADirectoryError):
+            self.vfs.cp("/archive/etc/*", "/archive/tmp/temp.txt")
+        self.assertEqual(self.vfs.tree("/"), tree)
+
+    def test_rm(self):
+        entries, size = self.totals()
+        self.assertEqual(self.run_command("rm /archive/tmp/temp.txt"), "Удалено: /archive/tmp/temp.txt\n")
+        with self.assertRaises(IsADirectoryError):
+            self.vfs.rm("/archive/home")
+        self.vfs.cd("/archive/home/user1")
+        with self.assertRaises(ValueError):
+            self.vfs.rm("/archive/home", recursive=True)
+        self.vfs.cd("/archive")
+        self.assertEqual(self.run_command("rm -r home home/user1 var/*"), "Удалено объектов: 3\n")
+        self.assertEqual(self.vfs.ls("/archive").split(), ["etc", "tmp", "var"])
+        self.assertEqual(self.vfs.ls("/archive/var"), "")
+        self.assertEqual(list(self.vfs.find("/", "*.txt")), [])
+        self.assertEqual(self.totals()[0], entries - 12)
+        with self.assertRaises(ValueError):
+            self.vfs.rm("/", recursive=True)
+        tree = self.vfs.tree("/")
+        self.assertEqual(self.backend(self.tar_path, journal=True).tree("/"), tree)
+
+    def test_hidden_names(self):
+        self.vfs.cd("/archive/tmp")
+        self.vfs.touch(".hidden")
+        self.vfs.rm("/archive/tmp/*")
+        self.assertEqual(self.vfs.ls("/archive/tmp"), ".hidden")
+        self.vfs.rm("/archive/tmp/.*")
+        self.assertEqual(self.vfs.ls("/archive/tmp"), "")
+
+
+class TestInodeBatch(TestBatch):
+    backend = InodeFileSystem
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.vfs = VirtualFileSystem(TestVirtualFileSystem.TAR_FILE, use_index=False)
+        self.dispatcher = CommandDispatcher(self.vfs)
+
+    def run_command(self, command):
+        return "".join(text + end for text, end in self.dispatcher.execute(command))
+
+    def test_commands_are_counted(self):
+        self.run_command("ls /archive")
+        self.run_command("ls")
+        with self.assertRaises(FileNotFoundError):
+            self.run_command("cd nowhere")
+        self.run_command("foo")
+        commands = self.vfs.metrics.as_dict()["commands"]
+        self.assertEqual((commands["ls"]["count"], commands["ls"]["errors"]), (2, 0))
+        self.assertEqual((commands["cd"]["count"], commands["cd"]["errors"]), (1, 1))
+        self.assertEqual(commands["other"]["count"], 1)
+        self.assertEqual(sum(commands["ls"]["histogram"].values()), 2)
+        self.assertLessEqual(commands["ls"]["p50_seconds"], commands["ls"]["max_seconds"])
+
+    def test_stats_command(self):
+        self.run_command("ls /archive")
+        output = self.run_command("stats")
+        self.assertIn("  ls: 1 (ошибок 0)", output)
+        self.assertIn("Загрузка:", output)
+        self.assertIn("  scan:", output)
+        self.assertIn("  entries: 18", output)
+        self.assertEqual(self.vfs.metrics.as_dict()["commands"]["stats"]["count"], 1)
+
+    def test_inode_stats(self):
+        vfs = InodeFileSystem(TestVirtualFileSystem.TAR_FILE)
+        output = "".join(text + end for text, end in CommandDispatcher(vfs).execute("stats"))
+        self.assertIn("  entries: 18", output)
+        self.assertIn("  scan_totals:", output)
+
+    def test_profile(self):
+        output = self.run_command("profile ls /archive")
+        self.assertIn("function calls", output)
+        self.assertNotIn("etc", output.split("\n")[0])
+        output = self.run_command("profile --memory ls /archive")
+        self.assertTrue(output.startswith("Пик памяти: "))
+        self.assertEqual(self.vfs.metrics.as_dict()["commands"]["ls"]["count"], 2)
+        with self.assertRaises(ValueError):
+            self.run_command("profile --memory")
+
+    def test_write_stats(self):
+        self.run_command("ls")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "stats.json")
+            write_stats(self.vfs, path)
+            with open(path, encoding="utf-8") as f:
+                report = json.load(f)
+        self.assertEqual(report["commands"]["ls"]["count"], 1)
+        self.assertIn("scan", report["load_phases"])
+        self.assertEqual(report["tree"]["entries"], 18)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_tar(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "synthetic.tar")
+            # 1 + 2 + 4 каталога, в каждом по 3 файла
+            self.assertEqual(make_synthetic_tar(path, depth=2, fanout=2, files_per_dir=3, name_length=6), 28)
+            vfs = VirtualFileSystem(path, use_index=False)
+            self.assertEqual(sorted(vfs.ls("/image").split()), ["d00000", "d00001", "f00000.txt", "f00001.txt", "f00002.txt"])
+            self.assertEqual(len(vfs.ls("/image/d00001/d00000").split()), 3)
+
+    def test_compare(self):
+        baseline = {"results": [{"size": "small", "operation": "ls", "seconds": 0.5, "peak_bytes": 1000}]}
+        same = [{"size": "small", "operation": "ls", "seconds": 0.55, "peak_bytes": 1100}]
+        slower = [{"size": "small", "operation": "ls", "seconds": 1.0, "peak_bytes": 1000}]
+        self.assertEqual(compare(same, baseline, 0.25), [])
+        self.assertEqual(len(compare(slower, baseline, 0.25)), 1)
+        self.assertEqual(compare([{**slower[0], "size": "large"}], baseline, 0.25), [])
+
+
+class TestLazyLoading(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tar_path = os.path.join(self.tmp.name, "image.tar")
+        make_tar(self.tar_path, {
+            "root/a/one.txt": b"1",
+            "root/b/two.txt": b"2",
+            "root/c/d/three.txt": b"3",
+        })
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_implicit_directories(self):
+        # Каталоги без собственных заголовков восстанавливаются по путям файлов
+        vfs = VirtualFileSystem(self.tar_path)
+        self.assertEqual(set(vfs.ls("/root").splitlines()), {"a", "b", "c"})
+        self.assertEqual(vfs.ls("/root/c/d"), "three.txt")
+
+    def test_cd_reads_archive_only_up_to_target(self):
+        vfs = VirtualFileSystem(self.tar_path)
+        vfs.cd("/root/a")
+        self.assertEqual(vfs.current_path, "/root/a")
+        self.assertIsNotNone(vfs._scanner, "Архив не должен дочитываться целиком ради cd")
+
+    def test_untouched_directories_stay_collapsed(self):
+        vfs = VirtualFileSystem(self.tar_path)
+        vfs.ls("/root/a")
+        root = vfs._entries(vfs.filesystem)["root"]
+        self.assertIsNotNone(root["b"].pending, "Каталог, к которому не обращались, не должен разворачиваться")
+        self.assertIsNone(root["a"].pending)
+
+
+    def test_scan_can_be_cancelled_and_resumed(self):
+        vfs = VirtualFileSystem(self.tar_path, use_index=False)
+        vfs.cancel_event = threading.Event()
+        vfs.cancel_event.set()
+        with self.assertRaises(CommandCancelled):
+            vfs.ls("/root")
+        vfs.cancel_event.clear()
+        self.assertEqual(set(vfs.ls("/root").splitlines()), {"a", "b", "c"})
+
+
+class TestIndexCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tar_path = os.path.join(self.tmp.name, "image.tar")
+        make_tar(self.tar_path, {
+            "root/etc/app.cfg": b"key=value\n",
+            "root/home/user/notes.txt": b"hello",
+        }, dirs=["root", "root/etc"])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_index_written_after_full_scan(self):
+        vfs = VirtualFileSystem(self.tar_path)
+        self.assertFalse(os.path.exists(self.tar_path + INDEX_SUFFIX))
+        vfs.ls("/root")
+        self.assertTrue(os.path.exists(self.tar_path + INDEX_SUFFIX))
+
+    def test_startup_from_index(self):
+        VirtualFileSystem(self.tar_path).ls("/")
+        vfs = VirtualFileSystem(self.tar_path)
+        self.assertIsNone(vfs._scanner, "При актуальном индексе заголовки архива читаться не должны")
+        self.assertIsInstance(vfs.filesystem.pending, _IndexRange)
+        self.assertEqual(set(vfs.ls("/root").splitlines()), {"etc", "home"})
+        self.assertEqual(vfs.ls("/root/home/user"), "notes.txt")
+
+        with tarfile.open(self.tar_path) as tar:
+            member = tar.getmember("root/home/user/notes.txt")
+        node = vfs._get_current_dir()
+        for part in ("root", "home", "user", "notes.txt"):
+            node = vfs._child(node, part)
+        self.assertEqual((node.offset, node.size), (member.offset_data, member.size))
+
+    def test_stale_index_is_ignored(self):
+        VirtualFileSystem(self.tar_path).ls("/")
+        make_tar(self.tar_path, {"other/file.txt": b"data"})
+        vfs = VirtualFileSystem(self.tar_path)
+        self.assertEqual(vfs.ls("/"), "other")
+
+
+class TestFileContents(unittest.TestCase):
+    LOG = b"".join(b"line %d of the log\n" % i for i in range(1, 5001))
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tar_path = os.path.join(self.tmp.name, "image.tar")
+        make_tar(self.tar_path, {
+            "root/var/app.log": self.LOG,
+            "root/etc/motd": b"no trailing newline",
+        })
+        self.vfs = self.open(self.tar_path)
+
+    def open(self, tar_path):
+        return VirtualFileSystem(tar_path, use_index=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cat(self):
+        result = "".join(self.vfs.cat("/root/var/app.log"))
+        self.assertEqual(result, self.LOG.decode())
+
+    def test_iter_file_returns_views(self):
+        chunks = list(self.vfs.iter_file("/root/var/app.log", chunk_size=4096))
+        self.assertTrue(all(isinstance(chunk, memoryview) for chunk in chunks))
+        self.assertEqual(b"".join(chunks), self.LOG)
+
+    def test_head_and_tail(self):
+        self.assertEqual(self.vfs.head("/root/var/app.log", 2), "line 1 of the log\nline 2 of the log")
+        self.assertEqual(self.vfs.tail("/root/var/app.log", 2), "line 4999 of the log\nline 5000 of the log")
+        self.assertEqual(self.vfs.tail("/root/etc/motd", 5), "no trailing newline")
+
+    def test_wc(self):
+        self.assertEqual(self.vfs.wc("/root/var/app.log"), f"5000 25000 {len(self.LOG)} /root/var/app.log")
+
+    def test_touched_file_is_empty(self):
+        self.vfs.cd("/root/etc")
+        self.vfs.touch("empty")
+        self.assertEqual("".join(self.vfs.cat("empty")), "")
+        self.assertEqual(self.vfs.wc("empty"), "0 0 0 empty")
+
+    def test_cat_directory(self):
+        with self.assertRaises(IsADirectoryError):
+            list(self.vfs.cat("/root/var"))
+
+    def test_copied_file(self):
+        self.vfs.cp("/root/var/app.log", "/root/etc")
+        self.assertEqual(self.vfs.head("/root/etc/app.log", 1), "line 1 of the log")
+        with self.assertRaises(FileNotFoundError):
+            self.vfs.wc("/root/missing")
+
+    def test_duplicate_member_last_wins(self):
+        # Архив, дописанный tar -r: одна и та же запись лежит в нём дважды, действует последняя
+        tar_path = os.path.join(self.tmp.name, "appended.tar")
+        with tarfile.open(tar_path, "w") as tar:
+            for data in (b"old", b"new contents"):
+                info = tarfile.TarInfo("etc/conf")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        vfs = self.open(tar_path)
+        self.assertEqual(vfs.ls("/etc"), "conf")
+        self.assertEqual("".join(vfs.cat("/etc/conf")), "new contents")
+
+    def test_duplicate_member_counted_once(self):
+        # Итоги каталога учитывают только последнюю из повторённых записей, в том числе после загрузки из индекса
+        tar_path = os.path.join(self.tmp.name, "appended.tar")
+        with tarfile.open(tar_path, "w") as tar:
+            for name, data in (("etc/hosts", b"127.0.0.1 me\n"), ("etc/hosts", b"127.0.0.1 me\n"),
+                               ("var/run", b"pid"), ("var/run/app.pid", b"42")):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        for _ in range(2):
+            vfs = self.open(tar_path)
+            self.assertIn("Entries: 1", vfs.stat("/etc"))
+            self.assertIn("Size: 13", vfs.stat("/etc"))
+            self.assertIn("Entries: 5", vfs.stat("/"))
+            self.assertIn("Size: 15", vfs.stat("/"))
+
+
+class TestInodeFileContents(TestFileContents):
+    def open(self, tar_path):
+        return InodeFileSystem(tar_path)
+
+
+class TestCompressedArchive(unittest.TestCase):
+    LOG = TestFileContents.LOG
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        tar_path = os.path.join(self.tmp.name, "image.tar")
+        make_tar(tar_path, {f"root/log{i}.txt": self.LOG for i in range(8)})
+        with open(tar_path, "rb") as f:
+            self.raw = f.read()
+
+    def write(self, name, compressed):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(compressed)
+        return path
+
+    def test_gzip_and_xz_contents(self):
+        for name, compressed in (("image.tar.gz", gzip.compress(self.raw)), ("image.tar.xz", lzma.compress(self.raw))):
+            with self.subTest(name):
+                vfs = VirtualFileSystem(self.write(name, compressed))
+                self.assertEqual(vfs.ls("/root").split(), [f"log{i}.txt" for i in range(8)])
+                self.assertEqual("".join(vfs.cat("/root/log7.txt")), self.LOG.decode())
+                self.assertEqual(vfs.tail("/root/log3.txt", 1), "line 5000 of the log")
+                self.assertEqual(vfs.head("/root/log5.txt", 1), "line 1 of the log")
+
+    def test_random_access_uses_checkpoints(self):
+        path = self.write("image.tar.gz", gzip.compress(self.raw))
+        # С системной zlib точки — границы блоков deflate, без неё — копии состояния zlib.decompressobj
+        for libz in (_libz, None):
+            with self.subTest(libz=libz is not None), mock.patch("emulator._libz", libz), \
+                    mock.patch("emulator.CHECKPOINT_SPAN", 64 * 1024):
+                data = _CompressedData(path)
+                self.assertEqual(data[0:len(self.raw)], self.raw)
+                self.assertGreater(len(data._states), 3)
+                # Чтение с конца начинается с ближайшей контрольной точки, а не с начала архива
+                self.assertEqual(data[0:100], self.raw[:100])
+                start = len(self.raw) - 1000
+                self.assertEqual(data[start:start + 100], self.raw[start:start + 100])
+                self.assertGreaterEqual(data._buffer_start, data._states[-1][0])
+                self.assertEqual(data.rfind(b"line 1 ", 0, len(self.raw)), self.raw.rfind(b"line 1 "))
+                data.close()
+                os.remove(path + CHECKPOINTS_SUFFIX)
+
+    @unittest.skipIf(_libz is None, "нужна системная библиотека zlib")
+    def test_block_points_are_cached(self):
+        # Архив из одного члена gzip: точки внутри него сохраняются в .vfsz вместе с окнами распаковки
+        path = self.write("image.tar.gz", gzip.compress(self.raw))
+        with mock.patch("emulator.CHECKPOINT_SPAN", 64 * 1024):
+            data = _CompressedData(path)
+            self.assertEqual(data[0:len(self.raw)], self.raw)
+            data.close()
+            data = _CompressedData(path)
+            self.assertGreater(len(data._states), 3)
+            # Граница блока бывает и внутри байта — распаковка с каждой точки должна совпасть с исходными данными
+            for position, *_ in reversed(data._states):
+                self.assertEqual(data[position:position + 100], self.raw[position:position + 100])
+            data.close()
+            start = len(self.raw) - 10
+            steps = []
+            for cached in (True, False):
+                if not cached:
+                    os.remove(path + CHECKPOINTS_SUFFIX)
+                data = _CompressedData(path)
+                with mock.patch.object(data, "_step", wraps=data._step) as step:
+                    self.assertEqual(data[start:len(self.raw)], self.raw[start:])
+                steps.append(step.call_count)
+                data.close()
+            self.assertLess(steps[0] * 3, steps[1])
+
+    def test_member_points_are_cached(self):
+        # Архив из нескольких членов gzip, как у bgzip и pigz -i: с начала каждого члена распаковку можно начать заново
+        size = len(self.raw) // 4
+        members = b"".join(gzip.compress(self.raw[i:i + size]) for i in range(0, len(self.raw), size))
+        path = self.write("image.tar.gz", members)
+        with mock.patch("emulator.CHECKPOINT_SPAN", 1):
+            vfs = VirtualFileSystem(path)
+            vfs.ls("/")
+            self.assertTrue(os.path.exists(path + CHECKPOINTS_SUFFIX))
+            steps = []
+            for cached in (True, False):
+                if not cached:
+                    os.remove(path + CHECKPOINTS_SUFFIX)
+                data = _CompressedData(path)
+                self.assertEqual(len(data._points), 4 if cached else 1)
+                start = len(self.raw) - 10
+                with mock.patch.object(data, "_step", wraps=data._step) as step:
+                    self.assertEqual(data[start:len(self.raw)], self.raw[start:])
+                steps.append(step.call_count)
+                data.close()
+            # С сохранёнными точками распаковывается только последний член
+            self.assertLess(steps[0] * 3, steps[1])
+
+    def test_save_compressed(self):
+        vfs = VirtualFileSystem(self.write("image.tar.gz", gzip.compress(self.raw)))
+        vfs.touch("new.txt")
+        target = os.path.join(self.tmp.name, "saved.tar.xz")
+        vfs.save(target)
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(6), b"\xfd7zXZ\x00")
+        saved = VirtualFileSystem(target)
+        self.assertEqual(sorted(saved.ls("/").split()), ["new.txt", "root"])
+        self.assertEqual(saved.wc("/root/log0.txt"), f"5000 25000 {len(self.LOG)} /root/log0.txt")
+
+    def test_inode_backend(self):
+        vfs = InodeFileSystem(self.write("image.tar.xz", lzma.compress(self.raw)))
+        self.assertEqual(vfs.ls("/root").split()[0], "log0.txt")
+
+
+class TestOverlay(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.layers = [os.path.join(self.tmp.name, name) for name in ("base.tar", "app.tar")]
+        make_tar(self.layers[0], {
+            "etc/passwd": b"root\n",
+            "etc/hosts": b"localhost\n",
+            "usr/bin/sh": b"ELF",
+            "var/cache/a": b"aaaa",
+        })
+        make_tar(self.layers[1], {
+            "etc/hosts": b"127.0.0.1 app\n",
+            "etc/.wh.passwd": b"",
+            "var/cache/.wh..wh..opq": b"",
+            "var/cache/b": b"b",
+            "app/main.py": b"print(1)\n",
+        })
+        self.vfs = VirtualFileSystem(self.layers)
+
+    def test_upper_layer_wins(self):
+        self.assertEqual("".join(self.vfs.cat("/etc/hosts")), "127.0.0.1 app\n")
+        self.assertEqual("".join(self.vfs.cat("/usr/bin/sh")), "ELF")
+        self.assertEqual(sorted(self.vfs.ls("/").split()), ["app", "etc", "usr", "var"])
+
+    def test_whiteouts(self):
+        self.assertEqual(self.vfs.ls("/etc").split(), ["hosts"])
+        self.assertEqual(self.vfs.ls("/var/cache").split(), ["b"])
+        self.assertEqual(list(self.vfs.find("/", "passwd")), [])
+        self.assertEqual(list(self.vfs.find("/", ".wh.*")), [])
+
+    def test_totals(self):
+        self.assertEqual(list(self.vfs.du("/", summarize=True)), [f"{14 + 3 + 1 + 9}\t/"])
+
+    def test_whiteouts_in_single_layer_directories(self):
+        # Каталоги usr и app есть только в одном слое, но и из них .wh.-записи убираются
+        make_tar(self.layers[0], {"etc/hosts": b"localhost\n", "usr/.wh.stale": b"", "usr/bin/.wh..wh..opq": b"",
+                                  "usr/bin/sh": b"ELF"})
+        make_tar(self.layers[1], {"etc/hosts": b"127.0.0.1 app\n", "app/.wh.old": b"", "app/main.py": b"print(1)\n"})
+        vfs = VirtualFileSystem(self.layers, use_index=False)
+        self.assertEqual(vfs.ls("/usr").split(), ["bin"])
+        self.assertEqual(vfs.ls("/usr/bin").split(), ["sh"])
+        self.assertEqual(vfs.ls("/app").split(), ["main.py"])
+        self.assertEqual(list(vfs.find("/", ".wh.*")), [])
+        self.assertEqual(vfs.tree_stats()["entries"], 7)
+        self.assertEqual(len(list(vfs.find("/"))), 8)
+
+    def test_layer_indexes_are_cached(self):
+        self.assertTrue(all(os.path.exists(path + INDEX_SUFFIX) for path in self.layers))
+        with mock.patch("emulator._layer_index") as build:
+            vfs = VirtualFileSystem(self.layers)
+        build.assert_not_called()
+        self.assertEqual(vfs.ls("/etc").split(), ["hosts"])
+
+    def test_changes_stay_above_layers(self):
+        self.vfs.mv("/app/main.py", "/etc")
+        target = os.path.join(self.tmp.name, "flat.tar")
+        self.vfs.save(target)
+        flat = VirtualFileSystem(target, use_index=False)
+        self.assertEqual(sorted(flat.find("/", "*", "f")), ["/etc/hosts", "/etc/main.py", "/usr/bin/sh", "/var/cache/b"])
+        self.assertEqual("".join(flat.cat("/etc/main.py")), "print(1)\n")
+        # Архивы слоёв не меняются, сохранить оверлей поверх них без пути нельзя
+        self.assertEqual(VirtualFileSystem(self.layers).ls("/app"), "main.py")
+        with self.assertRaises(ValueError):
+            self.vfs.save()
+
+    def test_file_replaces_directory_with_whiteouts(self):
+        # Верхний слой заменяет каталог x файлом, а в нижнем под x есть затирка
+        make_tar(self.layers[0], {"x/sub/.wh.foo": b"", "x/sub/bar": b"b"})
+        make_tar(self.layers[1], {"x": b"file"})
+        vfs = VirtualFileSystem(self.layers, use_index=False)
+        self.assertEqual("".join(vfs.cat("/x")), "file")
+        self.assertEqual(list(vfs.du("/", True)), ["4\t/"])
+
+    def test_inode_backend_rejects_layers(self):
+        with self.assertRaises(ValueError):
+            InodeFileSystem(self.layers)
+
+
+class TestServer(unittest.TestCase):
+    backend = VirtualFileSystem
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        tar_path = os.path.join(self.tmp.name, "image.tar")
+        make_tar(tar_path, {"etc/hosts": b"localhost\n", "home/readme": b"hi\n"})
+        self.server = SessionServer(self.backend(tar_path, journal=False))
+        self.address = os.path.join(self.tmp.name, "vfs.sock")
+
+    def run_clients(self, *scripts):
+        async def client(script):
+            reader, writer = await asyncio.open_unix_connection(self.address)
+            writer.write("".join(line + "\n" for line in script).encode())
+            await writer.drain()
+            output = await reader.read()
+            writer.close()
+            return output.decode()
+
+        async def scenario():
+            server = await self.server.start(self.address)
+            async with server:
+                results = await asyncio.gather(*(client(script) for script in scripts))
+                while self.server.sessions:
+                    await asyncio.sleep(0.01)
+            return results
+
+        return asyncio.run(scenario())
+
+    def test_sessions_have_own_cwd(self):
+        alice, bob = self.run_clients(["alice", "cd etc", "ls", "exit"], ["bob", "cd home", "ls", "exit"])
+        self.assertTrue(alice.startswith("Добро пожаловать, alice!\nalice@vfs:/$ "))
+        self.assertIn("alice@vfs:/etc$ hosts\n", alice)
+        self.assertIn("bob@vfs:/home$ readme\n", bob)
+
+    def test_transactions_are_isolated(self):
+        async def scenario():
+            server = await self.server.start(self.address)
+            async with server:
+                async def connect(user):
+                    reader, writer = await asyncio.open_unix_connection(self.address)
+                    writer.write(f"{user}\n".encode())
+                    await reader.readuntil(b"$ ")
+
+                    async def run(command):
+                        writer.write(f"{command}\n".encode())
+                        return (await reader.readuntil(b"$ ")).decode()
+                    return run, writer
+
+                alice, alice_writer = await connect("alice")
+                bob, bob_writer = await connect("bob")
+                await alice("begin")
+                await alice("touch draft")
+                self.assertIn("draft", await alice("ls /"))
+                self.assertNotIn("draft", await bob("ls /"))
+                self.assertIn("Изменения применены", await alice("commit"))
+                self.assertIn("draft", await bob("ls /"))
+                # Изменение, применённое другой сессией во время транзакции, отменяет её
+                await alice("begin")
+                await alice("touch second")
+                await bob("touch bobs")
+                self.assertIn("Ошибка:", await alice("commit"))
+                self.assertEqual(sorted((await alice("ls /")).split()[:-1]), ["bobs", "draft", "etc", "home"])
+                for writer in (alice_writer, bob_writer):
+                    writer.close()
+                while self.server.sessions:
+                    await asyncio.sleep(0.01)
+
+        asyncio.run(scenario())
+
+    def test_changes_are_shared(self):
+        self.run_clients(["alice", "cd home", "touch notes", "exit"])
+        bob, = self.run_clients(["bob", "ls /home", "cat /etc/missing", "exit"])
+        self.assertIn("notes\nreadme\n", bob)
+        self.assertIn("Ошибка: File /etc/missing not found.", bob)
+        self.assertEqual(self.server.vfs.ls("/home").split(), ["notes", "readme"])
+
+    def test_output_unaffected_by_other_sessions(self):
+        # Между порциями вывода tree другая сессия удаляет выводимый каталог и создаёт новые записи
+        tar_path = os.path.join(self.tmp.name, "wide.tar")
+        make_tar(tar_path, {f"a/file{i:03}": b"" for i in range(300)}, dirs=["b"])
+        server = SessionServer(self.backend(tar_path, journal=False))
+        expected = server.vfs.tree("/") + "\n"
+
+        def drain(session, output):
+            return "".join(iter(lambda: "".join(server._step(session, output) or ()), ""))
+
+        def run(session, command):
+            return drain(session, server.dispatcher.execute(command))
+
+        alice, bob = _Session("alice"), _Session("bob")
+        output = server.dispatcher.execute("tree /")
+        shown = "".join(server._step(alice, output))
+        run(bob, "rm -r /a")
+        run(bob, "cd /b")
+        for i in range(250):
+            run(bob, f"touch new{i}")
+        shown += drain(alice, output)
+        self.assertEqual(shown, expected)
+        self.assertEqual(len(server.vfs.ls("/b").split()), 250)
+
+
+class TestInodeServer(TestServer):
+    backend = InodeFileSystem
+
+    def test_transactions_are_isolated(self):
+        alice, = self.run_clients(["alice", "begin", "cd etc", "ls", "exit"])
+        self.assertIn("alice@vfs:/$ Ошибка: Команда begin не поддерживается представлением inode\n", alice)
+        self.assertIn("alice@vfs:/etc$ hosts\n", alice)
+
+
 if __name__ == "__main__":
     unittest.main()